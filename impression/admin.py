@@ -1,8 +1,40 @@
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
 from django.utils.translation import gettext_lazy as _
 
-from . import models
+from . import models, search
 from .forms import TemplateForm
+from .paginator import EstimatedCountPaginator
+from .routers import replica_reads
+
+
+class ReplicaChangeListMixin:
+    """
+    Read the change list from the replica (if ``impression.routers.ReplicaRouter`` is
+    used). Only ``GET`` requests are routed, since actions are posted to the change
+    list.
+    """
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method != "GET":
+            return super().changelist_view(request, extra_context)
+        with replica_reads():
+            return super().changelist_view(request, extra_context)
+
+
+class FullTextSearchMixin:
+    """
+    Search with the full-text search index (see ``impression.search``) when it's
+    enabled, rather than with ``search_fields``.
+    """
+
+    def get_search_results(self, request, queryset, search_term):
+        if search_term.strip():
+            results = search.search(queryset, search_term)
+            if results is not None:
+                return results, False
+        return super().get_search_results(request, queryset, search_term)
 
 
 @admin.register(models.EmailAddress)
@@ -13,9 +45,9 @@ class EmailAddressAdmin(admin.ModelAdmin):
 
 
 @admin.register(models.Template)
-class TemplateAdmin(admin.ModelAdmin):
+class TemplateAdmin(FullTextSearchMixin, admin.ModelAdmin):
     list_filter = ("extends",)
-    search_fields = ("subject", "body", "extends")
+    search_fields = ("name", "subject", "body_html", "body_plaintext")
     list_display = ("name", "subject", "extends")
     form = TemplateForm
 
@@ -91,9 +123,85 @@ class EmailMessageSentFilter(admin.SimpleListFilter):
         return queryset
 
 
+class KeysetChangeList(ChangeList):
+    """
+    A change list which, in the default (newest first) ordering, can page with the
+    primary key of the last row shown (``?before=<pk>``) rather than with an offset,
+    which gets slower the further into a large table you go. Once paged or filtered,
+    the rows aren't counted at all (the database statistics can't estimate the count of
+    a filtered list); one more row than is shown is fetched to find out whether there
+    are older ones.
+    """
+
+    keyset_var = "before"
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(self.keyset_var, None)
+        return lookup_params
+
+    def has_default_ordering(self):
+        return ORDER_VAR not in self.params
+
+    def is_uncounted(self):
+        return (
+            self.has_default_ordering()
+            and not self.show_all
+            and bool(self.queryset.query.where)
+        )
+
+    def get_queryset(self, request, *args, **kwargs):
+        queryset = super().get_queryset(request, *args, **kwargs)
+        before = self.params.get(self.keyset_var)
+        if before and self.has_default_ordering():
+            try:
+                queryset = queryset.filter(pk__lt=int(before))
+            except ValueError:
+                raise IncorrectLookupParameters
+        return queryset
+
+    def get_results(self, request):
+        if self.is_uncounted():
+            rows = list(self.queryset[: self.list_per_page + 1])
+            self.result_list = rows[: self.list_per_page]
+            self.result_count = len(self.result_list)
+            self.full_result_count = None
+            self.show_full_result_count = False
+            self.show_admin_actions = True
+            self.can_show_all = self.multi_page = False
+            self.paginator = self.model_admin.get_paginator(
+                request, self.queryset, self.list_per_page
+            )
+            has_older = len(rows) > self.list_per_page
+        else:
+            super().get_results(request)
+            has_older = len(self.result_list) == self.list_per_page
+
+        self.keyset_next_url = self.keyset_first_url = None
+        if self.has_default_ordering() and not self.show_all and self.result_list:
+            if has_older:
+                self.keyset_next_url = self.get_query_string(
+                    {self.keyset_var: list(self.result_list)[-1].pk}, [PAGE_VAR]
+                )
+            if self.keyset_var in self.params:
+                self.keyset_first_url = self.get_query_string(
+                    remove=[self.keyset_var, PAGE_VAR]
+                )
+
+
 @admin.register(models.Message)
-class MessageAdmin(admin.ModelAdmin):
-    list_filter = (EmailMessageSentFilter, "service")
+class MessageAdmin(FullTextSearchMixin, ReplicaChangeListMixin, admin.ModelAdmin):
+    """
+    The message table can get very large, so the change list estimates its count,
+    doesn't count the full result, and can page by primary key.
+    """
+
+    change_list_template = "admin/impression/message/change_list.html"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ("-pk",)
+    list_select_related = ("service",)
+    list_filter = (EmailMessageSentFilter, "service", "created")
     search_fields = ("subject",)
     list_display = (
         "id",
@@ -146,6 +254,7 @@ class MessageAdmin(admin.ModelAdmin):
                     "ready_to_send",
                     "sent",
                     "last_attempt",
+                    "attempts",
                 ),
             },
         ),
@@ -158,9 +267,9 @@ class MessageAdmin(admin.ModelAdmin):
                     "final_body_html",
                     "final_body_plaintext",
                     "final_from_email_address",
-                    "final_to_email_addresses",
-                    "final_cc_email_addresses",
-                    "final_bcc_email_addresses",
+                    "_final_to",
+                    "_final_cc",
+                    "_final_bcc",
                 ),
             },
         ),
@@ -169,15 +278,19 @@ class MessageAdmin(admin.ModelAdmin):
         "_user_display",
         "created",
         "updated",
+        "attempts",
         "final_subject",
         "final_body_html",
         "final_body_plaintext",
         "final_from_email_address",
-        "final_to_email_addresses",
-        "final_cc_email_addresses",
-        "final_bcc_email_addresses",
+        "_final_to",
+        "_final_cc",
+        "_final_bcc",
     )
 
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
     def get_fieldsets(self, request, obj=None):
         """
         Hook for specifying fieldsets. Modified to use `fieldsets_without_readonly`.
@@ -190,3 +303,132 @@ class MessageAdmin(admin.ModelAdmin):
         return obj.get_user_display()
 
     _user_display.short_description = "User"
+
+    def _get_final_recipients(self, obj, index):
+        """
+        Display the final recipients of a kind, whether they are packed or not.
+        """
+        if not hasattr(obj, "_final_recipients"):
+            obj._final_recipients = obj.get_final_recipients()
+        return ", ".join(str(e) for e in obj._final_recipients[index])
+
+    def _final_to(self, obj):
+        return self._get_final_recipients(obj, 0)
+
+    _final_to.short_description = "To (final)"
+
+    def _final_cc(self, obj):
+        return self._get_final_recipients(obj, 1)
+
+    _final_cc.short_description = "CC (final)"
+
+    def _final_bcc(self, obj):
+        return self._get_final_recipients(obj, 2)
+
+    _final_bcc.short_description = "BCC (final)"
+
+
+@admin.register(models.ArchivedMessage)
+class ArchivedMessageAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    """
+    Archived messages can be viewed and deleted, but not added or changed.
+    """
+
+    list_filter = ("service",)
+    search_fields = ("subject",)
+    date_hierarchy = "sent"
+    list_display = ("id", "service", "subject", "created", "sent", "archived")
+    list_select_related = ("service",)
+    fieldsets = (
+        (None, {"fields": ("service", "_user_display")}),
+        (
+            "Message Details",
+            {
+                "fields": (
+                    "subject",
+                    "body",
+                    "override_from_email_address",
+                    "_extra_to",
+                    "_extra_cc",
+                    "_extra_bcc",
+                )
+            },
+        ),
+        (
+            "Meta",
+            {
+                "fields": (
+                    "created",
+                    "updated",
+                    "sent",
+                    "last_attempt",
+                    "attempts",
+                    "archived",
+                )
+            },
+        ),
+        (
+            "Final Properties",
+            {
+                "fields": (
+                    "final_subject",
+                    "final_body_html",
+                    "final_body_plaintext",
+                    "final_from_email_address",
+                    "_final_to",
+                    "_final_cc",
+                    "_final_bcc",
+                )
+            },
+        ),
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def _user_display(self, obj):
+        return obj.get_user_display()
+
+    _user_display.short_description = "User"
+
+    def _get_recipients(self, obj, kind, index):
+        """
+        Display the unpacked recipients of a kind, unpacking each field once.
+        """
+        attr = "_{}_recipients".format(kind)
+        if not hasattr(obj, attr):
+            setattr(obj, attr, getattr(obj, "get_{}_recipients".format(kind))())
+        return ", ".join(str(e) for e in getattr(obj, attr)[index])
+
+    def _extra_to(self, obj):
+        return self._get_recipients(obj, "extra", 0)
+
+    _extra_to.short_description = "Extra To"
+
+    def _extra_cc(self, obj):
+        return self._get_recipients(obj, "extra", 1)
+
+    _extra_cc.short_description = "Extra CC"
+
+    def _extra_bcc(self, obj):
+        return self._get_recipients(obj, "extra", 2)
+
+    _extra_bcc.short_description = "Extra BCC"
+
+    def _final_to(self, obj):
+        return self._get_recipients(obj, "final", 0)
+
+    _final_to.short_description = "To (final)"
+
+    def _final_cc(self, obj):
+        return self._get_recipients(obj, "final", 1)
+
+    _final_cc.short_description = "CC (final)"
+
+    def _final_bcc(self, obj):
+        return self._get_recipients(obj, "final", 2)
+
+    _final_bcc.short_description = "BCC (final)"
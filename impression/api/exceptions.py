@@ -0,0 +1,12 @@
+"""
+This module implements exceptions for the API.
+"""
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class PayloadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Request payload is too large."
+    default_code = "payload_too_large"
@@ -0,0 +1,38 @@
+"""
+This module implements parsers for the API.
+"""
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+from .. import codec
+
+
+class FastJSONParser(JSONParser):
+    """
+    Parses JSON with ``impression.codec`` (so ``orjson`` when it is installed). JSON
+    request bodies are always UTF-8.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return codec.loads(stream.read())
+        except ValueError as e:
+            raise ParseError("JSON parse error - {}".format(e))
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline-delimited JSON lazily. Rather than the decoded data, this returns an
+    iterator of ``(line_number, line)`` tuples for the non-blank lines, which reads the
+    stream as it is consumed, so the view can decode (and handle errors) line by line.
+    """
+
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return (
+            (number, line)
+            for number, line in enumerate(stream or (), 1)
+            if line.strip()
+        )
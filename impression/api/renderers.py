@@ -0,0 +1,25 @@
+"""
+This module implements renderers for the API.
+"""
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .. import codec
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Renders JSON with ``impression.codec`` (so ``orjson`` when it is installed). Falls
+    back to DRF's renderer when indentation is requested (e.g., by the browsable API) or
+    ``orjson`` is not available.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if not codec.use_orjson() or self.get_indent(
+            accepted_media_type, renderer_context or {}
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        return codec.dumps(data, default=JSONEncoder().default).encode()
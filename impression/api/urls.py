@@ -1,6 +1,21 @@
 from django.urls import path
 
-from .views import SendMessageAPIView
+from .views import (
+    MessageStatusAPIView,
+    QuotaAPIView,
+    SendMessageAPIView,
+    SendMessagesAPIView,
+    StreamMessagesAPIView,
+    async_send_message,
+)
 
-
-urlpatterns = [path("send_message/", SendMessageAPIView.as_view(), name="send_message")]
+urlpatterns = [
+    path("send_message/", SendMessageAPIView.as_view(), name="send_message"),
+    path("async/send_message/", async_send_message, name="async_send_message"),
+    path("send_messages/", SendMessagesAPIView.as_view(), name="send_messages"),
+    path("stream_messages/", StreamMessagesAPIView.as_view(), name="stream_messages"),
+    path("messages/", MessageStatusAPIView.as_view(), name="message_status"),
+    path("messages/<int:pk>/", MessageStatusAPIView.as_view(), name="message_status"),
+    path("quota/", QuotaAPIView.as_view(), name="quota"),
+    path("quota/<str:service_name>/", QuotaAPIView.as_view(), name="quota"),
+]
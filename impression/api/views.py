@@ -1,119 +1,661 @@
-import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from asgiref.sync import sync_to_async
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, transaction
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
 
-from rest_framework import permissions, status
-from rest_framework.exceptions import NotFound, Throttled, ValidationError
+from rest_framework import exceptions, permissions, status
+from rest_framework.exceptions import APIException, NotFound, Throttled, ValidationError
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 
-from ..exceptions import RateLimitException, JSONBodyRequired
-from ..models import EmailAddress, Message, Service
+from .. import codec
+from ..cache import get_service
+from ..exceptions import (
+    BodyTooLarge,
+    ImpressionMessageException,
+    RateLimitException,
+    JSONBodyRequired,
+)
+from ..models import EmailAddress, IdempotencyKey, Message, Service
+from ..routers import replica_reads
+from ..settings import get_setting
+from .exceptions import PayloadTooLarge
+from .parsers import NDJSONParser
 
 
-class SendMessageAPIView(APIView):
+class ServiceAPIView(APIView):
     """
-    This API view is for external services that need to send email via this Impression
-    server. This view enforces group permissions in accordance with the Service's
-    allowed groups.
+    Base API view for external services acting on a service of this Impression server.
+    This view enforces group permissions in accordance with the Service's allowed
+    groups, and reports the caller's rate limit quota in the response headers.
     """
 
     permission_classes = [permissions.IsAuthenticated]
+    quota = None
 
-    def get_view_name(self):
-        return "Send Message API"
+    def get_service_name(self, request):
+        """
+        Extract the service name. The service must either be identified in the URL
+        pattern, or as a query parameter, or in the request data, all as the variable
+        ``service_name``. The precedance is in that same order, so for example, if the
+        service is defined in the URL parameter, then the service in the request data
+        will be ignored.
 
-    def create_message(self, request, *args, **kwargs):
+        Return ``None`` if the service name is not provided.
+        """
+        if "service_name" in self.kwargs:
+            return self.kwargs.get("service_name")
+        elif "service_name" in request.query_params:
+            return request.query_params.get("service_name")
+        elif isinstance(request.data, dict) and "service_name" in request.data:
+            return request.data.get("service_name")
+        return None
+
+    @staticmethod
+    def get_email_strings(item, kind):
+        """
+        Return the email strings of the given kind from a message in the request data.
         """
-        Create a message attached to a service. The service must either be identified in
-        the URL pattern, or as a query parameter, or in the request data, all as the
-        variable ``service_name``. The precedance is in that same order, so for example,
-        if the service is defined in the URL parameter, then the service in the request
-        data will be ignored.
+        emails = item.get(kind) or []
+        return [emails] if isinstance(emails, str) else emails
+
+    @staticmethod
+    def extract_body(service, body):
+        """
+        Validate the body of a message in the request data with
+        ``Service.extract_body_data``, raising an ``APIException`` if it's invalid.
+
+        Return a tuple in the form (body, body_data).
         """
+        try:
+            return service.extract_body_data(body)
+        except JSONBodyRequired:
+            raise ValidationError(detail="Body must be a JSON object.")
+        except BodyTooLarge as e:
+            raise PayloadTooLarge(detail=str(e))
+        except ImpressionMessageException as e:
+            raise ValidationError(detail=str(e))
 
+    def get_service(self, request):
+        """
+        Resolve the service and check the user is permitted to use it.
+        """
         # extract service name
-        if "service_name" in self.kwargs:
-            service_name = self.kwargs.get("service_name")
-        elif "service_name" in request.query_params:
-            service_name = request.query_params.get("service_name")
-        elif "service_name" in request.data:
-            service_name = request.data.get("service_name")
-        else:
+        service_name = self.get_service_name(request)
+        if service_name is None:
             raise NotFound(detail="Target service name not provided.")
 
-        # resolve to service, or raise error
+        # resolve to service (from the cache, if possible), or raise error
         try:
-            service = Service.objects.get(name=service_name)
+            service = get_service(service_name)
         except (Service.DoesNotExist, ValueError, TypeError):
             raise NotFound(detail="Target service not found.")
 
         # check for service-level permissions
-        allowed_groups = service.allowed_groups.values_list("pk", flat=True)
-        if not request.user.groups.filter(pk__in=allowed_groups):
+        if not service.is_allowed(request.user):
             raise PermissionDenied()
 
+        return service
+
+    def get_quota(self, request, service):
+        """
+        Get the rate limit quota of the user on the service, and keep it for the
+        response headers.
+        """
+        self.quota = service.get_quota(
+            request.user, service.get_allowed_groups(request.user)
+        )
+        return self.quota
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        """
+        Add the rate limit quota headers, if the quota was retrieved.
+        """
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.quota:
+            limit, remaining, reset = self.quota
+            response["X-RateLimit-Limit"] = limit
+            response["X-RateLimit-Remaining"] = remaining
+            response["X-RateLimit-Reset"] = int(reset.timestamp())
+        return response
+
+
+class SendMessageAPIView(ServiceAPIView):
+    """
+    This API view is for external services that need to send email via this Impression
+    server.
+    """
+
+    idempotency_key = None
+    message = None
+
+    def get_view_name(self):
+        return "Send Message API"
+
+    def is_async(self, request):
+        """
+        Whether the message should be queued for the ``impression_send_emails`` command
+        rather than sent inline. The request can ask for this with the
+        ``Prefer: respond-async`` header, otherwise ``IMPRESSION_ASYNC_INTAKE`` decides.
+        """
+        prefer = request.headers.get("Prefer", "")
+        if "respond-async" in [p.strip() for p in prefer.lower().split(",")]:
+            return True
+        return bool(get_setting("IMPRESSION_ASYNC_INTAKE"))
+
+    def create_message(self, request, *args, **kwargs):
+        """
+        Create a message attached to a service, which is resolved by ``get_service``.
+        In async mode, respond with ``202 Accepted``, the message ID and a URL for its
+        status, and leave sending to the workers.
+        """
+        service = self.get_service(request)
+
         # extract FROM email
         from_email = request.data.get("from", None)
         if from_email:
             from_email, _ = EmailAddress.get_or_create(from_email)
 
-        # check body
-        body_raw = request.data.get("body", "") or ""
-        if isinstance(body_raw, dict):
-            if service.json_body_policy == service.FORBID:
-                raise ValidationError(detail="Body cannot be a JSON object.")
-            body = json.dumps(body_raw)
-        elif isinstance(body_raw, str):
-            body = body_raw
-        else:
-            raise ValidationError(
-                detail="Body has invalid type {}".format(type(body_raw))
-            )
+        # check body, keeping decoded JSON objects for rendering
+        body, body_data = self.extract_body(service, request.data.get("body"))
 
-        # build message
-        message = Message(
-            service=service,
-            override_from_email_address=from_email,
-            subject=request.data.get("subject", "") or "",
-            body=body,
-        )
-
-        # associate message with user
-        message.user_type = ContentType.objects.get_for_model(request.user)
-        message.user_id = request.user.pk
+        # resolve the extra emails
+        to, cc, bcc = self.get_recipients(request)
 
-        # try saving, handling RateLimitException
+        # create the message, ready to send, handling RateLimitException; the
+        # idempotency key (if any) is bound to it in the same transaction
         try:
-            message.save()
+            with transaction.atomic():
+                message = Message.objects.create_ready(
+                    to=to,
+                    cc=cc,
+                    bcc=bcc,
+                    send_now=False,
+                    service=service,
+                    override_from_email_address=from_email,
+                    subject=request.data.get("subject", "") or "",
+                    body=body,
+                    body_data=body_data,
+                    user=request.user,
+                )
+                if self.idempotency_key:
+                    self.idempotency_key.message = message
+                    self.idempotency_key.save(update_fields=["message"])
         except RateLimitException:
-            raise Throttled(detail="Rate limit has been reached!")
+            quota = self.get_quota(request, service)
+            raise Throttled(
+                wait=(quota[2] - timezone.now()).total_seconds() if quota else None,
+                detail="Rate limit has been reached!",
+            )
         except JSONBodyRequired:
             raise ValidationError(detail="Body must be a JSON object.")
+        except BodyTooLarge as e:
+            raise PayloadTooLarge(detail=str(e))
+        self.message = message
 
-        # add emails to the message
-        message.extra_to_email_addresses.add(
-            *EmailAddress.convert_emails(request.data.get("to", []))
-        )
-        message.extra_cc_email_addresses.add(
-            *EmailAddress.convert_emails(request.data.get("cc", []))
-        )
-        message.extra_bcc_email_addresses.add(
-            *EmailAddress.convert_emails(request.data.get("bcc", []))
+        is_async = self.is_async(request)
+        if not is_async:
+            message.send()
+        self.get_quota(request, service)
+        if is_async:
+            return self.get_accepted_response(request, message)
+        return Response({}, status=status.HTTP_201_CREATED)
+
+    def get_recipients(self, request):
+        """
+        Resolve the extra email addresses of the message.
+
+        Return a tuple in the form (to, cc, bcc).
+        """
+        recipients = [
+            self.get_email_strings(request.data, kind) for kind in ("to", "cc", "bcc")
+        ]
+        emails = EmailAddress.bulk_get_or_create(e for r in recipients for e in r)
+        return tuple([emails[e] for e in r if e in emails] for r in recipients)
+
+    @staticmethod
+    def get_accepted_response(request, message):
+        """
+        Respond with ``202 Accepted``, the message ID and a URL for its status.
+        """
+        status_url = reverse("message_status", args=[message.pk], request=request)
+        return Response(
+            {"id": message.pk, "status_url": status_url},
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": status_url},
         )
 
-        # signal message can be sent
-        message.ready_to_send = True
-        message.save()
+    def create_message_once(self, request, *args, **kwargs):
+        """
+        Create a message, unless the request has an ``Idempotency-Key`` header which the
+        user has already used, in which case respond with the original result without
+        creating (or sending) another message. Requests which fail before creating a
+        message do not keep the key, so they can be retried; if sending fails after the
+        message was created, the message is left queued for the workers and the key
+        records a ``202 Accepted`` response for it.
+        """
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return self.create_message(request, *args, **kwargs)
+        if len(key) > IdempotencyKey._meta.get_field("key").max_length:
+            raise ValidationError(detail="Idempotency key is too long.")
 
-        return Response({}, status=status.HTTP_201_CREATED)
+        # replay the original result, if there is one
+        idempotency_key, created = IdempotencyKey.claim(request.user, key)
+        if not created:
+            if idempotency_key.status_code is None:
+                if idempotency_key.message_id is not None:
+                    return self.get_accepted_response(request, idempotency_key.message)
+                return Response(
+                    {"detail": "A request with this idempotency key is in progress."},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            data = idempotency_key.get_response_data()
+            headers = {"Idempotent-Replayed": "true"}
+            if data and "status_url" in data:
+                headers["Location"] = data["status_url"]
+            return Response(data, status=idempotency_key.status_code, headers=headers)
+
+        self.idempotency_key = idempotency_key
+        try:
+            response = self.create_message(request, *args, **kwargs)
+        except Exception:
+            if idempotency_key.message_id is None:
+                idempotency_key.delete()
+            else:
+                self.save_idempotent_response(
+                    self.get_accepted_response(request, idempotency_key.message)
+                )
+            raise
+        self.save_idempotent_response(response)
+        return response
+
+    def save_idempotent_response(self, response):
+        self.idempotency_key.status_code = response.status_code
+        self.idempotency_key.response_data = codec.dumps(
+            response.data, default=JSONEncoder().default
+        )
+        self.idempotency_key.save(update_fields=["status_code", "response_data"])
 
     def get(self, request, *args, **kwargs):
         return self.options(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
-        return self.create_message(request, *args, **kwargs)
+        return self.create_message_once(request, *args, **kwargs)
 
     def put(self, request, *args, **kwargs):
-        return self.create_message(request, *args, **kwargs)
+        return self.create_message_once(request, *args, **kwargs)
+
+
+class MessageStatusAPIView(APIView):
+    """
+    This API view lets external services look up the delivery state of the messages
+    they created, either one message by ID in the URL, or a batch of messages with a
+    comma-separated list of IDs in the ``ids`` query parameter. Single lookups support
+    conditional requests (``If-None-Match`` and ``If-Modified-Since``) based on when
+    the message was last updated, so polling clients get a ``304 Not Modified``.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    status_fields = (
+        "id",
+        "ready_to_send",
+        "sent",
+        "last_attempt",
+        "attempts",
+        "updated",
+    )
+    max_batch_size = 1000
+
+    def get_view_name(self):
+        return "Message Status API"
+
+    def get_queryset(self, request):
+        """
+        Return the messages which were created by the user, with just the fields needed
+        for the status.
+        """
+        return Message.objects.filter(
+            user_type=ContentType.objects.get_for_model(request.user),
+            user_id=request.user.pk,
+        ).only(*self.status_fields)
+
+    @staticmethod
+    def get_status(message):
+        return {
+            "id": message.pk,
+            "state": message.get_state(),
+            "attempts": message.attempts,
+            "sent": message.sent,
+            "last_attempt": message.last_attempt,
+        }
+
+    @staticmethod
+    def get_etag(message):
+        return '"{}-{}"'.format(message.pk, message.updated.timestamp())
+
+    def get_ids(self, request):
+        """
+        Extract the list of message IDs for a batch lookup.
+        """
+        try:
+            ids = [int(i) for i in request.query_params.get("ids", "").split(",") if i]
+        except ValueError:
+            raise ValidationError(
+                detail="IDs must be a comma-separated list of integers."
+            )
+        if len(ids) > self.max_batch_size:
+            raise ValidationError(
+                detail="At most {} IDs can be looked up at once.".format(
+                    self.max_batch_size
+                )
+            )
+        return ids
+
+    @replica_reads()
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset(request)
+        if "pk" not in self.kwargs:
+            messages = queryset.filter(pk__in=self.get_ids(request)).order_by("pk")
+            return Response({"results": [self.get_status(m) for m in messages]})
+
+        try:
+            message = queryset.get(pk=self.kwargs["pk"])
+        except Message.DoesNotExist:
+            # a new message may not have reached the replica yet
+            try:
+                message = queryset.using(DEFAULT_DB_ALIAS).get(pk=self.kwargs["pk"])
+            except Message.DoesNotExist:
+                raise NotFound(detail="Message not found.")
+        etag = self.get_etag(message)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=int(message.updated.timestamp())
+        )
+        if response is None:
+            response = Response(self.get_status(message))
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(message.updated.timestamp())
+        return response
+
+
+class QuotaAPIView(ServiceAPIView):
+    """
+    This API view lets external services look up their rate limit quota on a service,
+    so they can pace their requests.
+    """
+
+    def get_view_name(self):
+        return "Quota API"
+
+    @replica_reads()
+    def get(self, request, *args, **kwargs):
+        service = self.get_service(request)
+        quota = self.get_quota(request, service)
+        if not quota:
+            return Response({"limit": None, "remaining": None, "reset": None})
+        limit, remaining, reset = quota
+        return Response({"limit": limit, "remaining": remaining, "reset": reset})
+
+
+class SendMessagesAPIView(ServiceAPIView):
+    """
+    This API view is for external services that need to send many messages at once. The
+    request data should be a list of messages (or an object with the list under
+    ``messages``), each of which may name its own ``service_name``, falling back to the
+    service identified for the request. Messages are queued for the
+    ``impression_send_emails`` command rather than sent inline, and the response has a
+    result for each message, in order.
+    """
+
+    email_kinds = ("from", "to", "cc", "bcc")
+
+    def get_view_name(self):
+        return "Send Messages API"
+
+    def get_messages_data(self, request):
+        """
+        Extract the list of messages from the request data.
+        """
+        data = request.data
+        if isinstance(data, dict):
+            data = data.get("messages")
+        if not isinstance(data, list):
+            raise ValidationError(detail="Messages must be a list.")
+        return data
+
+    def get_services(self, request, service_names):
+        """
+        Resolve the services (from the cache, if possible) and find which of them the
+        user is permitted to use.
+
+        Return a tuple in the form (services_by_name, permitted_service_pks).
+        """
+        services = {}
+        for name in service_names:
+            try:
+                services[name] = get_service(name)
+            except (Service.DoesNotExist, ValueError, TypeError):
+                pass
+        permitted = {s.pk for s in services.values() if s.is_allowed(request.user)}
+        return services, permitted
+
+    def build_message(self, request, item, services, permitted, emails):
+        """
+        Validate a message from the request data and build it, without saving.
+
+        Return a tuple in the form (message, recipients), or raise an ``APIException``.
+        """
+        if not isinstance(item, dict):
+            raise ValidationError(detail="Message must be an object.")
+        service = services.get(item.get("service_name") or self.service_name)
+        if service is None:
+            raise NotFound(detail="Target service not found.")
+        if service.pk not in permitted:
+            raise exceptions.PermissionDenied()
+        body, _ = self.extract_body(service, item.get("body"))
+        from_emails = [e for e in self.get_email_strings(item, "from") if e in emails]
+        message = Message(
+            service=service,
+            override_from_email_address=emails[from_emails[0]] if from_emails else None,
+            subject=item.get("subject", "") or "",
+            body=body,
+            user_type=ContentType.objects.get_for_model(request.user),
+            user_id=request.user.pk,
+        )
+        recipients = tuple(
+            [emails[e] for e in self.get_email_strings(item, kind) if e in emails]
+            for kind in ("to", "cc", "bcc")
+        )
+        return message, recipients
+
+    def process_messages(self, request, items):
+        """
+        Validate the messages, then reserve rate limits and insert the messages in bulk,
+        per service.
+
+        Return a list with a result for each message, in order.
+        """
+        services, permitted = self.get_services(
+            request,
+            {
+                i.get("service_name") or self.service_name
+                for i in items
+                if isinstance(i, dict)
+            },
+        )
+        emails = EmailAddress.bulk_get_or_create(
+            e
+            for i in items
+            if isinstance(i, dict)
+            for kind in self.email_kinds
+            for e in self.get_email_strings(i, kind)
+        )
+
+        # build messages, grouped by service
+        results = [None] * len(items)
+        pending = defaultdict(list)
+        for index, item in enumerate(items):
+            try:
+                message, recipients = self.build_message(
+                    request, item, services, permitted, emails
+                )
+            except APIException as e:
+                results[index] = {"status": e.status_code, "detail": e.detail}
+                continue
+            pending[message.service].append((index, message, recipients))
+
+        # reserve rate limits for each service and insert what fits
+        with transaction.atomic():
+            for service, entries in pending.items():
+                if service.rate_limit:
+                    granted = service.rate_limit.reserve_up_to(
+                        service,
+                        len(entries),
+                        request.user,
+                        service.get_allowed_groups(request.user),
+                    )
+                    for index, _, _ in entries[granted:]:
+                        results[index] = {
+                            "status": status.HTTP_429_TOO_MANY_REQUESTS,
+                            "detail": "Rate limit has been reached!",
+                        }
+                    entries = entries[:granted]
+                messages = Message.objects.bulk_create_ready(
+                    [m for _, m, _ in entries], [r for _, _, r in entries]
+                )
+                for (index, _, _), message in zip(entries, messages):
+                    results[index] = {
+                        "status": status.HTTP_201_CREATED,
+                        "id": message.pk,
+                    }
+        return results
+
+    def create_messages(self, request, *args, **kwargs):
+        items = self.get_messages_data(request)
+        self.service_name = self.get_service_name(request)
+        results = self.process_messages(request, items)
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+    def post(self, request, *args, **kwargs):
+        return self.create_messages(request, *args, **kwargs)
+
+
+class StreamMessagesAPIView(SendMessagesAPIView):
+    """
+    This API view is like the ``SendMessagesAPIView``, but for submissions too large to
+    buffer. The request body is newline-delimited JSON with a message on each line. The
+    lines are read from the request stream as they are processed, in chunks of
+    ``IMPRESSION_STREAM_CHUNK_SIZE`` messages which are each committed separately, and
+    a result for each line is streamed back as newline-delimited JSON.
+    """
+
+    parser_classes = [NDJSONParser]
+
+    def get_view_name(self):
+        return "Stream Messages API"
+
+    def process_chunk(self, request, chunk):
+        """
+        Decode and process a chunk of (line_number, line) pairs, and return the encoded
+        results.
+        """
+        results = {}
+        items = []
+        for number, line in chunk:
+            try:
+                items.append((number, codec.loads(line)))
+            except ValueError:
+                results[number] = {
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "detail": "Line is not valid JSON.",
+                }
+        processed = self.process_messages(request, [item for _, item in items])
+        results.update((number, r) for (number, _), r in zip(items, processed))
+        return "".join(
+            codec.dumps(dict(results[number], line=number)) + "\n"
+            for number, _ in chunk
+        )
+
+    def stream_results(self, request, lines):
+        """
+        Process the lines in chunks, yielding the results of each chunk.
+        """
+        chunk_size = get_setting("IMPRESSION_STREAM_CHUNK_SIZE")
+        chunk = []
+        for number_line in lines:
+            chunk.append(number_line)
+            if len(chunk) >= chunk_size:
+                yield self.process_chunk(request, chunk)
+                chunk = []
+        if chunk:
+            yield self.process_chunk(request, chunk)
+
+    def post(self, request, *args, **kwargs):
+        self.service_name = self.get_service_name(request)
+        return StreamingHttpResponse(
+            self.stream_results(request, request.data),
+            content_type=NDJSONParser.media_type,
+        )
+
+
+_intake_executor = None
+_intake_executor_lock = Lock()
+
+
+def get_intake_executor():
+    """
+    Return the thread pool which runs the intake views for ``async_send_message``. It
+    has ``IMPRESSION_INTAKE_THREADS`` threads, which bounds the number of database
+    connections used by the intake.
+    """
+    global _intake_executor
+    with _intake_executor_lock:
+        if _intake_executor is None:
+            _intake_executor = ThreadPoolExecutor(
+                max_workers=get_setting("IMPRESSION_INTAKE_THREADS"),
+                thread_name_prefix="impression-intake",
+            )
+    return _intake_executor
+
+
+def run_intake_view(view, request, *args, **kwargs):
+    """
+    Run a sync view in an intake thread, rendering the response there, and manage the
+    thread's database connection like a request would.
+    """
+    close_old_connections()
+    try:
+        response = view(request, *args, **kwargs)
+        if hasattr(response, "render"):
+            response.render()
+        return response
+    finally:
+        close_old_connections()
+
+
+send_message_view = SendMessageAPIView.as_view()
+
+
+@csrf_exempt
+async def async_send_message(request, *args, **kwargs):
+    """
+    Async variant of ``SendMessageAPIView`` for ASGI servers. The connection is held by
+    the event loop, and only the view itself (which does the database work) runs in
+    the intake thread pool, so many more requests can be in flight than there are
+    threads.
+    """
+    return await sync_to_async(
+        run_intake_view, thread_sensitive=False, executor=get_intake_executor()
+    )(send_message_view, request, *args, **kwargs)
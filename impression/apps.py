@@ -1,6 +1,16 @@
+from importlib import import_module
+
 from django.apps import AppConfig
 
 
 class CustomAppConfig(AppConfig):
     name = "impression"
     verbose_name = "Impression"
+
+    def ready(self):
+        # register the signal receivers
+        for module in ("signals", "sqlite"):
+            import_module("{}.{}".format(self.name, module))
+        from .search import connect_signals
+
+        connect_signals()
@@ -2,8 +2,12 @@
 This module implements our local email backend.
 """
 
+from collections import defaultdict
+
 from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
 
+from .exceptions import ImpressionMessageException, JSONBodyRequired, RateLimitException
 from .models import EmailAddress, Message, Service
 from .settings import get_setting
 
@@ -13,8 +17,29 @@ class LocalEmailBackend(BaseEmailBackend):
     This backend adds emails to the ``impression.models.Message`` model. We respect the
     from/to/cc/bcc fields here to allow this backend to be a drop-in replacement for
     whatever their true sending backend is.
+
+    Messages are sent as they are added, unless ``send_now`` is False (a class
+    attribute, which can also be passed to ``get_connection()``), in which case they
+    are only queued for the ``impression_send_emails`` command.
     """
 
+    send_now = True
+
+    def __init__(self, fail_silently=False, send_now=None, **kwargs):
+        super().__init__(fail_silently=fail_silently, **kwargs)
+        if send_now is not None:
+            self.send_now = send_now
+
+    def get_service_name(self, message):
+        """
+        Return the service name of the email message, along with its "to" emails. The
+        first address in "to" is interpreted as the service name if it isn't an email,
+        otherwise the ``IMPRESSION_DEFAULT_SERVICE`` is used.
+        """
+        if message.to and not "@" in message.to[0]:
+            return message.to[0], message.to[1:]
+        return get_setting("IMPRESSION_DEFAULT_SERVICE"), message.to
+
     def send_message(self, message):
         """
         Add a single email message to the ``impression.models.Email`` model and return
@@ -26,43 +51,111 @@ class LocalEmailBackend(BaseEmailBackend):
         else:
             from_email = None
 
-        # determine if we should interpret the first address in "to" as the service
-        if message.to and not "@" in message.to[0]:
-            service_name = message.to[0]
-            to_emails = message.to[1:]
-        else:
-            service_name = get_setting("IMPRESSION_DEFAULT_SERVICE")
-            to_emails = message.to
-
         # get service
+        service_name, to_emails = self.get_service_name(message)
         service = Service.objects.get(name=service_name)
 
-        # build message
-        m = Message(
+        # resolve the extra emails
+        recipients = [to_emails or [], message.cc or [], message.bcc or []]
+        emails = EmailAddress.bulk_get_or_create(e for r in recipients for e in r)
+        to, cc, bcc = ([emails[e] for e in r if e in emails] for r in recipients)
+
+        # create the message, ready to send
+        m = Message.objects.create_ready(
+            to=to,
+            cc=cc,
+            bcc=bcc,
             service=service,
             override_from_email_address=from_email,
             subject=message.subject,
             body=message.body,
+            send_now=self.send_now,
         )
-        m.save()
-        m.extra_to_email_addresses.add(*EmailAddress.convert_emails(to_emails or []))
-        m.extra_cc_email_addresses.add(*EmailAddress.convert_emails(message.cc or []))
-        m.extra_bcc_email_addresses.add(*EmailAddress.convert_emails(message.bcc or []))
-
-        # signal message can be sent
-        m.ready_to_send = True
-        m.save()
 
         return m
 
+    def create_messages(self, email_messages):
+        """
+        Add the email messages to the ``impression.models.Message`` model in bulk. The
+        services and email addresses are resolved once, and then the messages of each
+        service are checked, counted against the rate limit and inserted (along with
+        their extra email addresses) together, all in a single transaction.
+
+        If ``fail_silently`` is set, skip invalid messages and the messages of each
+        service which would go over its rate limit (creating as many as still fit),
+        otherwise raise the error, and nothing is created.
+
+        Return the list of created messages.
+        """
+        email_messages = list(email_messages)
+        targets = [self.get_service_name(e) for e in email_messages]
+        services = Service.objects.select_related("rate_limit").in_bulk(
+            {name for name, _ in targets}, field_name="name"
+        )
+        emails = EmailAddress.bulk_get_or_create(
+            e
+            for message, (_, to_emails) in zip(email_messages, targets)
+            for r in ([message.from_email], to_emails, message.cc, message.bcc)
+            for e in r or []
+        )
+
+        # build messages, grouped by service
+        pending = defaultdict(list)
+        for message, (service_name, to_emails) in zip(email_messages, targets):
+            try:
+                service = services.get(service_name)
+                if service is None:
+                    raise Service.DoesNotExist(
+                        "Service {} does not exist.".format(service_name)
+                    )
+                m = Message(
+                    service=service,
+                    override_from_email_address=emails.get(message.from_email),
+                    subject=message.subject,
+                    body=service.extract_body(message.body),
+                )
+            except (Service.DoesNotExist, ImpressionMessageException, JSONBodyRequired):
+                if self.fail_silently:
+                    continue
+                raise
+            recipients = [to_emails or [], message.cc or [], message.bcc or []]
+            pending[service].append(
+                (m, [[emails[e] for e in r if e in emails] for r in recipients])
+            )
+
+        # reserve rate limits and insert messages, per service
+        created = []
+        with transaction.atomic():
+            for service, entries in pending.items():
+                if service.rate_limit:
+                    granted = service.rate_limit.reserve_up_to(service, len(entries))
+                    if granted < len(entries) and not self.fail_silently:
+                        raise RateLimitException()
+                    entries = entries[:granted]
+                created.extend(
+                    Message.objects.bulk_create_ready(
+                        [m for m, _ in entries], [r for _, r in entries]
+                    )
+                )
+        return created
+
     def send_messages(self, email_messages):
         """
-        Call ``send_message()`` for each email message, and return the number which were
-        successfully processed.
+        Add the email messages in bulk with ``create_messages()``, then send them (if
+        ``send_now``), and return the number which were successfully processed.
         """
-        successful = []
-        for e in email_messages:
-            m = self.send_message(e)
-            if m:
-                successful.append(m)
-        return len(successful)
+        messages = self.create_messages(email_messages)
+        if self.send_now:
+            for m in messages:
+                m.send()
+        return len(messages)
+
+
+class QueuedEmailBackend(LocalEmailBackend):
+    """
+    Like ``LocalEmailBackend``, but messages are only queued, so ``send_mail()`` returns
+    without waiting for the real email backend, and the ``impression_send_emails``
+    command sends them.
+    """
+
+    send_now = False
@@ -0,0 +1,64 @@
+"""
+This module caches the configuration which the API needs for every request, so the
+intake path does not have to query for it each time:
+
+ 1. Services (with their rate limits and allowed groups) are cached by name for
+    ``IMPRESSION_SERVICE_CACHE_TIMEOUT`` seconds in the ``IMPRESSION_CACHE`` cache, and
+    invalidated by signals (see ``impression.signals``) when they change.
+ 2. The group IDs of a user are memoized on the user object, which lives for a single
+    request.
+"""
+
+from django.apps import apps
+from django.core.cache import caches
+
+from .settings import get_setting
+
+
+def get_cache():
+    return caches[get_setting("IMPRESSION_CACHE")]
+
+
+def get_service_cache_key(name):
+    return "impression:service:{}".format(name)
+
+
+def get_service(name):
+    """
+    Return the service with the given name, along with its rate limit and allowed group
+    IDs, from the cache if possible. Raise ``Service.DoesNotExist`` if there is no such
+    service.
+    """
+    # use get_model because models import this module - avoid cyclic imports
+    service_model = apps.get_model("impression", "Service")
+    cache = get_cache()
+    key = get_service_cache_key(name)
+    service = cache.get(key)
+    if service is None:
+        service = service_model.objects.select_related("rate_limit").get(name=name)
+        service.get_allowed_group_ids()
+        cache.set(key, service, get_setting("IMPRESSION_SERVICE_CACHE_TIMEOUT"))
+    return service
+
+
+def invalidate_services(*names):
+    """
+    Remove the services with the given names from the cache.
+    """
+    get_cache().delete_many([get_service_cache_key(n) for n in names])
+
+
+def get_user_group_ids(user):
+    """
+    Return the set of IDs of the user's groups, memoized on the user object.
+    """
+    if not hasattr(user, "_impression_group_ids"):
+        user._impression_group_ids = set(user.groups.values_list("pk", flat=True))
+    return user._impression_group_ids
+
+
+def invalidate_user_group_ids(user):
+    """
+    Forget the memoized group IDs of the user.
+    """
+    user.__dict__.pop("_impression_group_ids", None)
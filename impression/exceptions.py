@@ -4,6 +4,12 @@ class ImpressionMessageException(Exception):
     """
 
 
+class BodyTooLarge(ImpressionMessageException):
+    """
+    The body is larger than the service allows.
+    """
+
+
 class RateLimitException(Exception):
     """
     The rate limit of the service has been reached.
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+
+from ...models import ArchivedMessage, Message, RateLimit
+from ...settings import get_setting
+
+
+class Command(BaseCommand):
+    help = "Move sent messages older than a number of days into the archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=get_setting("IMPRESSION_ARCHIVE_AFTER_DAYS"),
+            help="Archive messages sent more than this many days ago.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of messages to archive in each transaction.",
+        )
+
+    def handle(self, *args, **kwargs):
+        """
+        Messages are archived in batches, each in its own transaction, so the
+        ``Message`` table is never locked for long, and an interrupted run can simply be
+        run again. Messages still inside a rolling window of a rate limit are kept,
+        since the rate limit may count them.
+        """
+        now = timezone.now()
+        cutoff = now - timezone.timedelta(days=kwargs["days"])
+        window = RateLimit.objects.filter(type=RateLimit.ROLLING_WINDOW).aggregate(
+            Max("rolling_window")
+        )["rolling_window__max"]
+        if window and now - window < cutoff:
+            cutoff = now - window
+
+        total = 0
+        messages = Message.objects.filter(sent__lt=cutoff)
+        for count in ArchivedMessage.objects.archive_messages(
+            messages, kwargs["batch_size"]
+        ):
+            total += count
+            if kwargs["verbosity"] > 1:
+                self.stdout.write("Archived {} messages...".format(total))
+        self.stdout.write("Archived {} messages.".format(total))
@@ -0,0 +1,151 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from ...models import ArchivedMessage, BodyBlob, IdempotencyKey, Message, RateLimit
+from ...settings import get_setting
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete messages (and archived messages) created more than a number of days"
+        " ago, except messages still queued to send, and expired rate limit counters"
+        " and idempotency keys."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=get_setting("IMPRESSION_PURGE_AFTER_DAYS"),
+            help="Delete messages created more than this many days ago.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="The size of the primary key range to delete in each transaction.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="The number of seconds to sleep between chunks.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many messages would be deleted.",
+        )
+
+    def handle(self, *args, **kwargs):
+        """
+        Rather than deleting everything in one statement (which cascades through the
+        M2M tables and holds locks for as long as it takes), step through the primary
+        keys in ranges of ``--chunk-size``, deleting each range in its own short
+        transaction and sleeping in between, so other queries can get in.
+        """
+        self.options = kwargs
+        cutoff = timezone.now() - timezone.timedelta(days=kwargs["days"])
+        messages = Message.objects.filter(created__lt=cutoff).exclude(
+            Message.ready_query
+        )
+        archived_messages = ArchivedMessage.objects.filter(created__lt=cutoff)
+        self.purge(messages, "messages")
+        self.purge(archived_messages, "archived messages")
+        self.purge_blobs([messages, archived_messages])
+        self.purge_counters()
+        self.purge_idempotency_keys()
+
+    def purge(self, queryset, name):
+        """
+        Delete the queryset in chunks of primary key ranges, and report the rate.
+        """
+        if self.options["dry_run"]:
+            self.stdout.write("Would delete {} {}.".format(queryset.count(), name))
+            return
+
+        bounds = queryset.aggregate(low=Min("pk"), high=Max("pk"))
+        if bounds["low"] is None:
+            self.stdout.write("Deleted 0 {}.".format(name))
+            return
+        deleted = rows = 0
+        start = time.monotonic()
+        for low in range(bounds["low"], bounds["high"] + 1, self.options["chunk_size"]):
+            chunk = queryset.filter(
+                pk__gte=low, pk__lt=low + self.options["chunk_size"]
+            ).only("pk")
+            with transaction.atomic():
+                count, counts = chunk.delete()
+            deleted += counts.get(queryset.model._meta.label, 0)
+            rows += count
+            if self.options["verbosity"] > 1:
+                self.stdout.write("Deleted {} {}...".format(deleted, name))
+            if count and self.options["sleep"]:
+                time.sleep(self.options["sleep"])
+        self.report(name, deleted, rows, time.monotonic() - start)
+
+    def purge_blobs(self, deleting):
+        """
+        Delete the final bodies which are no longer referenced, in chunks. On a dry run,
+        count the bodies which would be freed by deleting the messages too.
+        """
+        if self.options["dry_run"]:
+            blobs = BodyBlob.objects.past_grace_period().unreferenced(deleting)
+            self.stdout.write("Would delete {} bodies.".format(blobs.count()))
+            return
+
+        deleted = 0
+        start = time.monotonic()
+        while True:
+            hashes = list(
+                BodyBlob.objects.past_grace_period()
+                .unreferenced()
+                .values_list("pk", flat=True)[: self.options["chunk_size"]]
+            )
+            if not hashes:
+                break
+            deleted += BodyBlob.objects.filter(pk__in=hashes).delete_unreferenced()
+            if self.options["sleep"]:
+                time.sleep(self.options["sleep"])
+        self.report("bodies", deleted, deleted, time.monotonic() - start)
+
+    def purge_counters(self):
+        """
+        Delete the rate limit counters for buckets which have left their time frames.
+        """
+        counters = [r.get_expired_counters() for r in RateLimit.objects.all()]
+        if self.options["dry_run"]:
+            self.stdout.write(
+                "Would delete {} rate limit counters.".format(
+                    sum(c.count() for c in counters)
+                )
+            )
+            return
+
+        start = time.monotonic()
+        deleted = sum(c.delete()[0] for c in counters)
+        self.report("rate limit counters", deleted, deleted, time.monotonic() - start)
+
+    def purge_idempotency_keys(self):
+        """
+        Delete the idempotency keys which have expired.
+        """
+        keys = IdempotencyKey.expired()
+        if self.options["dry_run"]:
+            self.stdout.write("Would delete {} idempotency keys.".format(keys.count()))
+            return
+
+        start = time.monotonic()
+        deleted = keys.delete()[0]
+        self.report("idempotency keys", deleted, deleted, time.monotonic() - start)
+
+    def report(self, name, deleted, rows, elapsed):
+        self.stdout.write(
+            "Deleted {} {} ({} rows in total) in {:.1f}s ({:.0f} rows/s).".format(
+                deleted, name, rows, elapsed, rows / elapsed if elapsed else rows
+            )
+        )
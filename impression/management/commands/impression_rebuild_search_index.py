@@ -0,0 +1,45 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from ... import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index of messages and templates."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of objects to index in each transaction.",
+        )
+
+    def handle(self, *args, **kwargs):
+        """
+        Objects are indexed in primary key order, a batch at a time, so this can be run
+        while the index is in use (e.g., after enabling ``IMPRESSION_FULL_TEXT_SEARCH``
+        on an existing database).
+        """
+        if not search.get_search_backend(DEFAULT_DB_ALIAS):
+            raise CommandError(
+                "Full-text search is disabled or not supported by the database."
+            )
+
+        for label in search.SEARCH_MODELS:
+            model = apps.get_model(label)
+            pks = model._default_manager.order_by("pk").values_list("pk", flat=True)
+            name = model._meta.verbose_name_plural
+            total = last_pk = 0
+            while True:
+                batch = list(pks.filter(pk__gt=last_pk)[: kwargs["batch_size"]])
+                if not batch:
+                    break
+                last_pk = batch[-1]
+                with transaction.atomic():
+                    search.update_index(model, batch, DEFAULT_DB_ALIAS)
+                total += len(batch)
+                if kwargs["verbosity"] > 1:
+                    self.stdout.write("Indexed {} {}...".format(total, name))
+            self.stdout.write("Indexed {} {}.".format(total, name))
@@ -20,7 +20,9 @@ class Command(BaseCommand):
         then send if it still meets the requirements.
         """
         q = Message.ready_query
-        message_ids = Message.objects.filter(q).values_list("pk", flat=True)
+        message_ids = (
+            Message.objects.filter(q).order_by("created").values_list("pk", flat=True)
+        )
         for message_id in message_ids:
             message_q = Message.objects.filter(pk=message_id)
             with transaction.atomic():
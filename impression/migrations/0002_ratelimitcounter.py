@@ -0,0 +1,213 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:05
+
+import datetime
+from collections import Counter
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+CHUNK_SIZE = 2000
+
+
+def get_timeframe_start(rate_limit, now):
+    """
+    Return the start of the rate limit's time frame at ``now``, as of this migration.
+    """
+    if rate_limit.type == "rolling_window":
+        return now - rate_limit.rolling_window
+    then = now.replace(microsecond=0, second=0, minute=0)
+    if rate_limit.block_period == "hour":
+        return then
+    then = then.replace(hour=0)
+    if rate_limit.block_period == "day":
+        return then
+    if rate_limit.block_period == "week":
+        return then - timezone.timedelta(days=then.isoweekday() % 7)
+    return then.replace(day=1)
+
+
+def get_bucket(rate_limit, dt):
+    """
+    Return the start of the counter bucket that ``dt`` falls into, as of this
+    migration.
+    """
+    if rate_limit.type == "rolling_window":
+        buckets = getattr(settings, "IMPRESSION_RATE_LIMIT_BUCKETS", 60) or 1
+        width = max(int(rate_limit.rolling_window.total_seconds()) // buckets, 1)
+        ts = int(dt.timestamp())
+        return datetime.datetime.fromtimestamp(ts - ts % width, tz=dt.tzinfo)
+    return get_timeframe_start(rate_limit, dt)
+
+
+def get_user_type_id(apps, db_alias):
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    return (
+        ContentType.objects.using(db_alias)
+        .filter(app_label=User._meta.app_label, model=User._meta.model_name)
+        .values_list("pk", flat=True)
+        .first()
+    )
+
+
+def get_group_ids(apps, db_alias, user_ids):
+    """
+    Return a dict mapping the IDs of the users to the IDs of their groups.
+    """
+    groups_field = apps.get_model(settings.AUTH_USER_MODEL)._meta.get_field("groups")
+    user_field = groups_field.m2m_field_name()
+    group_field = groups_field.m2m_reverse_field_name()
+    memberships = groups_field.remote_field.through.objects.using(db_alias).filter(
+        **{"{}__in".format(user_field): user_ids}
+    )
+    group_ids = {}
+    for user_id, group_id in memberships.values_list(user_field, group_field):
+        group_ids.setdefault(user_id, []).append(group_id)
+    return group_ids
+
+
+def get_counter_keys(grouping, user_type_id, user_id, memberships):
+    """
+    Return the counter keys which a message by the user counts against, where
+    ``memberships`` is a tuple in the form (user_type_id, group_ids_by_user_id).
+    """
+    if grouping == "total":
+        return ["total"]
+    if grouping == "per_user" and user_type_id:
+        return ["user:{}:{}".format(user_type_id, user_id)]
+    group_user_type_id, group_ids = memberships
+    if grouping == "per_group" and user_type_id == group_user_type_id:
+        return ["group:{}".format(g) for g in group_ids.get(user_id, [])]
+    return []
+
+
+def iter_chunks(messages):
+    """
+    Yield the messages as lists of tuples in the form (created, user_type_id,
+    user_id), reading ``CHUNK_SIZE`` at a time.
+    """
+    messages = messages.order_by("pk")
+    last_pk = 0
+    while True:
+        chunk = list(
+            messages.filter(pk__gt=last_pk).values_list(
+                "pk", "created", "user_type_id", "user_id"
+            )[:CHUNK_SIZE]
+        )
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        yield [row[1:] for row in chunk]
+
+
+def count_messages(apps, db_alias, messages, rate_limit, now):
+    """
+    Count the messages of the rate limit's current time frame by counter key and
+    bucket.
+    """
+    user_type_id = get_user_type_id(apps, db_alias)
+    counts = Counter()
+    messages = messages.filter(
+        created__gte=get_bucket(rate_limit, get_timeframe_start(rate_limit, now)),
+        created__lte=now,
+    )
+    for chunk in iter_chunks(messages):
+        group_ids = {}
+        if rate_limit.grouping == "per_group":
+            group_ids = get_group_ids(
+                apps, db_alias, {row[2] for row in chunk if row[1] == user_type_id}
+            )
+        for created, message_user_type_id, user_id in chunk:
+            for key in get_counter_keys(
+                rate_limit.grouping,
+                message_user_type_id,
+                user_id,
+                (user_type_id, group_ids),
+            ):
+                counts[key, get_bucket(rate_limit, created)] += 1
+    return counts
+
+
+def seed_counters(apps, schema_editor):
+    """
+    Seed the counters with the messages in the current time frame of each rate limit,
+    so existing rate limits don't start over from zero.
+    """
+    db_alias = schema_editor.connection.alias
+    Service = apps.get_model("impression", "Service")
+    Message = apps.get_model("impression", "Message")
+    RateLimitCounter = apps.get_model("impression", "RateLimitCounter")
+
+    now = timezone.now()
+    services = Service.objects.using(db_alias).select_related("rate_limit")
+    for service in services.filter(rate_limit__isnull=False):
+        counts = count_messages(
+            apps,
+            db_alias,
+            Message.objects.using(db_alias).filter(service=service),
+            service.rate_limit,
+            now,
+        )
+        RateLimitCounter.objects.using(db_alias).bulk_create(
+            [
+                RateLimitCounter(
+                    rate_limit=service.rate_limit,
+                    service=service,
+                    key=key,
+                    bucket=bucket,
+                    count=count,
+                )
+                for (key, bucket), count in counts.items()
+            ],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("impression", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RateLimitCounter",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=255)),
+                ("bucket", models.DateTimeField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "rate_limit",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="counters",
+                        to="impression.ratelimit",
+                    ),
+                ),
+                (
+                    "service",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="rate_limit_counters",
+                        to="impression.service",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("rate_limit", "service", "key", "bucket")},
+            },
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
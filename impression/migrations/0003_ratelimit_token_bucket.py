@@ -0,0 +1,81 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:08
+
+import datetime
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0002_ratelimitcounter"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ratelimit",
+            name="burst",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="For a token bucket, the maximum number of messages which can be sent at once. If blank, the quantity is used.",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="ratelimit",
+            name="rolling_window",
+            field=models.DurationField(
+                default=datetime.timedelta(seconds=3600),
+                help_text="[DD] HH:MM:SS; for a token bucket, the quantity is refilled evenly over this window.",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="ratelimit",
+            name="type",
+            field=models.CharField(
+                choices=[
+                    ("block_period", "Block Period"),
+                    ("rolling_window", "Rolling Window"),
+                    ("token_bucket", "Token Bucket"),
+                ],
+                default="block_period",
+                max_length=255,
+            ),
+        ),
+        migrations.CreateModel(
+            name="RateLimitTokenBucket",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=255)),
+                ("tokens", models.FloatField()),
+                ("last_refill", models.DateTimeField()),
+                (
+                    "rate_limit",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="token_buckets",
+                        to="impression.ratelimit",
+                    ),
+                ),
+                (
+                    "service",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="rate_limit_token_buckets",
+                        to="impression.service",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("rate_limit", "service", "key")},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("impression", "0003_ratelimit_token_bucket"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["service", "created"], name="impression_msg_svc_created"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["service", "user_type", "user_id", "created"],
+                name="impression_msg_svc_user",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["sent"], name="impression_msg_sent"),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                condition=models.Q(("ready_to_send", True), ("sent__isnull", True)),
+                fields=["sent", "created"],
+                name="impression_msg_ready",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0004_message_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("impression", "0005_message_attempts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdempotencyKey",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("user_id", models.PositiveIntegerField(verbose_name="User ID")),
+                ("key", models.CharField(max_length=255)),
+                (
+                    "status_code",
+                    models.PositiveSmallIntegerField(
+                        blank=True,
+                        help_text="The response status, or empty while the request is in progress.",
+                        null=True,
+                    ),
+                ),
+                ("response_data", models.TextField(blank=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "message",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="idempotency_keys",
+                        to="impression.message",
+                    ),
+                ),
+                (
+                    "user_type",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="contenttypes.contenttype",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user_type", "user_id", "key")},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0006_idempotencykey"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="service",
+            name="max_body_size",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="The maximum size of message bodies, in bytes. If blank, the 'IMPRESSION_MAX_BODY_SIZE' setting will be used.",
+                null=True,
+            ),
+        ),
+    ]
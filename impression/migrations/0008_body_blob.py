@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0007_service_max_body_size"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BodyBlob",
+            fields=[
+                (
+                    "hash",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.BinaryField()),
+                (
+                    "size",
+                    models.PositiveIntegerField(
+                        help_text="The uncompressed size, in bytes."
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="final_body_html_blob",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="message_final_html_set",
+                to="impression.bodyblob",
+                verbose_name="Body (HTML, final)",
+            ),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="final_body_plaintext_blob",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="message_final_plaintext_set",
+                to="impression.bodyblob",
+                verbose_name="Body (plaintext, final)",
+            ),
+        ),
+    ]
@@ -0,0 +1,89 @@
+import hashlib
+import zlib
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+KINDS = ("plaintext", "html")
+
+
+def make_blob(BodyBlob, text):
+    encoded = text.encode()
+    return BodyBlob(
+        hash=hashlib.sha256(encoded).hexdigest(),
+        data=zlib.compress(encoded),
+        size=len(encoded),
+    )
+
+
+def forwards(apps, schema_editor):
+    """
+    Move the final bodies of sent messages into (deduplicated) blobs, a batch at a time.
+    """
+    Message = apps.get_model("impression", "Message")
+    BodyBlob = apps.get_model("impression", "BodyBlob")
+    db_alias = schema_editor.connection.alias
+    messages = (
+        Message.objects.using(db_alias)
+        .exclude(final_body_plaintext="", final_body_html="")
+        .only("pk", *("final_body_{}".format(kind) for kind in KINDS))
+        .order_by("pk")
+    )
+    last_pk = 0
+    while True:
+        batch = list(messages.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        blobs = {}
+        for message in batch:
+            for kind in KINDS:
+                text = getattr(message, "final_body_{}".format(kind))
+                blob = make_blob(BodyBlob, text) if text else None
+                if blob:
+                    blobs[blob.hash] = blob
+                setattr(
+                    message, "final_body_{}_blob_id".format(kind), blob and blob.hash
+                )
+        BodyBlob.objects.using(db_alias).bulk_create(
+            blobs.values(), ignore_conflicts=True
+        )
+        Message.objects.using(db_alias).bulk_update(
+            batch, ["final_body_{}_blob".format(kind) for kind in KINDS]
+        )
+
+
+def backwards(apps, schema_editor):
+    Message = apps.get_model("impression", "Message")
+    db_alias = schema_editor.connection.alias
+    messages = (
+        Message.objects.using(db_alias)
+        .select_related(*("final_body_{}_blob".format(kind) for kind in KINDS))
+        .order_by("pk")
+    )
+    last_pk = 0
+    while True:
+        batch = list(messages.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        for message in batch:
+            for kind in KINDS:
+                blob = getattr(message, "final_body_{}_blob".format(kind))
+                setattr(
+                    message,
+                    "final_body_{}".format(kind),
+                    zlib.decompress(blob.data).decode() if blob else "",
+                )
+        Message.objects.using(db_alias).bulk_update(
+            batch, ["final_body_{}".format(kind) for kind in KINDS]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0008_body_blob"),
+    ]
+
+    operations = [migrations.RunPython(forwards, backwards)]
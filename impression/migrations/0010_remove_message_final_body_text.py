@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0009_move_final_bodies_to_blobs"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="message",
+            name="final_body_html",
+        ),
+        migrations.RemoveField(
+            model_name="message",
+            name="final_body_plaintext",
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0010_remove_message_final_body_text"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="final_recipients",
+            field=models.TextField(
+                blank=True,
+                editable=False,
+                help_text="The final recipients, if ``IMPRESSION_PACK_FINAL_RECIPIENTS`` is enabled, as EmailAddress IDs prefixed by kind, e.g. ',t1,t5,c3,b7,'.",
+                verbose_name="Recipients (final, packed)",
+            ),
+        ),
+    ]
@@ -0,0 +1,119 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("impression", "0011_message_final_recipients"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedMessage",
+            fields=[
+                ("id", models.IntegerField(primary_key=True, serialize=False)),
+                (
+                    "user_id",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="User ID"
+                    ),
+                ),
+                ("subject", models.CharField(blank=True, max_length=255)),
+                ("body", models.TextField(blank=True)),
+                (
+                    "extra_recipients",
+                    models.TextField(
+                        blank=True, verbose_name="Extra recipients (packed)"
+                    ),
+                ),
+                ("created", models.DateTimeField()),
+                ("updated", models.DateTimeField()),
+                ("sent", models.DateTimeField()),
+                ("last_attempt", models.DateTimeField(blank=True, null=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                (
+                    "final_subject",
+                    models.TextField(blank=True, verbose_name="Subject (final)"),
+                ),
+                (
+                    "final_recipients",
+                    models.TextField(
+                        blank=True, verbose_name="Recipients (final, packed)"
+                    ),
+                ),
+                ("archived", models.DateTimeField(auto_now_add=True)),
+                (
+                    "final_body_html_blob",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="archived_message_final_html_set",
+                        to="impression.bodyblob",
+                        verbose_name="Body (HTML, final)",
+                    ),
+                ),
+                (
+                    "final_body_plaintext_blob",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="archived_message_final_plaintext_set",
+                        to="impression.bodyblob",
+                        verbose_name="Body (plaintext, final)",
+                    ),
+                ),
+                (
+                    "final_from_email_address",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="archived_message_final_from_set",
+                        to="impression.emailaddress",
+                        verbose_name="From (final)",
+                    ),
+                ),
+                (
+                    "override_from_email_address",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="archived_message_override_from_set",
+                        to="impression.emailaddress",
+                        verbose_name="From (Override)",
+                    ),
+                ),
+                (
+                    "service",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="archived_messages",
+                        to="impression.service",
+                    ),
+                ),
+                (
+                    "user_type",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="contenttypes.contenttype",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["sent"], name="impression_archmsg_sent")
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("impression", "0012_archivedmessage"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["created"], name="impression_msg_created"),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations
+
+TABLES = ("impression_message_search", "impression_template_search")
+
+
+def create_search_tables(apps, schema_editor):
+    """
+    Create the full-text search tables used by ``impression.search``, on the databases
+    which support it.
+    """
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                return
+        for table in TABLES:
+            schema_editor.execute(
+                "CREATE VIRTUAL TABLE {} USING fts5(document)".format(
+                    schema_editor.quote_name(table)
+                )
+            )
+    elif connection.vendor == "postgresql":
+        for table in TABLES:
+            schema_editor.execute(
+                "CREATE TABLE {} (object_id integer PRIMARY KEY, document tsvector "
+                "NOT NULL)".format(schema_editor.quote_name(table))
+            )
+            schema_editor.execute(
+                "CREATE INDEX {} ON {} USING GIN (document)".format(
+                    schema_editor.quote_name("{}_gin".format(table)),
+                    schema_editor.quote_name(table),
+                )
+            )
+
+
+def drop_search_tables(apps, schema_editor):
+    if schema_editor.connection.vendor in ("sqlite", "postgresql"):
+        for table in TABLES:
+            schema_editor.execute(
+                "DROP TABLE IF EXISTS {}".format(schema_editor.quote_name(table))
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0013_message_created_index"),
+    ]
+
+    operations = [migrations.RunPython(create_search_tables, drop_search_tables)]
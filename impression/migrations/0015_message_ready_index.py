@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("impression", "0014_search_index"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="message",
+            name="impression_msg_ready",
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                condition=models.Q(("ready_to_send", True), ("sent__isnull", True)),
+                fields=["created"],
+                name="impression_msg_ready",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0015_message_ready_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ratelimit",
+            name="counter_config",
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
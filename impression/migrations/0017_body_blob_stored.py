@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:27
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("impression", "0016_ratelimit_counter_config"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="bodyblob",
+            name="stored",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now,
+                help_text="When the blob was last stored, for a message being created.",
+            ),
+        ),
+    ]
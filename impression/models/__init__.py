@@ -1,6 +1,9 @@
 from .email_address import *
+from .body_blob import *
 from .template import *
 from .distribution import *
 from .rate_limit import *
 from .service import *
 from .message import *
+from .archived_message import *
+from .idempotency_key import *
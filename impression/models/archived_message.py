@@ -0,0 +1,197 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.utils.translation import gettext_lazy as _
+
+from .message import Message
+
+
+class ArchivedMessageQuerySet(models.QuerySet):
+    def archive_messages(self, messages, batch_size=1000):
+        """
+        Move the messages (a ``Message`` queryset) into the archive in batches, each in
+        its own transaction: the messages are copied, with their extra and final email
+        addresses packed (see ``Message.pack_recipient_ids``), and then deleted, along
+        with their M2M rows. If a message is already in the archive, the insert fails
+        and its batch is rolled back, so no message is deleted without its copy.
+
+        Yield the number of messages archived in each batch.
+        """
+        messages = messages.order_by("pk")
+        while True:
+            with transaction.atomic(using=self.db):
+                batch = list(messages[:batch_size])
+                if not batch:
+                    return
+                pks = [m.pk for m in batch]
+                extra = self._get_recipient_ids(pks, "extra")
+                final = self._get_recipient_ids(pks, "final")
+                self.bulk_create(
+                    [
+                        self.model.from_message(
+                            m,
+                            Message.pack_recipient_ids(*extra[m.pk]),
+                            m.final_recipients
+                            or Message.pack_recipient_ids(*final[m.pk]),
+                        )
+                        for m in batch
+                    ]
+                )
+                Message.objects.using(self.db).filter(pk__in=pks).delete()
+            yield len(batch)
+
+    def _get_recipient_ids(self, pks, prefix):
+        """
+        Return a dict mapping each message ID to a tuple of lists of EmailAddress IDs
+        from the M2M tables with the prefix, in the form (to, cc, bcc).
+        """
+        recipients = {pk: ([], [], []) for pk in pks}
+        for i, kind in enumerate(("to", "cc", "bcc")):
+            field = Message._meta.get_field(
+                "{}_{}_email_addresses".format(prefix, kind)
+            )
+            rows = (
+                field.remote_field.through.objects.using(self.db)
+                .filter(**{"{}__in".format(field.m2m_field_name()): pks})
+                .values_list(field.m2m_field_name(), field.m2m_reverse_field_name())
+            )
+            for message_id, email_id in rows:
+                recipients[message_id][i].append(email_id)
+        return recipients
+
+
+class ArchivedMessage(models.Model):
+    """
+    A sent message which was moved out of the ``Message`` table by the
+    ``impression_archive_messages`` command, keeping its original ID. The extra and
+    final email addresses are packed into a column each (see
+    ``Message.pack_recipient_ids``).
+    """
+
+    id = models.IntegerField(primary_key=True)
+    service = models.ForeignKey(
+        "impression.Service",
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="archived_messages",
+    )
+    user_type = models.ForeignKey(
+        ContentType, blank=True, null=True, on_delete=models.SET_NULL
+    )
+    user_id = models.PositiveIntegerField(_("User ID"), blank=True, null=True)
+    user = GenericForeignKey("user_type", "user_id")
+    subject = models.CharField(max_length=255, blank=True)
+    body = models.TextField(blank=True)
+    override_from_email_address = models.ForeignKey(
+        "impression.EmailAddress",
+        blank=True,
+        null=True,
+        related_name="archived_message_override_from_set",
+        verbose_name=_("From (Override)"),
+        on_delete=models.SET_NULL,
+    )
+    extra_recipients = models.TextField(_("Extra recipients (packed)"), blank=True)
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+    sent = models.DateTimeField()
+    last_attempt = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    final_subject = models.TextField(_("Subject (final)"), blank=True)
+    final_body_plaintext_blob = models.ForeignKey(
+        "impression.BodyBlob",
+        blank=True,
+        null=True,
+        related_name="archived_message_final_plaintext_set",
+        verbose_name=_("Body (plaintext, final)"),
+        on_delete=models.PROTECT,
+    )
+    final_body_html_blob = models.ForeignKey(
+        "impression.BodyBlob",
+        blank=True,
+        null=True,
+        related_name="archived_message_final_html_set",
+        verbose_name=_("Body (HTML, final)"),
+        on_delete=models.PROTECT,
+    )
+    final_from_email_address = models.ForeignKey(
+        "impression.EmailAddress",
+        blank=True,
+        null=True,
+        related_name="archived_message_final_from_set",
+        verbose_name=_("From (final)"),
+        on_delete=models.SET_NULL,
+    )
+    final_recipients = models.TextField(_("Recipients (final, packed)"), blank=True)
+    archived = models.DateTimeField(auto_now_add=True)
+
+    objects = ArchivedMessageQuerySet.as_manager()
+
+    # the fields which are copied from the message as they are
+    copied_fields = (
+        "id",
+        "service_id",
+        "user_type_id",
+        "user_id",
+        "subject",
+        "body",
+        "override_from_email_address_id",
+        "created",
+        "updated",
+        "sent",
+        "last_attempt",
+        "attempts",
+        "final_subject",
+        "final_body_plaintext_blob_id",
+        "final_body_html_blob_id",
+        "final_from_email_address_id",
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=["sent"], name="impression_archmsg_sent")]
+
+    def __str__(self):
+        return str(self.id)
+
+    @classmethod
+    def from_message(cls, message, extra_recipients, final_recipients):
+        """
+        Build (without saving) the archived copy of the message, given its packed extra
+        and final recipients.
+        """
+        return cls(
+            extra_recipients=extra_recipients,
+            final_recipients=final_recipients,
+            **{f: getattr(message, f) for f in cls.copied_fields}
+        )
+
+    def get_user_display(self):
+        if not self.user:
+            return ""
+        return "{} ({}, {})".format(self.user, self.user_type, self.user_id)
+
+    def get_extra_recipients(self):
+        """
+        Return the extra email addresses in the form (to, cc, bcc).
+        """
+        return Message.unpack_recipients(self.extra_recipients)
+
+    def get_final_recipients(self):
+        """
+        Return the final recipients in the form (to, cc, bcc).
+        """
+        return Message.unpack_recipients(self.final_recipients)
+
+    def _get_final_body_plaintext(self):
+        blob = self.final_body_plaintext_blob
+        return blob.get_text() if blob else ""
+
+    _get_final_body_plaintext.short_description = _("Body (plaintext, final)")
+    final_body_plaintext = property(_get_final_body_plaintext)
+
+    def _get_final_body_html(self):
+        blob = self.final_body_html_blob
+        return blob.get_text() if blob else ""
+
+    _get_final_body_html.short_description = _("Body (HTML, final)")
+    final_body_html = property(_get_final_body_html)
@@ -0,0 +1,107 @@
+import hashlib
+import zlib
+
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from ..settings import get_setting
+
+
+def get_grace_period():
+    return timezone.timedelta(seconds=get_setting("IMPRESSION_BODY_GRACE_PERIOD"))
+
+
+class BodyBlobQuerySet(models.QuerySet):
+    def past_grace_period(self):
+        """
+        Return the blobs which haven't been stored in the last
+        ``IMPRESSION_BODY_GRACE_PERIOD`` seconds, so a message which is being created
+        with one of them has had the time to reference it.
+        """
+        return self.filter(stored__lt=timezone.now() - get_grace_period())
+
+    def unreferenced(self, deleting=()):
+        """
+        Return the blobs which are no longer the final body of any message (including
+        archived messages), ignoring references from the querysets of messages in
+        ``deleting``, which are about to be deleted.
+        """
+        q = models.Q()
+        for rel in self.model._meta.related_objects:
+            refs = rel.related_model._base_manager.filter(
+                **{rel.field.name: models.OuterRef("pk")}
+            )
+            for queryset in deleting:
+                if queryset.model is rel.related_model:
+                    refs = refs.exclude(pk__in=queryset.values("pk"))
+            q &= ~models.Exists(refs)
+        return self.filter(q)
+
+    def delete_unreferenced(self):
+        """
+        Delete the blobs which are unreferenced and past the grace period, checking both
+        in the DELETE statement itself (rather than selecting the blobs first), so a
+        blob which a message starts to reference (or which is stored again) in the
+        meantime is kept. Return the number of blobs deleted.
+        """
+        # the references are PROTECTed, so there is nothing for the collector to do
+        return self.past_grace_period().unreferenced()._raw_delete(self.db)
+
+
+class BodyBlob(models.Model):
+    """
+    A rendered message body, compressed with zlib and keyed by the SHA-256 hash of its
+    content, so identical bodies (e.g., a message sent to many recipients) are only
+    stored once.
+    """
+
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField(help_text=_("The uncompressed size, in bytes."))
+    stored = models.DateTimeField(
+        default=timezone.now,
+        help_text=_("When the blob was last stored, for a message being created."),
+    )
+
+    objects = BodyBlobQuerySet.as_manager()
+
+    def __str__(self):
+        return self.hash
+
+    @staticmethod
+    def get_hash(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @classmethod
+    def store(cls, text):
+        """
+        Return the blob for the text, inserting it unless an identical blob is already
+        stored.
+
+        An identical blob may be about to be purged as unreferenced, so unless it was
+        stored recently (within half the grace period), its ``stored`` time is bumped
+        first. The UPDATE locks the row, so a concurrent purge either deletes it before
+        (and the blob is inserted again) or sees the new time and keeps it.
+        """
+        encoded = text.encode()
+        blob = cls(
+            hash=hashlib.sha256(encoded).hexdigest(),
+            data=zlib.compress(encoded),
+            size=len(encoded),
+        )
+        bumped = cls.objects.filter(
+            hash=blob.hash, stored__lt=blob.stored - get_grace_period() / 2
+        ).update(stored=blob.stored)
+        if not bumped:
+            cls.objects.bulk_create([blob], ignore_conflicts=True)
+        blob._text = text
+        return blob
+
+    def get_text(self):
+        """
+        Return the decompressed text, which is cached on the instance.
+        """
+        if not hasattr(self, "_text"):
+            self._text = zlib.decompress(self.data).decode()
+        return self._text
@@ -89,6 +89,42 @@ class EmailAddress(models.Model):
             email.save()
         return email, created
 
+    @classmethod
+    def bulk_get_or_create(cls, email_strings):
+        """
+        Like ``get_or_create``, but for many email strings at once, so existing email
+        objects are fetched and missing ones are created with a few queries in total.
+        Invalid emails are ignored.
+
+        Return a dict mapping each valid email string to its email object.
+        """
+        field = cls._meta.get_field("email_address")
+        emails = {}
+        for email_string in email_strings:
+            if not isinstance(email_string, str):
+                continue
+            email = cls.extract_display_email(email_string)
+            try:
+                field.clean(email, None)
+            except ValidationError:
+                continue
+            emails[email_string] = email
+
+        # fetch existing email objects, then create the missing ones
+        found = cls.objects.in_bulk(set(emails.values()), field_name="email_address")
+        missing = set(emails.values()) - set(found)
+        if missing:
+            unsubscribed = bool(get_setting("IMPRESSION_DEFAULT_UNSUBSCRIBED"))
+            cls.objects.bulk_create(
+                [
+                    cls(email_address=e, unsubscribed_from_all=unsubscribed)
+                    for e in missing
+                ],
+                ignore_conflicts=True,
+            )
+            found.update(cls.objects.in_bulk(missing, field_name="email_address"))
+        return {s: found[e] for s, e in emails.items()}
+
     @staticmethod
     def extract_display_email(email):
         """
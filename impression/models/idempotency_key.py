@@ -0,0 +1,96 @@
+import datetime
+import json
+
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from ..settings import get_setting
+
+
+class IdempotencyKey(models.Model):
+    """
+    Records the result of an API request made with an ``Idempotency-Key`` header, so a
+    retry of the request with the same key can be answered with the original result.
+    Keys are unique per user, and expire after ``IMPRESSION_IDEMPOTENCY_KEY_TTL``
+    seconds.
+    """
+
+    user_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    user_id = models.PositiveIntegerField(_("User ID"))
+    user = GenericForeignKey("user_type", "user_id")
+    key = models.CharField(max_length=255)
+    message = models.ForeignKey(
+        "impression.Message",
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="idempotency_keys",
+    )
+    status_code = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text=_("The response status, or empty while the request is in progress."),
+    )
+    response_data = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("user_type", "user_id", "key")
+
+    def __str__(self):
+        return self.key
+
+    @classmethod
+    def claim(cls, user, key):
+        """
+        Get the user's idempotency key, or create it (in progress) if the user has not
+        used it before. An expired key, or a key whose request has been in progress
+        without creating a message for longer than ``IMPRESSION_IDEMPOTENCY_CLAIM_TIMEOUT``
+        seconds (e.g. because the worker was killed), is claimed again as if it was new.
+        Return a tuple in the form (idempotency_key, created).
+        """
+        idempotency_key, created = cls.objects.get_or_create(
+            user_type=ContentType.objects.get_for_model(user), user_id=user.pk, key=key
+        )
+        if created or not idempotency_key.is_reclaimable():
+            return idempotency_key, created
+
+        # only one of several concurrent retries gets to reclaim the key
+        now = timezone.now()
+        reclaimed = cls.objects.filter(
+            pk=idempotency_key.pk, created=idempotency_key.created
+        ).update(message=None, status_code=None, response_data="", created=now)
+        if not reclaimed:
+            idempotency_key.refresh_from_db()
+            return idempotency_key, False
+        idempotency_key.message = None
+        idempotency_key.status_code = None
+        idempotency_key.response_data = ""
+        idempotency_key.created = now
+        return idempotency_key, True
+
+    @classmethod
+    def expired(cls, now=None):
+        """
+        Return the keys which were created more than ``IMPRESSION_IDEMPOTENCY_KEY_TTL``
+        seconds ago.
+        """
+        ttl = datetime.timedelta(seconds=get_setting("IMPRESSION_IDEMPOTENCY_KEY_TTL"))
+        return cls.objects.filter(created__lt=(now or timezone.now()) - ttl)
+
+    def is_reclaimable(self, now=None):
+        now = now or timezone.now()
+        age = (now - self.created).total_seconds()
+        if age > get_setting("IMPRESSION_IDEMPOTENCY_KEY_TTL"):
+            return True
+        return (
+            self.status_code is None
+            and self.message_id is None
+            and age > get_setting("IMPRESSION_IDEMPOTENCY_CLAIM_TIMEOUT")
+        )
+
+    def get_response_data(self):
+        return json.loads(self.response_data) if self.response_data else None
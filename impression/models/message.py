@@ -1,18 +1,112 @@
-import json
-
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.mail import EmailMultiAlternatives, get_connection
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.template.context import Context
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .body_blob import BodyBlob
 from .email_address import EmailAddress
-from ..exceptions import RateLimitException, JSONBodyRequired
+from .. import codec, search
+from ..exceptions import JSONBodyRequired
 from ..settings import get_setting
 
 
+class MessageQuerySet(models.QuerySet):
+    def _add_recipients(self, messages, recipients):
+        """
+        Insert the extra email addresses of the messages with a single query for each
+        kind. ``recipients`` should be a list of (to, cc, bcc) tuples of EmailAddress
+        objects in the same order as the messages.
+        """
+        for i, kind in enumerate(("to", "cc", "bcc")):
+            field = self.model._meta.get_field("extra_{}_email_addresses".format(kind))
+            through = field.remote_field.through
+            rows = [
+                through(
+                    **{
+                        field.m2m_field_name(): message,
+                        field.m2m_reverse_field_name(): email,
+                    }
+                )
+                for message, emails in zip(messages, recipients)
+                for email in set(emails[i])
+            ]
+            if rows:
+                through.objects.using(self.db).bulk_create(rows)
+
+    def create_ready(
+        self, to=(), cc=(), bcc=(), send_now=True, body_data=None, **kwargs
+    ):
+        """
+        Create a message which is ready to send, along with its extra email addresses
+        (lists of EmailAddress objects), in a single transaction: one insert for the
+        message, which still runs the checks in ``Message.save`` (including the rate
+        limit), and one for each kind of extra email address. Then, if ``send_now`` is
+        True, send the message, otherwise leave it for the ``impression_send_emails``
+        command. If the body is a decoded JSON object, pass it as ``body_data``.
+
+        Return the created message.
+        """
+        message = self.model(ready_to_send=True, **kwargs)
+        if body_data is not None:
+            message.set_body_data(body_data, body=message.body or None)
+        with transaction.atomic(using=self.db):
+            message.save(using=self.db, send_now=False)
+            self._add_recipients([message], [(to, cc, bcc)])
+        if send_now:
+            message.send()
+        return message
+
+    def sent_to(self, email, kinds=("to", "cc", "bcc")):
+        """
+        Filter for messages which were sent to the EmailAddress (as one of the given
+        kinds), whether the final recipients were stored packed or in the M2M tables.
+        """
+        q = models.Q()
+        for kind in kinds:
+            field = self.model._meta.get_field("final_{}_email_addresses".format(kind))
+            through = field.remote_field.through
+            q |= models.Q(
+                final_recipients__contains=self.model.pack_recipients(**{kind: [email]})
+            )
+            q |= models.Q(
+                pk__in=through.objects.filter(
+                    **{field.m2m_reverse_field_name(): email}
+                ).values(field.m2m_field_name())
+            )
+        return self.filter(q)
+
+    def bulk_create_ready(self, messages, recipients=None):
+        """
+        Insert messages which are ready to send, along with their extra email addresses,
+        in a single transaction. Rather than being sent inline, these messages are
+        picked up by the ``impression_send_emails`` command. If provided,
+        ``recipients`` should be a list of (to, cc, bcc) tuples of EmailAddress objects
+        in the same order as the messages.
+
+        The checks in ``Message.save`` (including the rate limit) are skipped, so the
+        caller is responsible for them. On databases which don't return the primary
+        keys of bulk inserts (e.g., MySQL), the messages are inserted one at a time,
+        since the extra email addresses need them. Return the list of created messages.
+        """
+        with transaction.atomic(using=self.db):
+            for message in messages:
+                message.ready_to_send = True
+            if connections[self.db].features.can_return_rows_from_bulk_insert:
+                messages = self.bulk_create(messages)
+            else:
+                for message in messages:
+                    # skip the checks and sending of Message.save
+                    models.Model.save(message, using=self.db)
+            if recipients:
+                self._add_recipients(messages, recipients)
+            # bulk_create doesn't send post_save
+            search.schedule_update(self.model, [m.pk for m in messages], self.db)
+        return messages
+
+
 class Message(models.Model):
     """
     Represents an email message assigned to a service.
@@ -80,14 +174,27 @@ class Message(models.Model):
     ready_to_send = models.BooleanField(default=False)
     sent = models.DateTimeField(blank=True, null=True)
     last_attempt = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0, editable=False)
 
     # meta-data for after the message is sent
     final_subject = models.TextField(_("Subject (final)"), blank=True, editable=False)
-    final_body_plaintext = models.TextField(
-        _("Body (plaintext, final)"), blank=True, editable=False
+    final_body_plaintext_blob = models.ForeignKey(
+        "impression.BodyBlob",
+        blank=True,
+        null=True,
+        related_name="message_final_plaintext_set",
+        verbose_name=_("Body (plaintext, final)"),
+        on_delete=models.PROTECT,
+        editable=False,
     )
-    final_body_html = models.TextField(
-        _("Body (HTML, final)"), blank=True, editable=False
+    final_body_html_blob = models.ForeignKey(
+        "impression.BodyBlob",
+        blank=True,
+        null=True,
+        related_name="message_final_html_set",
+        verbose_name=_("Body (HTML, final)"),
+        on_delete=models.PROTECT,
+        editable=False,
     )
     final_from_email_address = models.ForeignKey(
         "impression.EmailAddress",
@@ -98,6 +205,15 @@ class Message(models.Model):
         on_delete=models.SET_NULL,
         editable=False,
     )
+    final_recipients = models.TextField(
+        _("Recipients (final, packed)"),
+        blank=True,
+        editable=False,
+        help_text=_(
+            "The final recipients, if ``IMPRESSION_PACK_FINAL_RECIPIENTS`` is enabled, "
+            "as EmailAddress IDs prefixed by kind, e.g. ',t1,t5,c3,b7,'."
+        ),
+    )
     final_to_email_addresses = models.ManyToManyField(
         "impression.EmailAddress",
         blank=True,
@@ -120,33 +236,145 @@ class Message(models.Model):
         editable=False,
     )
 
-    ready_query = models.Q(ready_to_send=True, send__isnull=True)
+    objects = MessageQuerySet.as_manager()
+
+    ready_query = models.Q(ready_to_send=True, sent__isnull=True)
+
+    # the related objects which get_search_document uses, fetched for all the messages
+    # being indexed at once by impression.search.update_index
+    search_select_related = (
+        "override_from_email_address",
+        "final_from_email_address",
+        "final_body_plaintext_blob",
+    )
+    search_prefetch_related = tuple(
+        "{}_{}_email_addresses".format(prefix, kind)
+        for prefix in ("extra", "final")
+        for kind in ("to", "cc", "bcc")
+    )
+
+    DRAFT = "draft"
+    QUEUED = "queued"
+    FAILED = "failed"
+    SENT = "sent"
+
+    class Meta:
+        indexes = [
+            # rate limit counts for the edge of rolling windows, in total and per user
+            models.Index(
+                fields=["service", "created"], name="impression_msg_svc_created"
+            ),
+            models.Index(
+                fields=["service", "user_type", "user_id", "created"],
+                name="impression_msg_svc_user",
+            ),
+            # the admin's sent/unsent filter
+            models.Index(fields=["sent"], name="impression_msg_sent"),
+            # the admin's date filter
+            models.Index(fields=["created"], name="impression_msg_created"),
+            # the send queue, oldest first; only unsent messages which are ready are
+            # indexed, so sent (always null here) would be a useless leading column
+            models.Index(
+                fields=["created"],
+                name="impression_msg_ready",
+                condition=models.Q(ready_to_send=True, sent__isnull=True),
+            ),
+        ]
 
     def __str__(self):
         return str(self.id)
 
+    RECIPIENT_KINDS = {"to": "t", "cc": "c", "bcc": "b"}
+
+    @classmethod
+    def pack_recipient_ids(cls, to=(), cc=(), bcc=()):
+        """
+        Pack EmailAddress IDs into a string of the IDs prefixed by kind and delimited by
+        commas (including at the ends, so any one recipient can be found with
+        ``contains``).
+        """
+        ids = [
+            "{}{}".format(cls.RECIPIENT_KINDS[kind], pk)
+            for kind, pks in (("to", to), ("cc", cc), ("bcc", bcc))
+            for pk in pks
+        ]
+        return ",{},".format(",".join(ids)) if ids else ""
+
+    @classmethod
+    def pack_recipients(cls, to=(), cc=(), bcc=()):
+        """
+        Pack the EmailAddress objects with ``pack_recipient_ids``.
+        """
+        return cls.pack_recipient_ids(
+            *([e.pk for e in emails] for emails in (to, cc, bcc))
+        )
+
+    @classmethod
+    def unpack_recipients(cls, packed):
+        """
+        Return the packed recipients as a tuple of lists of EmailAddress objects in the
+        form (to, cc, bcc). Recipients whose EmailAddress was deleted are skipped.
+        """
+        packed = [(p[0], int(p[1:])) for p in packed.strip(",").split(",") if p]
+        emails = EmailAddress.objects.in_bulk({pk for _, pk in packed})
+        return tuple(
+            [emails[pk] for prefix, pk in packed if prefix == p and pk in emails]
+            for p in cls.RECIPIENT_KINDS.values()
+        )
+
+    def get_final_recipients(self):
+        """
+        Return the final recipients as a tuple of lists of EmailAddress objects in the
+        form (to, cc, bcc), whether they were stored packed or in the M2M tables.
+        """
+        if not self.final_recipients:
+            return (
+                list(self.final_to_email_addresses.all()),
+                list(self.final_cc_email_addresses.all()),
+                list(self.final_bcc_email_addresses.all()),
+            )
+        return self.unpack_recipients(self.final_recipients)
+
+    def _get_final_body_plaintext(self):
+        blob = self.final_body_plaintext_blob
+        return blob.get_text() if blob else ""
+
+    def _set_final_body_plaintext(self, text):
+        self.final_body_plaintext_blob = BodyBlob.store(text) if text else None
+
+    _get_final_body_plaintext.short_description = _("Body (plaintext, final)")
+    final_body_plaintext = property(
+        _get_final_body_plaintext, _set_final_body_plaintext
+    )
+
+    def _get_final_body_html(self):
+        blob = self.final_body_html_blob
+        return blob.get_text() if blob else ""
+
+    def _set_final_body_html(self, text):
+        self.final_body_html_blob = BodyBlob.store(text) if text else None
+
+    _get_final_body_html.short_description = _("Body (HTML, final)")
+    final_body_html = property(_get_final_body_html, _set_final_body_html)
+
     def _pre_create_check(self):
         """
-        Checks to be done before message is created. Raise exceptions for errors.
+        Checks to be done before message is created. Raise exceptions for errors. This
+        must run in the same transaction as the insert, since it consumes rate limit
+        quota.
         """
-        # check if we hit our rate limit
+        # count the message against the rate limit, raising if we hit it
         if self.service.rate_limit:
-            groups = (
-                self.user.groups.all() & self.service.allowed_groups.all()
-                if self.user
-                else None
-            )
-            if not self.service.check_rate_limit(self.user, groups):
-                raise RateLimitException()
+            self.service.reserve_rate_limit(self.user, self.get_rate_limit_groups())
+
+        # check the size of the body
+        self.service.check_body_size(self.body)
 
         # check if the body passes the json_body_policy
         if self.service.json_body_policy in [self.service.FORBID, self.service.PERMIT]:
             pass
         elif self.service.json_body_policy == self.service.REQUIRE:
-            body = {}
-            try:
-                body.update(json.loads(self.body))
-            except (json.JSONDecodeError, TypeError):  # body is not a JSON object
+            if self.get_body_data() is None:  # body is not a JSON object
                 raise JSONBodyRequired()
         else:
             raise ValueError(
@@ -155,25 +383,74 @@ class Message(models.Model):
                 )
             )
 
-    def save(self, *args, **kwargs):
+    def get_body_data(self):
+        """
+        Return the body decoded as a JSON object, or ``None`` if it isn't one. This is
+        cached for the current body, so the body is decoded once for both the checks
+        and rendering.
+        """
+        cached = getattr(self, "_body_data", None)
+        if cached is None or cached[0] != self.body:
+            try:
+                data = codec.loads(self.body)
+            except (ValueError, TypeError):  # body is not a JSON
+                data = None
+            if not isinstance(data, dict):  # top level JSON is not an object
+                data = None
+            self._body_data = cached = (self.body, data)
+        return cached[1]
+
+    def set_body_data(self, data, body=None):
+        """
+        Set the body to the JSON encoding of the data (or ``body``, if it has already
+        been encoded), keeping the data so it doesn't have to be decoded again.
+        """
+        self.body = codec.dumps(data) if body is None else body
+        self._body_data = (self.body, data)
+
+    def get_rate_limit_groups(self):
+        """
+        Return the groups of the message's user which are allowed to use the service,
+        or ``None`` if there is no user.
+        """
+        if not self.user:
+            return None
+        return self.service.get_allowed_groups(self.user)
+
+    def save(self, *args, send_now=True, **kwargs):
         """
         Save the message. Then, if it looks ready to send but sending hasn't been
-        attempted, acquire DB lock, and send the message.
+        attempted, acquire DB lock, and send the message. If ``send_now`` is False, the
+        message is left for the ``impression_send_emails`` command to send.
 
         For messages being created (pk=None), there are initial checks for things like
         rate limiting and body content validity.
         """
-        # checks before Message is created
-        if self.pk is None:
-            self._pre_create_check()
-
-        # save object first
-        super().save(*args, **kwargs)
+        # checks before Message is created, then save object first
+        using = kwargs.get("using") or router.db_for_write(Message, instance=self)
+        with transaction.atomic(using=using):
+            if self.pk is None:
+                self._pre_create_check()
+            super().save(*args, **kwargs)
 
         # see if we are send-able and we haven't yet attempted; if so, send it
-        if self.ready_to_send and not self.sent and not self.last_attempt:
+        if send_now and self.ready_to_send and not self.sent and not self.last_attempt:
             self.send()
 
+    def get_state(self):
+        """
+        Return the delivery state of the message: one of ``DRAFT`` (not ready to send),
+        ``QUEUED`` (ready, but not attempted), ``FAILED`` (attempted, but not sent; the
+        message will be retried) or ``SENT``.
+        """
+        if self.sent:
+            return self.SENT
+        if not self.ready_to_send:
+            return self.DRAFT
+        if self.last_attempt:
+            return self.FAILED
+        return self.QUEUED
+
     def get_user_display(self):
         """
         Get a string representation of the `user` generic foreign key.
@@ -182,6 +459,26 @@ class Message(models.Model):
             return ""
         return "{} ({}, {})".format(self.user, self.user_type, self.user_id)
 
+    def get_search_document(self):
+        """
+        Return the text which full-text search (``impression.search``) indexes: the
+        content and the final content of the message, and its extra and final email
+        addresses.
+        """
+        emails = [
+            self.override_from_email_address,
+            self.final_from_email_address,
+            *self.extra_to_email_addresses.all(),
+            *self.extra_cc_email_addresses.all(),
+            *self.extra_bcc_email_addresses.all(),
+        ]
+        for recipients in self.get_final_recipients():
+            emails.extend(recipients)
+        return "\n".join(
+            [self.subject, self.body, self.final_subject, self.final_body_plaintext]
+            + sorted({str(e) for e in emails if e})
+        )
+
     def get_from_email(self):
         """
         Return the proper "FROM" EmailAddress object. If the service allows the message
@@ -235,12 +532,7 @@ class Message(models.Model):
         context["subject"] = self.subject
         context["body"] = self.body
         if self.service.json_body_policy in [self.service.PERMIT, self.service.REQUIRE]:
-            try:
-                context.update(json.loads(self.body))
-            except json.JSONDecodeError:  # body is not a JSON
-                pass
-            except TypeError:  # top level JSON is not an object
-                pass
+            context.update(self.get_body_data() or {})
         elif self.service.json_body_policy == self.service.FORBID:
             pass  # do not attempt to load body as JSON into context
         else:
@@ -285,14 +577,18 @@ class Message(models.Model):
 
         # send the message
         self.last_attempt = timezone.now()
+        self.attempts += 1
         if email.send():
             self.sent = timezone.now()
 
             # store the final sent message details
             self.final_from_email_address = from_email
-            self.final_to_email_addresses.add(*to)
-            self.final_cc_email_addresses.add(*cc)
-            self.final_bcc_email_addresses.add(*bcc)
+            if get_setting("IMPRESSION_PACK_FINAL_RECIPIENTS"):
+                self.final_recipients = self.pack_recipients(to, cc, bcc)
+            else:
+                self.final_to_email_addresses.add(*to)
+                self.final_cc_email_addresses.add(*cc)
+                self.final_bcc_email_addresses.add(*bcc)
             self.final_subject = subject
             self.final_body_plaintext = plaintext_body or ""
             self.final_body_html = html_body or ""
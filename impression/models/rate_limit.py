@@ -1,8 +1,16 @@
+import datetime
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from ..exceptions import RateLimitException
+from ..settings import get_setting
+
 
 class RateLimitQuerySet(models.QuerySet):
     def get_by_natural_key(self, name):
@@ -41,9 +49,11 @@ class RateLimit(models.Model):
     )
     BLOCK_PERIOD = "block_period"
     ROLLING_WINDOW = "rolling_window"
+    TOKEN_BUCKET = "token_bucket"
     TYPE_CHOICES = (
         (BLOCK_PERIOD, _("Block Period")),
         (ROLLING_WINDOW, _("Rolling Window")),
+        (TOKEN_BUCKET, _("Token Bucket")),
     )
     type = models.CharField(max_length=255, choices=TYPE_CHOICES, default=BLOCK_PERIOD)
     HOUR = "hour"
@@ -61,14 +71,33 @@ class RateLimit(models.Model):
         max_length=255, choices=BLOCK_PERIOD_CHOICES, default=HOUR
     )
     rolling_window = models.DurationField(
-        default=timezone.timedelta(hours=1), help_text=_("[DD] HH:MM:SS")
+        default=timezone.timedelta(hours=1),
+        help_text=_(
+            "[DD] HH:MM:SS; for a token bucket, the quantity is refilled evenly over "
+            "this window."
+        ),
+    )
+    burst = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text=_(
+            "For a token bucket, the maximum number of messages which can be sent at "
+            "once. If blank, the quantity is used."
+        ),
     )
+    counter_config = models.CharField(max_length=255, blank=True, editable=False)
 
     objects = RateLimitQuerySet.as_manager()
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.counter_config = self.get_counter_config()
+        super().save(*args, **kwargs)
+        self.check_counters()
+
     def get_timeframe(self, now=None):
         """
         Get a start and end datetime object (timezone aware) for the time frame we
@@ -89,14 +118,12 @@ class RateLimit(models.Model):
                 then = then.replace(hour=0)
                 if self.block_period == self.DAY:
                     return (then, now)
-                else:
-                    then = then.replace(hour=0, day=then.day - then.isoweekday())
-                    if self.block_period == self.WEEK:
-                        return (then, now)
-                    else:
-                        then = then.replace(day=1)
-                        if self.block_period == self.MONTH:
-                            return (then, now)
+                elif self.block_period == self.WEEK:
+                    # weeks start on Sunday
+                    days = timezone.timedelta(days=then.isoweekday() % 7)
+                    return (then - days, now)
+                elif self.block_period == self.MONTH:
+                    return (then.replace(day=1), now)
         raise Exception("RateLimit type or block period not known.")
 
     def _humanized_rolling_window(self):
@@ -123,28 +150,502 @@ class RateLimit(models.Model):
             return "{} messages for a rolling window of: {}".format(
                 self.quantity, self._humanized_rolling_window()
             )
+        if self.type == self.TOKEN_BUCKET:
+            return "{} messages refilled over: {}, with bursts of up to {}".format(
+                self.quantity, self._humanized_rolling_window(), self.get_burst()
+            )
 
-    def check_service(self, service, user=None, groups=None):
+    def get_burst(self):
         """
-        Check the service to see if the rate limit has been reached, either in total,
-        per user, or per group, depending on the configuration.
+        Return the capacity of a token bucket.
+        """
+        return self.quantity if self.burst is None else self.burst
 
-        Return True if the rate limit has not been reached and False if it has.
+    def get_refill_rate(self):
+        """
+        Return the number of tokens a token bucket regains per second.
+        """
+        return self.quantity / max(self.rolling_window.total_seconds(), 1)
+
+    def _refill(self, tokens, last_refill, now):
+        """
+        Return the tokens in a bucket at ``now``, given its state at ``last_refill``.
+        """
+        elapsed = max((now - last_refill).total_seconds(), 0)
+        return min(tokens + elapsed * self.get_refill_rate(), self.get_burst())
+
+    def get_tokens(self, service, user=None, groups=None, now=None):
+        """
+        Return a dict mapping each counter key to the tokens currently in its bucket.
+        """
+        if not now:
+            now = timezone.now()
+        keys = self.get_keys(user, groups)
+        states = {
+            b.key: self._refill(b.tokens, b.last_refill, now)
+            for b in self.token_buckets.filter(service=service, key__in=keys)
+        }
+        return {k: states.get(k, self.get_burst()) for k in keys}
+
+    def _take_token(self, service, key, now, amount=1):
+        """
+        Take ``amount`` tokens from the bucket for the key. This must run in a
+        transaction: the bucket row is locked while it is read and updated, so
+        concurrent callers cannot take the same token. On databases which can't lock
+        rows, the update is also conditional on the state that was read, and the state
+        is read again a limited number of times before failing closed.
+
+        Return True if the tokens were taken.
+        """
+        buckets = self.token_buckets.filter(service=service, key=key)
+        for _ in range(3):
+            bucket = buckets.select_for_update().first()
+            if bucket is None:
+                if self.get_burst() < amount:
+                    return False
+                try:
+                    with transaction.atomic():
+                        self.token_buckets.create(
+                            service=service,
+                            key=key,
+                            tokens=self.get_burst() - amount,
+                            last_refill=now,
+                        )
+                    return True
+                except IntegrityError:
+                    # another process created the bucket first
+                    continue
+            tokens = self._refill(bucket.tokens, bucket.last_refill, now)
+            if tokens < amount:
+                return False
+            if buckets.filter(
+                tokens=bucket.tokens, last_refill=bucket.last_refill
+            ).update(tokens=tokens - amount, last_refill=max(now, bucket.last_refill)):
+                return True
+        return False
+
+    def get_bucket_width(self):
+        """
+        Return the width (as a timedelta) of the counter buckets for a rolling window.
+        The window is split into ``IMPRESSION_RATE_LIMIT_BUCKETS`` buckets, each at
+        least one second wide.
+        """
+        buckets = get_setting("IMPRESSION_RATE_LIMIT_BUCKETS") or 1
+        seconds = int(self.rolling_window.total_seconds()) // buckets
+        return timezone.timedelta(seconds=max(seconds, 1))
+
+    def get_bucket(self, dt):
+        """
+        Return the start of the counter bucket that ``dt`` falls into. For block
+        periods, this is the start of the block, so each block is a single bucket.
+        """
+        if self.type == self.ROLLING_WINDOW:
+            width = int(self.get_bucket_width().total_seconds())
+            ts = int(dt.timestamp())
+            return datetime.datetime.fromtimestamp(ts - ts % width, tz=dt.tzinfo)
+        return self.get_timeframe(now=dt)[0]
+
+    def get_expired_counters(self, now=None):
+        """
+        Return the counters whose buckets lie entirely before the current time frame,
+        which can no longer count against the rate limit.
+        """
+        if self.type == self.TOKEN_BUCKET:
+            return self.counters.all()
+        return self.counters.filter(
+            bucket__lt=self.get_bucket(self.get_timeframe(now)[0])
+        )
+
+    def get_counter_config(self):
+        """
+        Return a summary of how messages are counted (the counter keys and buckets), so
+        the counters can be rebuilt when it changes.
+        """
+        if self.type == self.ROLLING_WINDOW:
+            buckets = int(self.get_bucket_width().total_seconds())
+        elif self.type == self.BLOCK_PERIOD:
+            buckets = self.block_period
+        else:
+            buckets = ""
+        return "{}:{}:{}".format(self.type, self.grouping, buckets)
+
+    def check_counters(self):
+        """
+        Rebuild the counters of every service from their messages if the way messages
+        are counted has changed since the counters were built, e.g. if the grouping or
+        the rolling window was edited, or ``IMPRESSION_RATE_LIMIT_BUCKETS`` changed.
+        """
+        config = self.get_counter_config()
+        if self.counter_config == config:
+            return
+        with transaction.atomic():
+            # only one process rebuilds the counters for the change
+            claimed = RateLimit.objects.filter(
+                pk=self.pk, counter_config=self.counter_config
+            ).update(counter_config=config)
+            if claimed:
+                for service in self.service_set.all():
+                    self.seed_counters(service)
+        self.counter_config = config
+
+    def _get_group_ids(self, user_ids):
+        """
+        Return a dict mapping the IDs of the users to the IDs of their groups.
+        """
+        groups_field = get_user_model()._meta.get_field("groups")
+        user_field = groups_field.m2m_field_name()
+        group_field = groups_field.m2m_reverse_field_name()
+        memberships = groups_field.remote_field.through.objects.filter(
+            **{"{}__in".format(user_field): user_ids}
+        )
+        group_ids = {}
+        for user_id, group_id in memberships.values_list(user_field, group_field):
+            group_ids.setdefault(user_id, []).append(group_id)
+        return group_ids
+
+    def _get_message_keys(self, messages):
+        """
+        Yield the counter key (or keys, per group) of each message in ``messages``, a
+        list of tuples in the form (created, user_type_id, user_id), along with its
+        creation date.
+        """
+        group_ids = {}
+        user_type_id = ContentType.objects.get_for_model(get_user_model()).pk
+        if self.grouping == self.PER_GROUP:
+            group_ids = self._get_group_ids(
+                {row[2] for row in messages if row[1] == user_type_id}
+            )
+        for created, message_user_type_id, user_id in messages:
+            if self.grouping == self.TOTAL:
+                yield "total", created
+            elif self.grouping == self.PER_USER and message_user_type_id:
+                yield "user:{}:{}".format(message_user_type_id, user_id), created
+            elif (
+                self.grouping == self.PER_GROUP and message_user_type_id == user_type_id
+            ):
+                for group_id in group_ids.get(user_id, []):
+                    yield "group:{}".format(group_id), created
+
+    def seed_counters(self, service, now=None, chunk_size=2000):
+        """
+        Replace the counters of the service with counts of its messages in the current
+        time frame, e.g. when the service starts using this rate limit. The messages are
+        read in chunks of ``chunk_size``.
+        """
+        if not now:
+            now = timezone.now()
+        counts = Counter()
+        if self.type != self.TOKEN_BUCKET:
+            messages = service.messages.filter(
+                created__gte=self.get_bucket(self.get_timeframe(now)[0]),
+                created__lte=now,
+            ).order_by("pk")
+            last_pk = 0
+            while True:
+                chunk = list(
+                    messages.filter(pk__gt=last_pk).values_list(
+                        "pk", "created", "user_type_id", "user_id"
+                    )[:chunk_size]
+                )
+                if not chunk:
+                    break
+                last_pk = chunk[-1][0]
+                for key, created in self._get_message_keys([row[1:] for row in chunk]):
+                    counts[key, self.get_bucket(created)] += 1
+        with transaction.atomic():
+            self.counters.filter(service=service).delete()
+            RateLimitCounter.objects.bulk_create(
+                [
+                    RateLimitCounter(
+                        rate_limit=self,
+                        service=service,
+                        key=key,
+                        bucket=bucket,
+                        count=count,
+                    )
+                    for (key, bucket), count in counts.items()
+                ],
+                batch_size=1000,
+            )
+
+    def get_keys(self, user=None, groups=None):
+        """
+        Return the list of counter keys which a message from the user (and the relevant
+        groups) counts against, depending on the grouping.
         """
-        (then, now) = self.get_timeframe()
-        base_query = service.messages.filter(created__gte=then, created__lte=now)
         if self.grouping == self.PER_USER and user:
-            count = base_query.filter(
-                user_type=ContentType.objects.get_for_model(user), user_id=user.pk
-            ).count()
+            return [
+                "user:{}:{}".format(ContentType.objects.get_for_model(user).pk, user.pk)
+            ]
         elif self.grouping == self.PER_GROUP and groups:
-            count = max([base_query.filter(user__groups=g).count() for g in groups])
+            return ["group:{}".format(g.pk) for g in groups]
         elif self.grouping == self.TOTAL:
-            count = base_query.count()
-        else:
-            raise ValueError(
-                "self.grouping is not valid (bad value {} for obj {})".format(
-                    self.grouping, self.pk
-                )
+            return ["total"]
+        raise ValueError(
+            "self.grouping is not valid (bad value {} for obj {})".format(
+                self.grouping, self.pk
             )
-        return count < self.quantity
+        )
+
+    def _count_messages(self, base_query, user=None, groups=None):
+        """
+        Count the messages in ``base_query`` per counter key.
+        """
+        keys = self.get_keys(user, groups)
+        if self.grouping == self.PER_USER:
+            return {
+                keys[0]: base_query.filter(
+                    user_type=ContentType.objects.get_for_model(user), user_id=user.pk
+                ).count()
+            }
+        elif self.grouping == self.PER_GROUP:
+            return dict(zip(keys, self._count_group_messages(base_query, groups)))
+        return {keys[0]: base_query.count()}
+
+    def _count_group_messages(self, base_query, groups):
+        """
+        Count the messages in ``base_query`` which were created by members of each of
+        the groups, in a single query. Return a list of counts in the same order as the
+        groups.
+        """
+        user_model = get_user_model()
+        groups_field = user_model._meta.get_field("groups")
+        memberships = groups_field.remote_field.through.objects.filter(
+            group_id=models.OuterRef(models.OuterRef("pk"))
+        ).values(groups_field.m2m_field_name())
+        counts = (
+            base_query.filter(
+                user_type=ContentType.objects.get_for_model(user_model),
+                user_id__in=memberships,
+            )
+            .order_by()
+            .values("service")
+            .annotate(count=models.Count("pk"))
+            .values("count")
+        )
+        rows = dict(
+            Group.objects.filter(pk__in=[g.pk for g in groups])
+            .annotate(count=models.Subquery(counts))
+            .values_list("pk", "count")
+        )
+        return [rows.get(g.pk) or 0 for g in groups]
+
+    def count_messages(self, service, user=None, groups=None, now=None):
+        """
+        Count the messages created for the service in the current time frame by
+        querying the messages directly.
+
+        Return a dict mapping each counter key to its count.
+        """
+        then, now = self.get_timeframe(now)
+        return self._count_messages(
+            service.messages.filter(created__gte=then, created__lte=now), user, groups
+        )
+
+    def get_counts(self, service, user=None, groups=None, now=None, until=None):
+        """
+        Count the messages created for the service in the current time frame using the
+        bucketed counters. Buckets which lie entirely within the time frame are summed,
+        and the slice of a rolling window which only partially covers its oldest bucket
+        is counted from the messages themselves, so the result matches
+        ``count_messages``. If ``until`` is provided, only buckets starting before it
+        are summed.
+
+        Return a dict mapping each counter key to its count.
+        """
+        self.check_counters()
+        then, now = self.get_timeframe(now)
+        keys = self.get_keys(user, groups)
+        start = self.get_bucket(then)
+        edge = {}
+        if start < then:
+            start += self.get_bucket_width()
+            edge = self._count_messages(
+                service.messages.filter(created__gte=then, created__lt=start),
+                user,
+                groups,
+            )
+        counts = {}
+        # e.g., a block period only has the current bucket, so there is nothing before
+        if not until or until > start:
+            counters = self.counters.filter(
+                service=service, key__in=keys, bucket__gte=start, bucket__lte=now
+            )
+            if until:
+                counters = counters.filter(bucket__lt=until)
+            counts = dict(
+                counters.order_by()
+                .values_list("key")
+                .annotate(total=models.Sum("count"))
+            )
+        return {k: counts.get(k, 0) + edge.get(k, 0) for k in keys}
+
+    def _increment(self, service, key, bucket, allowance, amount=1):
+        """
+        Add ``amount`` to the counter for the key and bucket, but only if its count
+        stays within ``allowance``. The check and the increment are a single
+        conditional UPDATE, so concurrent callers cannot both take the last of the
+        allowance.
+
+        Return True if the counter was incremented.
+        """
+        if allowance < amount:
+            return False
+        counter = self.counters.filter(
+            service=service, key=key, bucket=bucket, count__lte=allowance - amount
+        )
+        if counter.update(count=models.F("count") + amount):
+            return True
+        try:
+            with transaction.atomic():
+                self.counters.create(
+                    service=service, key=key, bucket=bucket, count=amount
+                )
+            return True
+        except IntegrityError:
+            # the counter exists, so it was either full or created by another process
+            return bool(counter.update(count=models.F("count") + amount))
+
+    def reserve(self, service, user=None, groups=None, now=None, amount=1):
+        """
+        Check the rate limit and count ``amount`` new messages against it in one step,
+        so concurrent messages cannot overshoot the limit. Only the bucket for ``now``
+        can still change, so the older buckets are summed first, and the current bucket
+        is conditionally incremented with what remains of the quantity. With multiple
+        keys (per group), either all of them are incremented or none are.
+
+        For a token bucket, a token is taken from the bucket of each key instead.
+
+        Raise ``RateLimitException`` if the rate limit has been reached.
+        """
+        if not now:
+            now = timezone.now()
+        if self.type == self.TOKEN_BUCKET:
+            with transaction.atomic():
+                for key in self.get_keys(user, groups):
+                    if not self._take_token(service, key, now, amount):
+                        raise RateLimitException()
+            return
+        bucket = self.get_bucket(now)
+        counts = self.get_counts(service, user, groups, now, until=bucket)
+        with transaction.atomic():
+            for key, count in counts.items():
+                allowance = self.quantity - count
+                if not self._increment(service, key, bucket, allowance, amount):
+                    raise RateLimitException()
+
+    def reserve_up_to(self, service, amount, user=None, groups=None):
+        """
+        Reserve as many as possible of ``amount`` new messages at once, retrying with
+        the remaining quota when the full amount does not fit.
+
+        Return the number of messages which were reserved.
+        """
+        while amount > 0:
+            try:
+                self.reserve(service, user, groups, amount=amount)
+                return amount
+            except RateLimitException:
+                amount = min(amount - 1, self.get_quota(service, user, groups)[1])
+        return 0
+
+    def get_block_end(self, start):
+        """
+        Return the end of the block period which begins at ``start``.
+        """
+        if self.block_period == self.HOUR:
+            return start + timezone.timedelta(hours=1)
+        elif self.block_period == self.DAY:
+            return start + timezone.timedelta(days=1)
+        elif self.block_period == self.WEEK:
+            return start + timezone.timedelta(days=7)
+        elif self.block_period == self.MONTH:
+            return (start.replace(day=28) + timezone.timedelta(days=4)).replace(day=1)
+        raise Exception("RateLimit block period not known.")
+
+    def get_quota(self, service, user=None, groups=None, now=None):
+        """
+        Get the quota of the user (or groups) on the service from the counters (or the
+        token buckets), using the most restrictive key.
+
+        This should return a tuple in the form (limit, remaining, reset_dt), where
+        ``reset_dt`` is when more messages will next be allowed.
+        """
+        if not now:
+            now = timezone.now()
+        if self.type == self.TOKEN_BUCKET:
+            burst = self.get_burst()
+            tokens = min(self.get_tokens(service, user, groups, now).values())
+            rate = self.get_refill_rate()
+            # the time until the next whole token
+            wait = (1 - tokens) / rate if tokens < 1 and rate else 0
+            return (burst, int(tokens), now + timezone.timedelta(seconds=wait))
+        counts = self.get_counts(service, user, groups, now)
+        remaining = max(self.quantity - max(counts.values()), 0)
+        if self.type == self.ROLLING_WINDOW:
+            reset = self.get_bucket(now) + self.get_bucket_width()
+        else:
+            reset = self.get_block_end(self.get_bucket(now))
+        return (self.quantity, remaining, reset)
+
+    def check_service(self, service, user=None, groups=None):
+        """
+        Check the service to see if the rate limit has been reached, either in total,
+        per user, or per group, depending on the configuration.
+
+        Return True if the rate limit has not been reached and False if it has.
+        """
+        if self.type == self.TOKEN_BUCKET:
+            return min(self.get_tokens(service, user, groups).values()) >= 1
+        counts = self.get_counts(service, user, groups)
+        return max(counts.values()) < self.quantity
+
+
+class RateLimitCounter(models.Model):
+    """
+    The number of messages created for a service within one bucket of a rate limit's
+    time frame, for a single counter key (total, a user, or a group).
+    """
+
+    rate_limit = models.ForeignKey(
+        RateLimit, on_delete=models.CASCADE, related_name="counters"
+    )
+    service = models.ForeignKey(
+        "impression.Service",
+        on_delete=models.CASCADE,
+        related_name="rate_limit_counters",
+    )
+    key = models.CharField(max_length=255)
+    bucket = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("rate_limit", "service", "key", "bucket")
+
+    def __str__(self):
+        return "{} ({}, {})".format(self.key, self.service_id, self.bucket)
+
+
+class RateLimitTokenBucket(models.Model):
+    """
+    The state of a token bucket rate limit for a service and a single counter key
+    (total, a user, or a group).
+    """
+
+    rate_limit = models.ForeignKey(
+        RateLimit, on_delete=models.CASCADE, related_name="token_buckets"
+    )
+    service = models.ForeignKey(
+        "impression.Service",
+        on_delete=models.CASCADE,
+        related_name="rate_limit_token_buckets",
+    )
+    key = models.CharField(max_length=255)
+    tokens = models.FloatField()
+    last_refill = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("rate_limit", "service", "key")
+
+    def __str__(self):
+        return "{} ({})".format(self.key, self.service_id)
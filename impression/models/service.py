@@ -3,6 +3,12 @@ from django.core.validators import RegexValidator
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
+from .template import DefaultTemplate
+from .. import codec
+from ..cache import get_user_group_ids
+from ..exceptions import BodyTooLarge, ImpressionMessageException, JSONBodyRequired
+from ..settings import get_setting
+
 
 class ServiceQuerySet(models.QuerySet):
     def get_by_natural_key(self, name):
@@ -84,6 +90,14 @@ class Service(models.Model):
             " be decoded as a JSON and loaded into template context."
         ),
     )
+    max_body_size = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text=_(
+            "The maximum size of message bodies, in bytes. If blank, the "
+            "'IMPRESSION_MAX_BODY_SIZE' setting will be used."
+        ),
+    )
     template = models.ForeignKey(
         "impression.Template", blank=True, null=True, on_delete=models.SET_NULL
     )
@@ -138,6 +152,22 @@ class Service(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        """
+        When the service is given a new rate limit, seed the counters of the rate limit
+        from the messages of the service, so the messages it already sent still count.
+        """
+        rate_limit_id = None
+        if not self._state.adding:
+            rate_limit_id = (
+                Service.objects.filter(pk=self.pk)
+                .values_list("rate_limit_id", flat=True)
+                .first()
+            )
+        super().save(*args, **kwargs)
+        if self.rate_limit_id and self.rate_limit_id != rate_limit_id:
+            self.rate_limit.seed_counters(self)
+
     def _collect_email_addresses_by_kind(self, kind="to"):
         """
         Expand the distributions and return a set of emails, given a `kind` which should
@@ -174,6 +204,50 @@ class Service(models.Model):
             return True
         return self.rate_limit.check_service(self, user, groups)
 
+    def get_allowed_group_ids(self):
+        """
+        Return the set of IDs of the groups which are allowed to use the service. This
+        is memoized on the instance, so it is cached along with the service.
+        """
+        if not hasattr(self, "_allowed_group_ids"):
+            self._allowed_group_ids = set(
+                self.allowed_groups.values_list("pk", flat=True)
+            )
+        return self._allowed_group_ids
+
+    def is_allowed(self, user):
+        """
+        Return whether the user is in a group which is allowed to use the service.
+        """
+        return bool(self.get_allowed_group_ids() & get_user_group_ids(user))
+
+    def get_allowed_groups(self, user):
+        """
+        Return the groups of the user which are allowed to use the service.
+        """
+        return Group.objects.filter(
+            pk__in=self.get_allowed_group_ids() & get_user_group_ids(user)
+        )
+
+    def get_quota(self, user=None, groups=None):
+        """
+        Return the rate limit quota of this user or the relevant groups as a tuple in
+        the form (limit, remaining, reset_dt). If no rate limit is provided, return
+        None.
+        """
+        if not self.rate_limit:
+            return None
+        return self.rate_limit.get_quota(self, user, groups)
+
+    def reserve_rate_limit(self, user=None, groups=None, amount=1):
+        """
+        Check the rate limit and count ``amount`` new messages against it atomically. If
+        no rate limit is provided, do nothing. Raise ``RateLimitException`` if the rate
+        limit has been reached.
+        """
+        if self.rate_limit:
+            self.rate_limit.reserve(self, user, groups, amount=amount)
+
     def filter_unsubscribed(self, email_set):
         """
         Filter out emails which are unsubscribed. Return a filtered set of EmailAddress
@@ -181,7 +255,7 @@ class Service(models.Model):
         """
         if self.is_unsubscribable:
             return {e for e in email_set if not e.is_unsubscribed_from(self)}
-        return emails
+        return email_set
 
     def extract_body(self, body):
         """
@@ -192,4 +266,55 @@ class Service(models.Model):
          - FORBID, then the body must be a string.
          - PERMIT, then the body can be either a JSON string or an object.
          - REQUIRE, then the body must be decodable as JSON or itself be an object.
+
+        Return the body as a string, encoding it as JSON if it is an object. Raise
+        ``JSONBodyRequired`` or ``ImpressionMessageException`` if the body is invalid.
+        """
+        return self.extract_body_data(body)[0]
+
+    def extract_body_data(self, body):
+        """
+        Like ``extract_body``, but also return the body's JSON object (or ``None`` if
+        the body is a string which wasn't decoded), so it doesn't have to be decoded
+        again for rendering.
+
+        Return a tuple in the form (body, body_data).
+        """
+        data = None
+        if body is None:
+            body = ""
+        if isinstance(body, dict):
+            if self.json_body_policy == self.FORBID:
+                raise ImpressionMessageException("Body cannot be a JSON object.")
+            body, data = codec.dumps(body), body
+        elif not isinstance(body, str):
+            raise ImpressionMessageException(
+                "Body has invalid type {}".format(type(body))
+            )
+        elif self.json_body_policy == self.REQUIRE:
+            try:
+                data = codec.loads(body)
+            except ValueError:
+                raise JSONBodyRequired()
+            if not isinstance(data, dict):
+                raise JSONBodyRequired()
+        self.check_body_size(body)
+        return body, data
+
+    def get_max_body_size(self):
+        """
+        Return the maximum size of message bodies in bytes, or ``None`` for no limit.
+        """
+        if self.max_body_size is not None:
+            return self.max_body_size
+        return get_setting("IMPRESSION_MAX_BODY_SIZE")
+
+    def check_body_size(self, body):
+        """
+        Raise ``BodyTooLarge`` if the body (a string) is larger than the service allows.
         """
+        limit = self.get_max_body_size()
+        # a character is at most 4 bytes in UTF-8, so most bodies skip the encoding
+        if limit is not None and len(body) * 4 > limit:
+            if len(body.encode()) > limit:
+                raise BodyTooLarge("Body is larger than {} bytes.".format(limit))
@@ -92,6 +92,14 @@ class Template(models.Model):
     def __str__(self):
         return self.name
 
+    def get_search_document(self):
+        """
+        Return the text which full-text search (``impression.search``) indexes.
+        """
+        return "\n".join(
+            (self.name, self.subject, self.body_html, self.get_body_plaintext())
+        )
+
     def get_body_html(self):
         """
         Helper for getting the HTML body, including the ``extends`` tag, if needed.
@@ -0,0 +1,69 @@
+"""
+This module provides a paginator for the admin change lists of large tables (e.g., the
+messages), where counting every row on each page load is too slow.
+"""
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+def get_estimated_count(model, using):
+    """
+    Return the number of rows in the table of the model according to the statistics of
+    the database, or ``None`` if there are no statistics (e.g., the table was never
+    analyzed) or the database isn't supported.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [connection.ops.quote_name(table)],
+            )
+        elif connection.vendor == "mysql":
+            cursor.execute(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s",
+                [table],
+            )
+        elif connection.vendor == "sqlite":
+            # sqlite_stat1 only exists once ANALYZE has been run
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = 'sqlite_stat1'"
+            )
+            if not cursor.fetchone():
+                return None
+            # the first number of the stat of any index of the table is its row count
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s", [table])
+        else:
+            return None
+        row = cursor.fetchone()
+
+    if not row or row[0] is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    # PostgreSQL uses -1 for tables which have never been analyzed
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator which estimates the count of an unfiltered queryset from the statistics
+    of the database. Small tables (with an estimate below ``min_estimate``) and
+    filtered querysets are counted exactly, since estimates for them are either cheap
+    to replace or unavailable.
+    """
+
+    min_estimate = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = get_estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.min_estimate:
+                return estimate
+        return super().count
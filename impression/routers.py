@@ -0,0 +1,84 @@
+"""
+This module implements an optional database router which sends the read-only paths of
+Impression (admin browsing, quota and status lookups) to a read replica. To use it, add
+the replica to ``DATABASES`` and configure:
+
+.. code-block:: python
+
+    DATABASE_ROUTERS = ["impression.routers.ReplicaRouter"]
+    IMPRESSION_REPLICA_DATABASE = "replica"
+
+Only reads made inside ``replica_reads()`` go to the replica; everything else, including
+the intake, rate limiting and queue claims (``select_for_update`` queries are routed as
+writes), stays on the primary. Since the replica may lag behind, reads also stay on the
+primary for ``IMPRESSION_REPLICA_LAG`` seconds after a write in the same context, so
+clients read their own writes.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS
+
+from .settings import get_setting
+
+_replica_reads = ContextVar("impression_replica_reads", default=False)
+_last_write = ContextVar("impression_last_write", default=None)
+
+
+@contextmanager
+def replica_reads():
+    """
+    Context manager (or decorator) which sends Impression reads to the replica. Used as
+    a decorator, each call gets its own context, so overlapping calls don't share state.
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def get_replica():
+    """
+    Return the alias of the replica which reads should be sent to right now, or
+    ``None`` if they should go to the primary.
+    """
+    replica = get_setting("IMPRESSION_REPLICA_DATABASE")
+    if not replica or not _replica_reads.get():
+        return None
+    last_write = _last_write.get()
+    if last_write is not None:
+        if time.monotonic() - last_write < get_setting("IMPRESSION_REPLICA_LAG"):
+            return None
+    return replica
+
+
+class ReplicaRouter:
+    app_label = "impression"
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return get_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            _last_write.set(time.monotonic())
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, get_setting("IMPRESSION_REPLICA_DATABASE")}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        """
+        The replica gets its schema through replication.
+        """
+        if db == get_setting("IMPRESSION_REPLICA_DATABASE"):
+            return False
+        return None
@@ -0,0 +1,236 @@
+"""
+This module implements optional full-text search of messages and templates, for the
+admin search box. When ``IMPRESSION_FULL_TEXT_SEARCH`` is enabled, each saved message or
+template gets a search document (see ``get_search_document`` on the models) which is
+stored in a search table next to the model's table:
+
+ - On PostgreSQL, as a ``tsvector`` with a GIN index.
+ - On SQLite, in an FTS5 virtual table (with the primary key as the ``rowid``).
+
+Documents are updated when the transaction of the save commits, so a message's
+recipients (which are added after the message is saved) are included. To index rows
+which were saved before search was enabled, run ``impression_rebuild_search_index``.
+"""
+
+from django.apps import apps
+from django.db import connections, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .settings import get_setting
+
+SEARCH_MODELS = ("impression.Message", "impression.Template")
+
+
+def get_search_table(model):
+    return "{}_search".format(model._meta.db_table)
+
+
+class SQLiteSearchBackend:
+    has_fts5 = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def is_available(self):
+        if SQLiteSearchBackend.has_fts5 is None:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+                SQLiteSearchBackend.has_fts5 = bool(cursor.fetchone()[0])
+        return SQLiteSearchBackend.has_fts5
+
+    def update(self, model, documents):
+        table = self.connection.ops.quote_name(get_search_table(model))
+        with self.connection.cursor() as cursor:
+            self._delete(cursor, table, list(documents))
+            cursor.executemany(
+                "INSERT INTO {} (rowid, document) VALUES (%s, %s)".format(table),
+                list(documents.items()),
+            )
+
+    def delete(self, model, pks):
+        table = self.connection.ops.quote_name(get_search_table(model))
+        with self.connection.cursor() as cursor:
+            self._delete(cursor, table, pks)
+
+    @staticmethod
+    def _delete(cursor, table, pks):
+        if pks:
+            cursor.execute(
+                "DELETE FROM {} WHERE rowid IN ({})".format(
+                    table, ", ".join(["%s"] * len(pks))
+                ),
+                pks,
+            )
+
+    def get_match_sql(self, model, term):
+        """
+        Return SQL (and params) selecting the primary keys matching every word of the
+        search term, where each word may be the start of a word (so, e.g., an email
+        address can be searched by its user part).
+        """
+        table = self.connection.ops.quote_name(get_search_table(model))
+        query = " ".join(
+            '"{}"*'.format(word.replace('"', '""')) for word in term.split()
+        )
+        return "SELECT rowid FROM {0} WHERE {0} MATCH %s".format(table), [query]
+
+
+class PostgreSQLSearchBackend:
+    config = "simple"
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def is_available(self):
+        return True
+
+    def update(self, model, documents):
+        table = self.connection.ops.quote_name(get_search_table(model))
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO {} (object_id, document) "
+                "VALUES (%s, to_tsvector(%s::regconfig, %s)) "
+                "ON CONFLICT (object_id) DO UPDATE SET document = EXCLUDED.document"
+                "".format(table),
+                [(pk, self.config, text) for pk, text in documents.items()],
+            )
+
+    def delete(self, model, pks):
+        table = self.connection.ops.quote_name(get_search_table(model))
+        if pks:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM {} WHERE object_id = ANY(%s)".format(table), [pks]
+                )
+
+    def get_match_sql(self, model, term):
+        table = self.connection.ops.quote_name(get_search_table(model))
+        return (
+            "SELECT object_id FROM {} "
+            "WHERE document @@ plainto_tsquery(%s::regconfig, %s)".format(table),
+            [self.config, term],
+        )
+
+
+SEARCH_BACKENDS = {
+    "sqlite": SQLiteSearchBackend,
+    "postgresql": PostgreSQLSearchBackend,
+}
+
+
+def get_search_backend(using):
+    """
+    Return the search backend for the database, or ``None`` if full-text search is
+    disabled or not supported by the database.
+    """
+    if not get_setting("IMPRESSION_FULL_TEXT_SEARCH"):
+        return None
+    connection = connections[using]
+    backend_class = SEARCH_BACKENDS.get(connection.vendor)
+    if not backend_class:
+        return None
+    backend = backend_class(connection)
+    return backend if backend.is_available() else None
+
+
+def update_index(model, pks, using):
+    """
+    Update (or delete) the search documents of the objects with the primary keys. The
+    related objects which the model lists in ``search_select_related`` and
+    ``search_prefetch_related`` are fetched for all the objects at once.
+    """
+    backend = get_search_backend(using)
+    if not backend or not pks:
+        return
+    queryset = model._default_manager.using(using).filter(pk__in=pks)
+    if getattr(model, "search_select_related", None):
+        queryset = queryset.select_related(*model.search_select_related)
+    queryset = queryset.prefetch_related(*getattr(model, "search_prefetch_related", ()))
+    documents = {obj.pk: obj.get_search_document() for obj in queryset}
+    backend.delete(model, [pk for pk in pks if pk not in documents])
+    if documents:
+        backend.update(model, documents)
+
+
+class PendingUpdates:
+    """
+    The primary keys scheduled for indexing in a transaction, by model, which are
+    indexed when it commits. It is the ``on_commit`` callback itself, so it is discarded
+    if the transaction (or the savepoint it was scheduled in) is rolled back. Objects
+    which were only changed in a savepoint that was rolled back are indexed as they are
+    in the database (or their documents are deleted if they don't exist).
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.pks = {}
+
+    def __call__(self):
+        # once run, later changes are scheduled anew
+        pks, self.pks = self.pks, None
+        for model, model_pks in pks.items():
+            update_index(model, list(model_pks), self.using)
+
+
+def get_pending_updates(using):
+    """
+    Return the updates which are pending in the current transaction, scheduling them
+    if there are none yet.
+    """
+    connection = connections[using]
+    for entry in connection.run_on_commit:
+        if isinstance(entry[1], PendingUpdates) and entry[1].pks is not None:
+            return entry[1]
+    updates = PendingUpdates(using)
+    transaction.on_commit(updates, using=using)
+    return updates
+
+
+def schedule_update(model, pks, using):
+    """
+    Update the search documents of the objects when the current transaction commits.
+    Objects scheduled more than once in a transaction are only indexed once.
+    """
+    if not pks or not get_setting("IMPRESSION_FULL_TEXT_SEARCH"):
+        return
+    if not connections[using].in_atomic_block:
+        update_index(model, list(pks), using)
+        return
+    get_pending_updates(using).pks.setdefault(model, set()).update(pks)
+
+
+def search(queryset, term):
+    """
+    Filter the queryset for objects whose search documents match the term, or return
+    ``None`` if full-text search isn't available.
+    """
+    backend = get_search_backend(queryset.db)
+    if not backend:
+        return None
+    sql, params = backend.get_match_sql(queryset.model, term)
+    return queryset.filter(pk__in=RawSQL(sql, params))
+
+
+def update_saved(sender, instance, using, **kwargs):
+    schedule_update(sender, [instance.pk], using)
+
+
+def update_recipients(sender, instance, action, reverse, using, **kwargs):
+    if not reverse and action.startswith("post_"):
+        schedule_update(type(instance), [instance.pk], using)
+
+
+def connect_signals():
+    """
+    Keep the search documents in sync; called when the app is ready, since the
+    models import this module.
+    """
+    for label in SEARCH_MODELS:
+        model = apps.get_model(label)
+        post_save.connect(update_saved, sender=model)
+        post_delete.connect(update_saved, sender=model)
+    Message = apps.get_model("impression.Message")
+    for kind in ("to", "cc", "bcc"):
+        field = Message._meta.get_field("extra_{}_email_addresses".format(kind))
+        m2m_changed.connect(update_recipients, sender=field.remote_field.through)
@@ -10,6 +10,7 @@ This module is designed to do 2 things:
 import os
 import sys
 
+import django
 from django.conf import settings
 
 
@@ -28,6 +29,24 @@ IMPRESSION_DEFAULT_SERVICE = "default"
 IMPRESSION_DEFAULT_TARGET = "http://127.0.0.1:8000/api/send_message/"
 IMPRESSION_DEFAULT_TOKEN = ""
 IMPRESSION_DEFAULT_UNSUBSCRIBED = False
+IMPRESSION_ASYNC_INTAKE = False
+IMPRESSION_RATE_LIMIT_BUCKETS = 60
+IMPRESSION_STREAM_CHUNK_SIZE = 500
+IMPRESSION_CACHE = "default"
+IMPRESSION_SERVICE_CACHE_TIMEOUT = 30
+IMPRESSION_INTAKE_THREADS = 16
+IMPRESSION_FAST_JSON = True
+IMPRESSION_MAX_BODY_SIZE = 1048576
+IMPRESSION_PACK_FINAL_RECIPIENTS = False
+IMPRESSION_ARCHIVE_AFTER_DAYS = 90
+IMPRESSION_PURGE_AFTER_DAYS = 365
+IMPRESSION_BODY_GRACE_PERIOD = 3600
+IMPRESSION_REPLICA_DATABASE = None
+IMPRESSION_REPLICA_LAG = 5
+IMPRESSION_FULL_TEXT_SEARCH = False
+IMPRESSION_IDEMPOTENCY_CLAIM_TIMEOUT = 300
+IMPRESSION_IDEMPOTENCY_KEY_TTL = 86400
+IMPRESSION_SQLITE_PRAGMAS = None
 
 EMAIL_BACKEND = "impression.backends.LocalEmailBackend"
 EMAIL_BACKEND = "impression_client.backends.RemoteEmailBackend"  # for testing the API
@@ -77,11 +96,28 @@ TEMPLATES = [
     }
 ]
 WSGI_APPLICATION = "impression.wsgi.application"
+ASGI_APPLICATION = "impression.asgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
-    }
+        # test on a file so that SQLite runs in WAL mode like it does standalone
+        "TEST": {"NAME": os.path.join(BASE_DIR, "test_db.sqlite3")},
+        # start transactions with the write lock, since a transaction which reads first
+        # can't wait for the lock when it later writes, and tune SQLite so the API and
+        # the sender can use the database at the same time (see impression.sqlite)
+        "OPTIONS": (
+            {
+                "transaction_mode": "IMMEDIATE",
+                "init_command": (
+                    "PRAGMA journal_mode = WAL; PRAGMA synchronous = NORMAL;"
+                    " PRAGMA busy_timeout = 5000; PRAGMA mmap_size = 268435456"
+                ),
+            }
+            if django.VERSION >= (5, 1)
+            else {}
+        ),
+    },
 }
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -97,6 +133,15 @@ REST_FRAMEWORK = {
         "rest_framework.authentication.SessionAuthentication",
         "rest_framework.authentication.TokenAuthentication",
     ),
+    "DEFAULT_PARSER_CLASSES": (
+        "impression.api.parsers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "impression.api.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
     "PAGE_SIZE": 10,
 }
@@ -120,3 +165,5 @@ if "test" in sys.argv:
         from .test_settings import *
     except ImportError:
         pass
+    else:
+        DATABASES.update(TEST_DATABASES)
@@ -0,0 +1,89 @@
+"""
+This module keeps the caches in ``impression.cache`` consistent with the database.
+"""
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+
+from .cache import invalidate_services, invalidate_user_group_ids
+from .models import RateLimit, Service
+
+
+@receiver(pre_save, sender=Service)
+def invalidate_renamed_service(sender, instance, **kwargs):
+    """
+    Invalidate the old name of a service which is being renamed.
+    """
+    if instance.pk:
+        invalidate_services(
+            *sender.objects.filter(pk=instance.pk)
+            .exclude(name=instance.name)
+            .values_list("name", flat=True)
+        )
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def invalidate_service(sender, instance, **kwargs):
+    invalidate_services(instance.name)
+
+
+@receiver(m2m_changed, sender=Service.allowed_groups.through)
+def invalidate_service_groups(sender, instance, reverse, pk_set, **kwargs):
+    if not reverse:
+        invalidate_services(instance.name)
+    else:
+        # the groups of the services were changed from the group side
+        services = Service.objects.all()
+        if pk_set:
+            services = services.filter(pk__in=pk_set)
+        invalidate_services(*services.values_list("name", flat=True))
+
+
+@receiver(post_save, sender=RateLimit)
+def invalidate_rate_limit(sender, instance, **kwargs):
+    invalidate_services(
+        *Service.objects.filter(rate_limit=instance).values_list("name", flat=True)
+    )
+
+
+@receiver(pre_delete, sender=RateLimit)
+def find_rate_limit_services(sender, instance, **kwargs):
+    """
+    Find the services of a rate limit which is being deleted, before ``SET_NULL``
+    detaches them, so they can be invalidated once it's deleted.
+    """
+    instance._impression_service_names = list(
+        Service.objects.filter(rate_limit=instance).values_list("name", flat=True)
+    )
+    invalidate_services(*instance._impression_service_names)
+
+
+@receiver(post_delete, sender=RateLimit)
+def invalidate_deleted_rate_limit(sender, instance, **kwargs):
+    invalidate_services(*getattr(instance, "_impression_service_names", []))
+
+
+@receiver(pre_delete, sender=Group)
+def invalidate_group(sender, instance, **kwargs):
+    """
+    Invalidate the services which allow a group which is being deleted (the deletion of
+    the M2M rows doesn't send ``m2m_changed``).
+    """
+    invalidate_services(
+        *Service.objects.filter(allowed_groups=instance).values_list("name", flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def invalidate_user_groups(sender, instance, reverse, **kwargs):
+    if not reverse:
+        invalidate_user_group_ids(instance)
@@ -0,0 +1,33 @@
+"""
+This module tunes SQLite connections so that the API intake and the sender can use the
+database concurrently. If ``IMPRESSION_SQLITE_PRAGMAS`` is set (it isn't by default), the
+``PRAGMA`` statements in it are run on each new SQLite connection. For example:
+
+ - ``journal_mode = WAL`` lets readers and a writer run at the same time.
+ - ``synchronous = NORMAL`` only syncs at checkpoints, which is safe in WAL mode.
+ - ``busy_timeout`` makes writers wait for the lock rather than failing with "database
+   is locked".
+ - ``mmap_size`` lets reads use memory-mapped I/O.
+
+On Django 5.1 and later, the database's ``init_command`` option can be used instead, as
+the standalone settings do.
+"""
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .settings import get_setting
+
+
+def get_pragma_statements(pragmas):
+    return ["PRAGMA {} = {}".format(name, value) for name, value in pragmas.items()]
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    pragmas = get_setting("IMPRESSION_SQLITE_PRAGMAS")
+    if connection.vendor != "sqlite" or not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for statement in get_pragma_statements(pragmas):
+            cursor.execute(statement)
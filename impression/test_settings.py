@@ -0,0 +1,17 @@
+"""
+Settings for running the tests of the standalone project, loaded by ``settings`` when
+the ``test`` command is run. The databases in ``TEST_DATABASES`` are added to
+``DATABASES``.
+"""
+
+import os
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEST_DATABASES = {
+    # only used by the tests of impression.routers.ReplicaRouter
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, "db_replica.sqlite3"),
+    },
+}
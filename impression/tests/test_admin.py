@@ -0,0 +1,134 @@
+"""
+This module is for testing the admin.
+"""
+
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from ..admin import MessageAdmin
+from ..models import EmailAddress, Message, Service
+from ..paginator import EstimatedCountPaginator, get_estimated_count
+
+
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class MessageAdminTestCase(TestCase):
+    url = reverse("admin:impression_message_changelist")
+
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.org", "pw")
+        self.client.force_login(self.user)
+        self.service = Service.objects.create(name="test_service")
+        self.to = EmailAddress.get_or_create("to@example.org")[0]
+        self.messages = [
+            Message.objects.create_ready(
+                to=[self.to], send_now=False, service=self.service, subject=str(i)
+            )
+            for i in range(5)
+        ]
+
+    def get_ids(self, response):
+        return [m.pk for m in response.context["cl"].result_list]
+
+    def test_changelist_queries(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(6):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+        # the number of queries doesn't grow with the number of rows
+        Message.objects.create_ready(to=[self.to], send_now=False, service=self.service)
+        with self.assertNumQueries(6):
+            self.client.get(self.url)
+
+    @mock.patch.object(MessageAdmin, "list_per_page", 2)
+    def test_keyset_pagination(self):
+        ids = [m.pk for m in reversed(self.messages)]
+        response = self.client.get(self.url)
+        self.assertEqual(self.get_ids(response), ids[:2])
+        cl = response.context["cl"]
+        self.assertIsNone(cl.keyset_first_url)
+        self.assertEqual(cl.keyset_next_url, "?before={}".format(ids[1]))
+
+        response = self.client.get(self.url + cl.keyset_next_url)
+        self.assertEqual(self.get_ids(response), ids[2:4])
+        self.assertIsNotNone(response.context["cl"].keyset_first_url)
+        self.assertContains(response, "?before={}".format(ids[3]))
+
+        # keyset pagination is only used in the default ordering
+        response = self.client.get(self.url, {"o": "3", "before": ids[1]})
+        self.assertEqual(response.context["cl"].queryset.count(), 5)
+        self.assertIsNone(response.context["cl"].keyset_next_url)
+
+    @mock.patch.object(MessageAdmin, "list_per_page", 2)
+    def test_paged_and_filtered_lists_are_not_counted(self):
+        ids = [m.pk for m in reversed(self.messages)]
+        for params in [
+            {"before": ids[1]},
+            {"before": ids[3]},
+            {"email_sent": "unsent"},
+        ]:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url, params)
+            self.assertFalse(
+                [q for q in queries if "COUNT(" in q["sql"].upper()], params
+            )
+        self.assertEqual(self.get_ids(response), ids[:2])
+        self.assertIsNotNone(response.context["cl"].keyset_next_url)
+
+        # there is no link to older messages on the last page
+        response = self.client.get(self.url, {"before": ids[2]})
+        self.assertEqual(self.get_ids(response), ids[3:])
+        self.assertIsNone(response.context["cl"].keyset_next_url)
+
+    def test_invalid_keyset(self):
+        response = self.client.get(self.url, {"before": "x"})
+        self.assertRedirects(response, self.url + "?e=1")
+
+    def test_created_filter(self):
+        old = self.messages[0]
+        Message.objects.filter(pk=old.pk).update(
+            created=timezone.now() - timezone.timedelta(days=30)
+        )
+        response = self.client.get(
+            self.url,
+            {"created__gte": (timezone.now() - timezone.timedelta(days=7)).isoformat()},
+        )
+        self.assertNotIn(old.pk, self.get_ids(response))
+        self.assertEqual(len(self.get_ids(response)), 4)
+
+
+class EstimatedCountPaginatorTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        Message.objects.bulk_create(Message(service=self.service) for i in range(20))
+
+    def test_estimate(self):
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+        estimate = get_estimated_count(Message, "default")
+        if estimate is None:
+            self.skipTest("No statistics")
+
+        paginator = EstimatedCountPaginator(Message.objects.order_by("pk"), 10)
+        paginator.min_estimate = 1
+        self.assertEqual(paginator.count, estimate)
+
+        # filtered querysets are counted
+        paginator = EstimatedCountPaginator(
+            Message.objects.filter(pk__gt=0).order_by("pk"), 10
+        )
+        paginator.min_estimate = 1
+        self.assertEqual(paginator.count, 20)
+
+    def test_small_table(self):
+        paginator = EstimatedCountPaginator(Message.objects.order_by("pk"), 10)
+        self.assertEqual(paginator.count, 20)
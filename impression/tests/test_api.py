@@ -0,0 +1,538 @@
+"""
+This module is for testing the API views.
+"""
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipIf
+
+import django
+from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from ..cache import get_service
+from ..models import IdempotencyKey, Message, RateLimit, RateLimitCounter, Service
+
+
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class APITestCase(TestCase):
+    def setUp(self):
+        self.rate_limit = RateLimit.objects.create(
+            name="Test Limit",
+            quantity=2,
+            grouping=RateLimit.PER_USER,
+            type=RateLimit.BLOCK_PERIOD,
+            block_period=RateLimit.DAY,
+        )
+        self.service = Service.objects.create(
+            name="test_service", rate_limit=self.rate_limit
+        )
+        self.group = Group.objects.create(name="Test Group")
+        self.service.allowed_groups.add(self.group)
+        self.user = User.objects.create(username="user")
+        self.user.groups.add(self.group)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send_message(self, headers=None, **data):
+        data.setdefault("service_name", self.service.name)
+        data.setdefault("to", ["test1@example.org"])
+        return self.client.post(
+            reverse("send_message"), data, format="json", **(headers or {})
+        )
+
+
+class QuotaTestCase(APITestCase):
+    def test_send_message_headers(self):
+        response = self.send_message(subject="Test")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response["X-RateLimit-Limit"], "2")
+        self.assertEqual(response["X-RateLimit-Remaining"], "1")
+        self.assertIn("X-RateLimit-Reset", response)
+
+        self.send_message(subject="Test")
+        response = self.send_message(subject="Test")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["X-RateLimit-Remaining"], "0")
+        self.assertIn("Retry-After", response)
+
+    def test_quota(self):
+        self.send_message(subject="Test")
+        response = self.client.get(reverse("quota", args=[self.service.name]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["limit"], 2)
+        self.assertEqual(response.data["remaining"], 1)
+        self.assertEqual(response["X-RateLimit-Remaining"], "1")
+
+    def test_quota_rendering(self):
+        response = self.client.get(reverse("quota", args=[self.service.name]))
+        data = json.loads(response.content)
+        self.assertEqual(data["limit"], 2)
+        self.assertTrue(data["reset"].endswith("Z"))
+
+    def test_quota_without_rate_limit(self):
+        self.service.rate_limit = None
+        self.service.save()
+        response = self.client.get(
+            reverse("quota"), {"service_name": self.service.name}
+        )
+        self.assertEqual(
+            response.data, {"limit": None, "remaining": None, "reset": None}
+        )
+        self.assertNotIn("X-RateLimit-Limit", response)
+
+    def test_quota_forbidden(self):
+        self.user.groups.clear()
+        response = self.client.get(reverse("quota", args=[self.service.name]))
+        self.assertEqual(response.status_code, 403)
+
+
+class SendMessagesTestCase(APITestCase):
+    def send_messages(self, messages, **kwargs):
+        return self.client.post(
+            reverse("send_messages"), {"messages": messages}, format="json", **kwargs
+        )
+
+    def test_send_messages(self):
+        response = self.send_messages(
+            [
+                {
+                    "service_name": self.service.name,
+                    "subject": "Test",
+                    "to": ["test1@example.org", "Test 2 <test2@example.org>"],
+                    "cc": "test3@example.org",
+                    "bcc": ["invalid"],
+                },
+                {"service_name": "missing"},
+                {"service_name": self.service.name, "body": {"a": 1}},
+                {"service_name": self.service.name},
+                {"service_name": self.service.name},
+            ]
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.data["results"]
+        self.assertEqual(
+            [r["status"] for r in results],
+            [201, 404, 400, 201, 429],
+        )
+        message = Message.objects.get(pk=results[0]["id"])
+        self.assertTrue(message.ready_to_send)
+        self.assertEqual(message.user, self.user)
+        self.assertEqual(
+            {e.email_address for e in message.extra_to_email_addresses.all()},
+            {"test1@example.org", "test2@example.org"},
+        )
+        self.assertEqual(
+            message.extra_cc_email_addresses.get().email_address, "test3@example.org"
+        )
+        self.assertFalse(message.extra_bcc_email_addresses.exists())
+        self.assertEqual(
+            self.rate_limit.get_counts(self.service, user=self.user),
+            {
+                "user:{}:{}".format(
+                    ContentType.objects.get_for_model(User).pk, self.user.pk
+                ): 2
+            },
+        )
+
+    def test_send_messages_forbidden(self):
+        self.user.groups.clear()
+        response = self.send_messages([{"service_name": self.service.name}])
+        self.assertEqual(response.data["results"][0]["status"], 403)
+
+    def test_send_messages_queries(self):
+        """
+        Test that the number of queries does not grow with the number of messages.
+        """
+        self.service.rate_limit = None
+        self.service.save()
+
+        def messages(n, domain):
+            return [
+                {"to": ["test{}@{}".format(i, domain)], "cc": ["cc@example.org"]}
+                for i in range(n)
+            ]
+
+        url = "{}?service_name={}".format(reverse("send_messages"), self.service.name)
+        self.client.post(url, {"messages": messages(2, "a.org")}, format="json")
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(url, {"messages": messages(2, "b.org")}, format="json")
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.post(
+                url, {"messages": messages(50, "c.org")}, format="json"
+            )
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(Message.objects.count(), 54)
+        self.assertTrue(all(r["status"] == 201 for r in response.data["results"]))
+
+
+class StreamMessagesTestCase(APITestCase):
+    def stream_messages(self, lines):
+        response = self.client.post(
+            "{}?service_name={}".format(reverse("stream_messages"), self.service.name),
+            "\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, 200)
+        return [
+            json.loads(line)
+            for line in b"".join(response.streaming_content).splitlines()
+        ]
+
+    @override_settings(IMPRESSION_STREAM_CHUNK_SIZE=2)
+    def test_stream_messages(self):
+        results = self.stream_messages(
+            [
+                json.dumps({"subject": "Test", "to": ["test1@example.org"]}),
+                "",
+                "not json",
+                json.dumps({"service_name": "missing"}),
+                json.dumps({"subject": "Test"}),
+                json.dumps({"subject": "Test"}),
+            ]
+        )
+        self.assertEqual(
+            [(r["line"], r["status"]) for r in results],
+            [(1, 201), (3, 400), (4, 404), (5, 201), (6, 429)],
+        )
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class AsyncIntakeTestCase(APITestCase):
+    def test_async_intake(self):
+        response = self.send_message(
+            subject="Test", headers={"HTTP_PREFER": "respond-async"}
+        )
+        self.assertEqual(response.status_code, 202)
+        message = Message.objects.get(pk=response.data["id"])
+        self.assertEqual(message.get_state(), Message.QUEUED)
+        self.assertEqual(len(mail.outbox), 0)
+
+        response = self.client.get(response.data["status_url"])
+        self.assertEqual(response.data["state"], Message.QUEUED)
+
+        call_command("impression_send_emails")
+        self.assertEqual(len(mail.outbox), 1)
+        response = self.client.get(reverse("message_status", args=[message.pk]))
+        self.assertEqual(response.data["state"], Message.SENT)
+        self.assertIsNotNone(response.data["sent"])
+
+    @override_settings(IMPRESSION_ASYNC_INTAKE=True)
+    def test_async_intake_setting(self):
+        response = self.send_message(subject="Test")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response["Location"], response.data["status_url"])
+
+    def test_sync_intake(self):
+        response = self.send_message(subject="Test")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_status_of_other_user(self):
+        response = self.send_message(
+            subject="Test", headers={"HTTP_PREFER": "respond-async"}
+        )
+        self.client.force_authenticate(User.objects.create(username="other"))
+        response = self.client.get(response.data["status_url"])
+        self.assertEqual(response.status_code, 404)
+
+
+class MessageStatusTestCase(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.message_ids = [
+            self.send_message(
+                subject="Test", headers={"HTTP_PREFER": "respond-async"}
+            ).data["id"]
+            for i in range(2)
+        ]
+
+    def test_status(self):
+        url = reverse("message_status", args=[self.message_ids[0]])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["state"], Message.QUEUED)
+        self.assertEqual(response.data["attempts"], 0)
+
+        # repeated polls are not modified
+        with self.assertNumQueries(1):
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(not_modified.status_code, 304)
+        not_modified = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+        )
+        self.assertEqual(not_modified.status_code, 304)
+
+        # until the message is sent
+        call_command("impression_send_emails")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["state"], Message.SENT)
+        self.assertEqual(response.data["attempts"], 1)
+
+    def test_batch_status(self):
+        response = self.client.get(
+            reverse("message_status"),
+            {"ids": ",".join(str(i) for i in self.message_ids + [0])},
+        )
+        self.assertEqual([r["id"] for r in response.data["results"]], self.message_ids)
+
+    def test_batch_status_invalid(self):
+        response = self.client.get(reverse("message_status"), {"ids": "1,a"})
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotencyKeyTestCase(APITestCase):
+    def test_retry_is_not_sent_twice(self):
+        headers = {"HTTP_IDEMPOTENCY_KEY": "abc"}
+        response = self.send_message(subject="Test", headers=headers)
+        self.assertEqual(response.status_code, 201)
+        with self.assertNumQueries(1):
+            retry = self.send_message(subject="Test", headers=headers)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(IdempotencyKey.objects.get().message, Message.objects.get())
+
+    def test_async_retry(self):
+        headers = {"HTTP_IDEMPOTENCY_KEY": "abc", "HTTP_PREFER": "respond-async"}
+        response = self.send_message(subject="Test", headers=headers)
+        retry = self.send_message(subject="Test", headers=headers)
+        self.assertEqual(retry.status_code, 202)
+        self.assertEqual(retry.data, response.data)
+        self.assertEqual(retry["Location"], response["Location"])
+
+    def test_keys_are_per_user(self):
+        self.send_message(subject="Test", headers={"HTTP_IDEMPOTENCY_KEY": "abc"})
+        other = User.objects.create(username="other")
+        other.groups.add(self.group)
+        self.client.force_authenticate(other)
+        self.send_message(subject="Test", headers={"HTTP_IDEMPOTENCY_KEY": "abc"})
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_failed_request_can_be_retried(self):
+        headers = {"HTTP_IDEMPOTENCY_KEY": "abc"}
+        response = self.send_message(service_name="missing", headers=headers)
+        self.assertEqual(response.status_code, 404)
+        response = self.send_message(subject="Test", headers=headers)
+        self.assertEqual(response.status_code, 201)
+
+    def test_in_progress(self):
+        IdempotencyKey.claim(self.user, "abc")
+        response = self.send_message(
+            subject="Test", headers={"HTTP_IDEMPOTENCY_KEY": "abc"}
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_stale_claim_is_reclaimed(self):
+        idempotency_key, _ = IdempotencyKey.claim(self.user, "abc")
+        IdempotencyKey.objects.filter(pk=idempotency_key.pk).update(
+            created=timezone.now() - timezone.timedelta(minutes=10)
+        )
+        response = self.send_message(
+            subject="Test", headers={"HTTP_IDEMPOTENCY_KEY": "abc"}
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(IdempotencyKey.objects.get().message, Message.objects.get())
+
+    def test_expired_key_is_reclaimed(self):
+        headers = {"HTTP_IDEMPOTENCY_KEY": "abc"}
+        self.send_message(subject="Test", headers=headers)
+        IdempotencyKey.objects.update(
+            created=timezone.now() - timezone.timedelta(days=2)
+        )
+        response = self.send_message(subject="Test", headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_send_failure_keeps_key(self):
+        headers = {"HTTP_IDEMPOTENCY_KEY": "abc"}
+        self.client.raise_request_exception = False
+        with mock.patch.object(Message, "send", side_effect=OSError):
+            response = self.send_message(subject="Test", headers=headers)
+        self.assertEqual(response.status_code, 500)
+        message = Message.objects.get()
+        self.assertEqual(IdempotencyKey.objects.get().message, message)
+
+        # the retry doesn't create another message, which is left for the workers
+        retry = self.send_message(subject="Test", headers=headers)
+        self.assertEqual(retry.status_code, 202)
+        self.assertEqual(retry.data["id"], message.pk)
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertTrue(Message.objects.filter(Message.ready_query).exists())
+
+
+class ServiceCacheTestCase(APITestCase):
+    def test_service_is_cached(self):
+        self.assertEqual(get_service(self.service.name), self.service)
+        with self.assertNumQueries(0):
+            service = get_service(self.service.name)
+        with self.assertNumQueries(1):
+            self.assertTrue(service.is_allowed(self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(service.is_allowed(self.user))
+
+    def test_invalidation(self):
+        self.assertEqual(self.send_message(subject="Test").status_code, 201)
+        self.service.allowed_groups.remove(self.group)
+        self.assertEqual(self.send_message(subject="Test").status_code, 403)
+        self.service.allowed_groups.add(self.group)
+        self.user.groups.remove(self.group)
+        self.assertEqual(self.send_message(subject="Test").status_code, 403)
+        self.user.groups.add(self.group)
+        self.rate_limit.quantity = 1
+        self.rate_limit.save()
+        self.assertEqual(self.send_message(subject="Test").status_code, 429)
+
+    def test_rate_limit_deleted(self):
+        self.assertIsNotNone(get_service(self.service.name).rate_limit)
+        self.rate_limit.delete()
+        self.assertIsNone(get_service(self.service.name).rate_limit)
+        self.assertEqual(self.send_message(subject="Test").status_code, 201)
+        self.assertFalse(RateLimitCounter.objects.exists())
+
+    def test_group_deleted(self):
+        self.assertEqual(
+            get_service(self.service.name).get_allowed_group_ids(), {self.group.pk}
+        )
+        self.group.delete()
+        self.assertEqual(get_service(self.service.name).get_allowed_group_ids(), set())
+
+    def test_rename(self):
+        get_service(self.service.name)
+        self.service.name = "renamed_service"
+        self.service.save()
+        with self.assertRaises(Service.DoesNotExist):
+            get_service("test_service")
+
+    def test_intake_queries(self):
+        self.rate_limit.quantity = 10
+        self.rate_limit.save()
+        self.send_message(subject="Test")
+
+        # each request authenticates a fresh user, whose groups aren't memoized yet
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.send_message(subject="Test").status_code, 201)
+        statements = [q["sql"] for q in queries.captured_queries]
+        insert = next(
+            i
+            for i, sql in enumerate(statements)
+            if sql.startswith('INSERT INTO "impression_message"')
+        )
+        # only the user's groups and the recipients are looked up, and the rate limit
+        # is reserved, before the message is inserted
+        self.assertEqual(
+            [
+                sql.split(" ")[0] + " " + sql.split('"')[1]
+                for sql in statements[:insert]
+                if not sql.startswith(("SAVEPOINT", "RELEASE SAVEPOINT"))
+                and "impression_emailaddress" not in sql
+            ],
+            ["SELECT auth_group", "UPDATE impression_ratelimitcounter"],
+        )
+
+
+@skipIf(django.VERSION < (5, 0), "AsyncClient.aforce_login needs Django 5.0")
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class AsyncSendMessageTestCase(TransactionTestCase):
+    """
+    The async view runs in other threads, so the data must be committed for them to see
+    it.
+    """
+
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        self.group = Group.objects.create(name="Test Group")
+        self.service.allowed_groups.add(self.group)
+        self.user = User.objects.create(username="user")
+        self.user.groups.add(self.group)
+
+    async def send_message(self, client, headers=None, **data):
+        data.setdefault("service_name", self.service.name)
+        data.setdefault("to", ["test1@example.org"])
+        return await client.post(
+            reverse("async_send_message"),
+            json.dumps(data),
+            content_type="application/json",
+            headers=headers,
+        )
+
+    async def test_async_send_message(self):
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        response = await self.send_message(client, subject="Test")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(mail.outbox[0].to, ["test1@example.org"])
+        self.assertEqual(await Message.objects.acount(), 1)
+
+    async def test_concurrent_requests(self):
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+
+        # more requests than threads are waited on by the event loop
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with mock.patch("impression.api.views._intake_executor", executor):
+                responses = await asyncio.gather(
+                    *[
+                        self.send_message(
+                            client, {"Prefer": "respond-async"}, subject=str(i)
+                        )
+                        for i in range(10)
+                    ]
+                )
+        self.assertEqual([r.status_code for r in responses], [202] * 10)
+        self.assertEqual(await Message.objects.acount(), 10)
+
+    async def test_unauthenticated(self):
+        response = await self.send_message(AsyncClient(), subject="Test")
+        self.assertIn(response.status_code, [401, 403])
+
+
+class PayloadLimitTestCase(APITestCase):
+    def test_service_body_limit(self):
+        self.service.max_body_size = 10
+        self.service.save()
+        response = self.send_message(body="x" * 11)
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(self.send_message(body="x" * 10).status_code, 201)
+
+    @override_settings(IMPRESSION_MAX_BODY_SIZE=10)
+    def test_global_body_limit(self):
+        self.service.json_body_policy = Service.PERMIT
+        self.service.save()
+        self.assertEqual(self.send_message(body={"a": "x" * 10}).status_code, 413)
+        response = self.client.post(
+            reverse("send_messages"),
+            {"messages": [{"service_name": self.service.name, "body": "x" * 11}]},
+            format="json",
+        )
+        self.assertEqual(response.data["results"][0]["status"], 413)
+
+    def test_invalid_json(self):
+        response = self.client.post(
+            reverse("send_message"), "{", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(IMPRESSION_FAST_JSON=False)
+    def test_without_fast_json(self):
+        self.assertEqual(self.send_message(subject="Test").status_code, 201)
@@ -0,0 +1,124 @@
+"""
+This module is for testing the message archive.
+"""
+
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from ..models import (
+    ArchivedMessage,
+    BodyBlob,
+    EmailAddress,
+    Message,
+    RateLimit,
+    Service,
+)
+
+
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        self.to = EmailAddress.get_or_create("to@example.org")[0]
+        self.cc = EmailAddress.get_or_create("cc@example.org")[0]
+
+    def send(self, days_ago, body="Body"):
+        message = Message.objects.create_ready(
+            to=[self.to], cc=[self.cc], service=self.service, subject="Test", body=body
+        )
+        sent = timezone.now() - timezone.timedelta(days=days_ago)
+        Message.objects.filter(pk=message.pk).update(created=sent, sent=sent)
+        return message
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command("impression_archive_messages", *args, stdout=out)
+        return out.getvalue()
+
+    def test_archive(self):
+        old = [self.send(100) for _ in range(3)]
+        recent = self.send(10)
+        self.assertIn("Archived 3 messages.", self.archive("--batch-size", "2"))
+
+        self.assertEqual(list(Message.objects.all()), [recent])
+        self.assertFalse(
+            Message.final_to_email_addresses.through.objects.exclude(
+                message=recent
+            ).exists()
+        )
+        archived = ArchivedMessage.objects.get(pk=old[0].pk)
+        self.assertEqual(archived.service, self.service)
+        self.assertEqual(archived.subject, "Test")
+        self.assertEqual(archived.get_extra_recipients(), ([self.to], [self.cc], []))
+        self.assertEqual(archived.get_final_recipients(), ([self.to], [self.cc], []))
+        self.assertIn("Body", archived.final_body_plaintext)
+        self.assertFalse(BodyBlob.objects.unreferenced().exists())
+
+    @override_settings(IMPRESSION_PACK_FINAL_RECIPIENTS=True)
+    def test_archive_packed(self):
+        message = self.send(100)
+        self.archive()
+        archived = ArchivedMessage.objects.get(pk=message.pk)
+        self.assertEqual(archived.final_recipients, message.final_recipients)
+        self.assertEqual(archived.get_final_recipients(), ([self.to], [self.cc], []))
+
+    def test_conflict(self):
+        message = self.send(100)
+        ArchivedMessage.objects.bulk_create(
+            [ArchivedMessage.from_message(message, "", "")]
+        )
+        with self.assertRaises(IntegrityError):
+            self.archive()
+        self.assertTrue(Message.objects.filter(pk=message.pk).exists())
+
+    def test_days(self):
+        self.send(20)
+        self.send(5)
+        self.archive("--days", "10")
+        self.assertEqual(ArchivedMessage.objects.count(), 1)
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_rolling_window(self):
+        RateLimit.objects.create(
+            name="Test Limit",
+            quantity=10,
+            type=RateLimit.ROLLING_WINDOW,
+            rolling_window=timezone.timedelta(days=200),
+        )
+        self.send(100)
+        self.archive()
+        self.assertFalse(ArchivedMessage.objects.exists())
+
+    def test_unsent(self):
+        message = Message.objects.create_ready(
+            service=self.service, send_now=False, subject="Test"
+        )
+        Message.objects.filter(pk=message.pk).update(
+            created=timezone.now() - timezone.timedelta(days=100)
+        )
+        self.archive()
+        self.assertTrue(Message.objects.exists())
+
+    def test_admin(self):
+        message = self.send(100)
+        self.archive()
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@example.org", "password")
+        )
+        response = self.client.get(
+            reverse("admin:impression_archivedmessage_changelist")
+        )
+        self.assertContains(response, "Test")
+        response = self.client.get(
+            reverse("admin:impression_archivedmessage_change", args=[message.pk])
+        )
+        self.assertContains(response, "cc@example.org")
+        self.assertNotContains(response, 'name="_save"')
@@ -0,0 +1,131 @@
+"""
+This module is for testing the local email backend.
+"""
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from ..exceptions import RateLimitException
+from ..models import EmailAddress, Message, RateLimit, Service
+
+
+@override_settings(
+    EMAIL_BACKEND="impression.backends.LocalEmailBackend",
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+    IMPRESSION_DEFAULT_SERVICE="default",
+)
+class LocalEmailBackendTestCase(TestCase):
+    def setUp(self):
+        self.default_service = Service.objects.create(name="default")
+        self.service = Service.objects.create(name="test_service")
+
+    def get_datatuple(self, n, service_name=None):
+        return [
+            (
+                "Test {}".format(i),
+                "Body",
+                "from@example.org",
+                ([service_name] if service_name else [])
+                + ["test{}@example.org".format(i)],
+            )
+            for i in range(n)
+        ]
+
+    def test_send_mail(self):
+        self.assertEqual(
+            mail.send_mail("Test", "Body", "from@example.org", ["to@example.org"]), 1
+        )
+        message = Message.objects.get()
+        self.assertEqual(message.service, self.default_service)
+        self.assertEqual(message.get_state(), Message.SENT)
+        self.assertEqual(mail.outbox[0].to, ["to@example.org"])
+
+    def test_send_mass_mail(self):
+        datatuple = self.get_datatuple(3) + self.get_datatuple(2, "test_service")
+        self.assertEqual(mail.send_mass_mail(datatuple), 5)
+        self.assertEqual(self.default_service.messages.count(), 3)
+        self.assertEqual(self.service.messages.count(), 2)
+        message = self.service.messages.get(subject="Test 1")
+        self.assertEqual(message.get_state(), Message.SENT)
+        self.assertEqual(
+            message.override_from_email_address.email_address, "from@example.org"
+        )
+        self.assertEqual(
+            list(message.extra_to_email_addresses.all()),
+            [EmailAddress.objects.get(email_address="test1@example.org")],
+        )
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_create_messages_queries(self):
+        backend = mail.get_connection()
+        with CaptureQueriesContext(connection) as queries:
+            backend.create_messages(
+                mail.EmailMessage(*data) for data in self.get_datatuple(20)
+            )
+        with CaptureQueriesContext(connection) as more_queries:
+            backend.create_messages(
+                mail.EmailMessage(*data) for data in self.get_datatuple(40)
+            )
+        self.assertEqual(len(queries), len(more_queries))
+        self.assertEqual(Message.objects.count(), 60)
+
+    def test_rate_limit(self):
+        self.service.rate_limit = RateLimit.objects.create(
+            name="Test Limit",
+            quantity=2,
+            type=RateLimit.BLOCK_PERIOD,
+            block_period=RateLimit.DAY,
+        )
+        self.service.save()
+        datatuple = self.get_datatuple(1) + self.get_datatuple(3, "test_service")
+        with self.assertRaises(RateLimitException):
+            mail.send_mass_mail(datatuple)
+        self.assertFalse(Message.objects.exists())
+
+        # the messages which still fit in the rate limit are created
+        self.assertEqual(mail.send_mass_mail(datatuple, fail_silently=True), 3)
+        self.assertEqual(self.default_service.messages.count(), 1)
+        self.assertEqual(self.service.messages.count(), 2)
+
+    def test_missing_service(self):
+        datatuple = self.get_datatuple(1, "missing_service")
+        with self.assertRaises(Service.DoesNotExist):
+            mail.send_mass_mail(datatuple)
+        self.assertEqual(mail.send_mass_mail(datatuple, fail_silently=True), 0)
+
+
+@override_settings(
+    EMAIL_BACKEND="impression.backends.QueuedEmailBackend",
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+    IMPRESSION_DEFAULT_SERVICE="default",
+)
+class QueuedEmailBackendTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="default")
+
+    def test_send_mail(self):
+        mail.send_mail("Test", "Body", "from@example.org", ["to@example.org"])
+        message = Message.objects.get()
+        self.assertEqual(message.get_state(), Message.QUEUED)
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command("impression_send_emails")
+        message.refresh_from_db()
+        self.assertEqual(message.get_state(), Message.SENT)
+        self.assertEqual(mail.outbox[0].to, ["to@example.org"])
+
+    def test_send_mass_mail(self):
+        datatuple = [("Test", "Body", None, ["to@example.org"])] * 3
+        self.assertEqual(mail.send_mass_mail(datatuple), 3)
+        self.assertEqual(Message.objects.filter(Message.ready_query).count(), 3)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_option(self):
+        backend = mail.get_connection(
+            "impression.backends.LocalEmailBackend", send_now=False
+        )
+        mail.send_mail("Test", "Body", None, ["to@example.org"], connection=backend)
+        self.assertEqual(Message.objects.get().get_state(), Message.QUEUED)
@@ -0,0 +1,139 @@
+"""
+This module is for testing the storage of final bodies as blobs.
+"""
+
+import zlib
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from ..models import BodyBlob, EmailAddress, Message, Service
+
+
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class BodyBlobTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        self.to = EmailAddress.get_or_create("to@example.org")[0]
+
+    def send(self, body):
+        return Message.objects.create_ready(
+            to=[self.to], service=self.service, subject="Test", body=body
+        )
+
+    def test_store(self):
+        blob = BodyBlob.store("Test body")
+        self.assertEqual(BodyBlob.store("Test body").pk, blob.pk)
+        self.assertEqual(BodyBlob.objects.count(), 1)
+        self.assertEqual(BodyBlob.objects.get().get_text(), "Test body")
+        self.assertEqual(blob.size, len("Test body"))
+
+    def test_identical_bodies_are_stored_once(self):
+        messages = [self.send("Same body") for _ in range(3)]
+        self.send("Other body")
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(len({m.final_body_plaintext_blob_id for m in messages}), 1)
+        self.assertEqual(BodyBlob.objects.count(), 2)
+
+        message = Message.objects.get(pk=messages[0].pk)
+        self.assertEqual(message.final_body_plaintext, mail.outbox[0].body)
+        self.assertEqual(message.final_body_html, "")
+
+    def test_unreferenced(self):
+        message = self.send("Body")
+        BodyBlob.store("Orphan")
+        self.assertEqual(
+            list(BodyBlob.objects.unreferenced()),
+            [BodyBlob.objects.get(hash=BodyBlob.get_hash("Orphan"))],
+        )
+        self.assertEqual(
+            BodyBlob.objects.unreferenced(
+                [Message.objects.filter(pk=message.pk)]
+            ).count(),
+            2,
+        )
+        message.delete()
+        self.assertEqual(BodyBlob.objects.unreferenced().count(), 2)
+
+    @override_settings(IMPRESSION_BODY_GRACE_PERIOD=0)
+    def test_delete_unreferenced(self):
+        orphan = BodyBlob.store("Orphan")
+        hashes = [orphan.pk, BodyBlob.store("Body").pk]
+
+        # the body is referenced after the hashes were selected, so it's kept
+        self.send("Body")
+        self.assertEqual(
+            BodyBlob.objects.filter(pk__in=hashes).delete_unreferenced(), 1
+        )
+        self.assertFalse(BodyBlob.objects.filter(pk=orphan.pk).exists())
+        self.assertTrue(BodyBlob.objects.filter(pk=hashes[1]).exists())
+
+    def test_grace_period(self):
+        """
+        Test that a blob which was just stored (e.g., for a message which hasn't been
+        saved yet) isn't purged, and that storing an old blob again keeps it.
+        """
+        orphan = BodyBlob.store("Orphan")
+        self.assertEqual(BodyBlob.objects.delete_unreferenced(), 0)
+
+        BodyBlob.objects.update(stored=timezone.now() - timezone.timedelta(hours=2))
+        BodyBlob.store("Orphan")
+        self.assertEqual(BodyBlob.objects.delete_unreferenced(), 0)
+
+        BodyBlob.objects.update(stored=timezone.now() - timezone.timedelta(hours=2))
+        self.assertEqual(BodyBlob.objects.delete_unreferenced(), 1)
+        self.assertFalse(BodyBlob.objects.filter(pk=orphan.pk).exists())
+
+    def test_admin_detail(self):
+        message = self.send("Admin body")
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@example.org", "password")
+        )
+        response = self.client.get(
+            reverse("admin:impression_message_change", args=[message.pk])
+        )
+        self.assertContains(response, "Body (plaintext, final)")
+        self.assertContains(response, "Admin body")
+
+
+class BodyBlobMigrationTestCase(TransactionTestCase):
+    before = [("impression", "0008_body_blob")]
+    after = [("impression", "0010_remove_message_final_body_text")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_migration(self):
+        apps = self.migrate(self.before)
+        service = apps.get_model("impression", "Service").objects.create(name="test")
+        OldMessage = apps.get_model("impression", "Message")
+        for body in ["Same", "Same", "Other", ""]:
+            OldMessage.objects.create(
+                service=service, final_body_plaintext=body, final_body_html=body
+            )
+
+        apps = self.migrate(self.after)
+        self.assertEqual(apps.get_model("impression", "BodyBlob").objects.count(), 2)
+        messages = apps.get_model("impression", "Message").objects.order_by("pk")
+        self.assertEqual(
+            [
+                zlib.decompress(m.final_body_plaintext_blob.data).decode()
+                for m in messages[:3]
+            ],
+            ["Same", "Same", "Other"],
+        )
+        self.assertEqual(messages[0].final_body_html_blob_id, BodyBlob.get_hash("Same"))
+        self.assertIsNone(messages[3].final_body_plaintext_blob)
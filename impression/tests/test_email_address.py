@@ -28,3 +28,18 @@ class EmailAddressTestCase(TestCase):
         upper_email1 = EmailAddress.get_or_create("jane@example.org")[0]
         upper_email2 = EmailAddress.get_or_create("jane@example.org")[0]
         self.assertEqual(upper_email1, upper_email2)
+
+    def test_bulk_get_or_create(self):
+        existing = EmailAddress.get_or_create("john@example.org")[0]
+        emails = EmailAddress.bulk_get_or_create(
+            ["John <john@example.org>", "JANE@example.org", "invalid", None]
+        )
+        self.assertEqual(
+            emails,
+            {
+                "John <john@example.org>": existing,
+                "JANE@example.org": EmailAddress.objects.get(
+                    email_address="jane@example.org"
+                ),
+            },
+        )
@@ -0,0 +1,245 @@
+"""
+This module is for testing the message model.
+"""
+
+import json
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .. import codec
+from ..models import EmailAddress, Message, RateLimit, Service
+
+
+@skipUnless(connection.vendor == "sqlite", "Query plans are checked on SQLite.")
+class MessageIndexTestCase(TestCase):
+    """
+    Test that the queue and rate limit queries are planned with the message indexes.
+    """
+
+    def setUp(self):
+        self.rate_limit = RateLimit.objects.create(
+            name="Test Limit",
+            quantity=100,
+            grouping=RateLimit.PER_USER,
+            type=RateLimit.ROLLING_WINDOW,
+        )
+        self.service = Service.objects.create(
+            name="test_service", rate_limit=self.rate_limit
+        )
+        self.user = User.objects.create(username="user")
+
+    def assertUsesIndex(self, queryset, index):
+        self.assertRegex(
+            queryset.explain(), r"USING (COVERING )?INDEX {}\b".format(index)
+        )
+
+    def test_ready_query(self):
+        # like a real table, where most messages have been sent; without statistics,
+        # SQLite can't tell that the partial index is smaller than the sent index
+        now = timezone.now()
+        Message.objects.bulk_create(
+            [
+                Message(service=self.service, ready_to_send=True, sent=now)
+                for _ in range(100)
+            ]
+            + [Message(service=self.service, ready_to_send=True) for _ in range(5)]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        queryset = (
+            Message.objects.filter(Message.ready_query)
+            .order_by("created")
+            .values_list("pk", flat=True)
+        )
+        self.assertUsesIndex(queryset, "impression_msg_ready")
+        self.assertNotIn("TEMP B-TREE", queryset.explain())
+
+    def test_rate_limit_total_query(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            self.service.messages.filter(
+                created__gte=now - self.rate_limit.rolling_window, created__lt=now
+            ).values("pk"),
+            "impression_msg_svc_created",
+        )
+
+    def test_rate_limit_user_query(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            self.service.messages.filter(
+                created__gte=now - self.rate_limit.rolling_window,
+                created__lt=now,
+                user_type=ContentType.objects.get_for_model(self.user),
+                user_id=self.user.pk,
+            ).values("pk"),
+            "impression_msg_svc_user",
+        )
+
+    def test_sent_filter(self):
+        self.assertUsesIndex(
+            Message.objects.filter(sent__isnull=False).values("pk"),
+            "impression_msg_sent",
+        )
+
+
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class MessageCreateReadyTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        self.to = EmailAddress.get_or_create("to@example.org")[0]
+        self.cc = EmailAddress.get_or_create("cc@example.org")[0]
+
+    def test_create_ready(self):
+        with CaptureQueriesContext(connection) as queries:
+            message = Message.objects.create_ready(
+                to=[self.to],
+                cc=[self.cc],
+                send_now=False,
+                service=self.service,
+                subject="Test",
+            )
+        writes = [
+            q["sql"].split(" (")[0]
+            for q in queries.captured_queries
+            if q["sql"].startswith(("INSERT", "UPDATE"))
+        ]
+        self.assertEqual(
+            writes,
+            [
+                'INSERT INTO "impression_message"',
+                'INSERT INTO "impression_message_extra_to_email_addresses"',
+                'INSERT INTO "impression_message_extra_cc_email_addresses"',
+            ],
+        )
+        self.assertEqual(message.get_state(), Message.QUEUED)
+        self.assertEqual(list(message.extra_to_email_addresses.all()), [self.to])
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_bulk_create_ready_without_returned_pks(self):
+        with mock.patch.object(
+            type(connection.features),
+            "can_return_rows_from_bulk_insert",
+            new_callable=mock.PropertyMock,
+            return_value=False,
+        ):
+            messages = Message.objects.bulk_create_ready(
+                [Message(service=self.service, subject=str(i)) for i in range(2)],
+                [([self.to], [], []), ([], [self.cc], [])],
+            )
+        self.assertEqual(
+            [list(m.extra_to_email_addresses.all()) for m in messages], [[self.to], []]
+        )
+        self.assertEqual(
+            [list(m.extra_cc_email_addresses.all()) for m in messages], [[], [self.cc]]
+        )
+        self.assertEqual(Message.objects.filter(ready_to_send=True).count(), 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_create_ready_send_now(self):
+        message = Message.objects.create_ready(
+            to=[self.to], service=self.service, subject="Test"
+        )
+        self.assertEqual(message.get_state(), Message.SENT)
+        self.assertEqual(mail.outbox[0].to, ["to@example.org"])
+
+
+class MessageSaveDatabaseTestCase(TestCase):
+    databases = {"default", "replica"}
+
+    def test_save_using(self):
+        """
+        Test that the checks and the insert run in a transaction on the database the
+        message is saved to.
+        """
+        service = Service.objects.using("replica").create(name="test_service")
+        with CaptureQueriesContext(connections["replica"]) as queries:
+            Message(service=service, subject="Test").save(using="replica")
+        self.assertTrue(queries.captured_queries[0]["sql"].startswith("SAVEPOINT"))
+        self.assertEqual(Message.objects.using("replica").count(), 1)
+
+
+class MessageBodyDataTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(
+            name="test_service", json_body_policy=Service.REQUIRE
+        )
+
+    def test_body_is_decoded_once(self):
+        message = Message(service=self.service, body='{"name": "Test"}')
+        with mock.patch("impression.codec.loads", wraps=codec.loads) as loads:
+            message.save(send_now=False)
+            self.assertEqual(message.get_context()["name"], "Test")
+        self.assertEqual(loads.call_count, 1)
+
+    def test_set_body_data(self):
+        message = Message(service=self.service)
+        message.set_body_data({"name": "Test"})
+        self.assertEqual(json.loads(message.body), {"name": "Test"})
+        message.body = '{"name": "Other"}'
+        self.assertEqual(message.get_body_data(), {"name": "Other"})
+        message.body = "[]"
+        self.assertIsNone(message.get_body_data())
+
+
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class MessageFinalRecipientsTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        self.to = [
+            EmailAddress.get_or_create("to{}@example.org".format(i))[0]
+            for i in range(3)
+        ]
+        self.bcc = EmailAddress.get_or_create("bcc@example.org")[0]
+
+    def send(self):
+        return Message.objects.create_ready(
+            to=self.to, bcc=[self.bcc], service=self.service, subject="Test"
+        )
+
+    @override_settings(IMPRESSION_PACK_FINAL_RECIPIENTS=True)
+    def test_packed(self):
+        message = Message.objects.create_ready(
+            to=self.to, bcc=[self.bcc], send_now=False, service=self.service
+        )
+        with CaptureQueriesContext(connection) as queries:
+            message.send()
+        self.assertFalse(
+            [q for q in queries.captured_queries if "final_to" in q["sql"]]
+        )
+        message.refresh_from_db()
+        self.assertEqual(
+            set(message.final_recipients.strip(",").split(",")),
+            {"t{}".format(e.pk) for e in self.to} | {"b{}".format(self.bcc.pk)},
+        )
+        self.assertFalse(message.final_to_email_addresses.exists())
+        to, cc, bcc = message.get_final_recipients()
+        self.assertEqual(set(to), set(self.to))
+        self.assertEqual((cc, bcc), ([], [self.bcc]))
+
+    def test_unpacked(self):
+        message = self.send()
+        self.assertEqual(message.final_recipients, "")
+        to, cc, bcc = message.get_final_recipients()
+        self.assertEqual(set(to), set(self.to))
+        self.assertEqual((cc, bcc), ([], [self.bcc]))
+
+    def test_sent_to(self):
+        unpacked = self.send()
+        with override_settings(IMPRESSION_PACK_FINAL_RECIPIENTS=True):
+            packed = self.send()
+        self.assertEqual(set(Message.objects.sent_to(self.to[1])), {unpacked, packed})
+        self.assertEqual(
+            set(Message.objects.sent_to(self.bcc, kinds=["bcc"])), {unpacked, packed}
+        )
+        self.assertFalse(Message.objects.sent_to(self.bcc, kinds=["to", "cc"]))
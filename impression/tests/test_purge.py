@@ -0,0 +1,110 @@
+"""
+This module is for testing the purge command.
+"""
+
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from ..models import (
+    ArchivedMessage,
+    BodyBlob,
+    EmailAddress,
+    IdempotencyKey,
+    Message,
+    RateLimit,
+    RateLimitCounter,
+    Service,
+)
+
+
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+    IMPRESSION_BODY_GRACE_PERIOD=0,
+)
+class PurgeTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        self.to = EmailAddress.get_or_create("to@example.org")[0]
+
+    def create(self, days_ago, send_now=True, body="Body"):
+        message = Message.objects.create_ready(
+            to=[self.to], send_now=send_now, service=self.service, body=body
+        )
+        created = timezone.now() - timezone.timedelta(days=days_ago)
+        Message.objects.filter(pk=message.pk).update(created=created)
+        Message.objects.filter(pk=message.pk, sent__isnull=False).update(sent=created)
+        return message
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command("impression_purge_messages", "--sleep", "0", *args, stdout=out)
+        return out.getvalue()
+
+    def test_purge(self):
+        old = [self.create(400, body="Body {}".format(i)) for i in range(5)]
+        queued = self.create(400, send_now=False)
+        recent = self.create(10)
+        out = self.purge("--chunk-size", "2")
+        self.assertIn("Deleted 5 messages", out)
+        self.assertIn("rows/s", out)
+        self.assertEqual(set(Message.objects.all()), {queued, recent})
+        self.assertFalse(
+            Message.extra_to_email_addresses.through.objects.filter(
+                message__in=[m.pk for m in old]
+            ).exists()
+        )
+        self.assertEqual(
+            set(BodyBlob.objects.values_list("pk", flat=True)),
+            {recent.final_body_plaintext_blob_id},
+        )
+
+    def test_days(self):
+        self.create(20)
+        self.create(5)
+        self.purge("--days", "10")
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_archived(self):
+        self.create(400)
+        call_command("impression_archive_messages", stdout=StringIO())
+        self.assertIn("Deleted 1 archived messages", self.purge())
+        self.assertFalse(ArchivedMessage.objects.exists())
+        self.assertFalse(BodyBlob.objects.exists())
+
+    def test_rate_limit_counters(self):
+        rate_limit = RateLimit.objects.create(
+            name="Test Limit", quantity=10, type=RateLimit.ROLLING_WINDOW
+        )
+        self.service.rate_limit = rate_limit
+        self.service.save()
+        self.create(0)
+        RateLimitCounter.objects.create(
+            rate_limit=rate_limit,
+            service=self.service,
+            key="total",
+            bucket=timezone.now() - timezone.timedelta(hours=2),
+            count=1,
+        )
+        self.assertIn("Deleted 1 rate limit counters", self.purge())
+        self.assertEqual(RateLimitCounter.objects.count(), 1)
+
+    def test_idempotency_keys(self):
+        user = User.objects.create(username="user")
+        old, _ = IdempotencyKey.claim(user, "old")
+        IdempotencyKey.claim(user, "new")
+        IdempotencyKey.objects.filter(pk=old.pk).update(
+            created=timezone.now() - timezone.timedelta(days=2)
+        )
+        self.assertIn("Deleted 1 idempotency keys", self.purge())
+        self.assertEqual(IdempotencyKey.objects.get().key, "new")
+
+    def test_dry_run(self):
+        self.create(400)
+        out = self.purge("--dry-run")
+        self.assertIn("Would delete 1 messages.", out)
+        self.assertIn("Would delete 1 bodies.", out)
+        self.assertEqual(Message.objects.count(), 1)
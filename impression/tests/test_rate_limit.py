@@ -4,10 +4,22 @@ This module is for testing the rate limiting mechanism.
 
 from unittest import mock
 
-from django.test import TestCase
+from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 
-from ..models import EmailAddress, RateLimit, Service
+from ..exceptions import RateLimitException
+from ..models import (
+    EmailAddress,
+    Message,
+    RateLimit,
+    RateLimitCounter,
+    RateLimitTokenBucket,
+    Service,
+)
 
 
 class RateLimitTestCase(TestCase):
@@ -29,16 +41,16 @@ class RateLimitTestCase(TestCase):
     @mock.patch("django.utils.timezone.now")
     def test_get_timeframe_rolling_window(self, mock_now):
         mock_now.return_value = timezone.datetime(2019, 12, 11, 4, 32, 45)
-        (then, now) = self.rate_limit.get_timeframe()
+        then, now = self.rate_limit.get_timeframe()
         self.assertEqual(then, timezone.datetime(2019, 12, 11, 3, 32, 45))
         self.assertEqual(now, timezone.datetime(2019, 12, 11, 4, 32, 45))
 
     @mock.patch("django.utils.timezone.now")
     def test_get_timeframe_block_hour(self, mock_now):
         self.rate_limit.type = RateLimit.BLOCK_PERIOD
-        self.rate_limit.save()
         mock_now.return_value = timezone.datetime(2019, 12, 11, 4, 32, 45)
-        (then, now) = self.rate_limit.get_timeframe()
+        self.rate_limit.save()
+        then, now = self.rate_limit.get_timeframe()
         self.assertEqual(then, timezone.datetime(2019, 12, 11, 4, 0, 0))
         self.assertEqual(now, timezone.datetime(2019, 12, 11, 4, 32, 45))
 
@@ -46,9 +58,9 @@ class RateLimitTestCase(TestCase):
     def test_get_timeframe_block_day(self, mock_now):
         self.rate_limit.type = RateLimit.BLOCK_PERIOD
         self.rate_limit.block_period = RateLimit.DAY
-        self.rate_limit.save()
         mock_now.return_value = timezone.datetime(2019, 12, 11, 4, 32, 45)
-        (then, now) = self.rate_limit.get_timeframe()
+        self.rate_limit.save()
+        then, now = self.rate_limit.get_timeframe()
         self.assertEqual(then, timezone.datetime(2019, 12, 11, 0, 0, 0))
         self.assertEqual(now, timezone.datetime(2019, 12, 11, 4, 32, 45))
 
@@ -56,19 +68,31 @@ class RateLimitTestCase(TestCase):
     def test_get_timeframe_block_week(self, mock_now):
         self.rate_limit.type = RateLimit.BLOCK_PERIOD
         self.rate_limit.block_period = RateLimit.WEEK
-        self.rate_limit.save()
         mock_now.return_value = timezone.datetime(2019, 12, 11, 4, 32, 45)
-        (then, now) = self.rate_limit.get_timeframe()
+        self.rate_limit.save()
+        then, now = self.rate_limit.get_timeframe()
         self.assertEqual(then, timezone.datetime(2019, 12, 8, 0, 0, 0))
         self.assertEqual(now, timezone.datetime(2019, 12, 11, 4, 32, 45))
 
+    def test_get_timeframe_block_week_start_of_month(self):
+        self.rate_limit.type = RateLimit.BLOCK_PERIOD
+        self.rate_limit.block_period = RateLimit.WEEK
+        now = timezone.datetime(2019, 10, 1, 4, 32, 45)
+        self.assertEqual(
+            self.rate_limit.get_timeframe(now)[0], timezone.datetime(2019, 9, 29)
+        )
+        now = timezone.datetime(2019, 12, 1, 4, 32, 45)
+        self.assertEqual(
+            self.rate_limit.get_timeframe(now)[0], timezone.datetime(2019, 12, 1)
+        )
+
     @mock.patch("django.utils.timezone.now")
     def test_get_timeframe_block_month(self, mock_now):
         self.rate_limit.type = RateLimit.BLOCK_PERIOD
         self.rate_limit.block_period = RateLimit.MONTH
-        self.rate_limit.save()
         mock_now.return_value = timezone.datetime(2019, 12, 11, 4, 32, 45)
-        (then, now) = self.rate_limit.get_timeframe()
+        self.rate_limit.save()
+        then, now = self.rate_limit.get_timeframe()
         self.assertEqual(then, timezone.datetime(2019, 12, 1, 0, 0, 0))
         self.assertEqual(now, timezone.datetime(2019, 12, 11, 4, 32, 45))
 
@@ -76,8 +100,312 @@ class RateLimitTestCase(TestCase):
     def test_check_service_good(self, mock_now):
         self.rate_limit.type = RateLimit.BLOCK_PERIOD
         self.rate_limit.block_period = RateLimit.MONTH
-        self.rate_limit.save()
         mock_now.return_value = timezone.datetime(2019, 12, 11, 4, 32, 45)
-        (then, now) = self.rate_limit.get_timeframe()
+        self.rate_limit.save()
+        then, now = self.rate_limit.get_timeframe()
         self.assertEqual(then, timezone.datetime(2019, 12, 1, 0, 0, 0))
         self.assertEqual(now, timezone.datetime(2019, 12, 11, 4, 32, 45))
+
+
+class RateLimitCounterTestCase(TestCase):
+    def setUp(self):
+        self.rate_limit = RateLimit.objects.create(
+            name="Test Limit",
+            quantity=3,
+            type=RateLimit.ROLLING_WINDOW,
+            rolling_window=timezone.timedelta(hours=1),
+        )
+        self.service = Service.objects.create(
+            name="test_service", rate_limit=self.rate_limit
+        )
+
+    def create_messages(self, n):
+        for i in range(n):
+            Message.objects.create(service=self.service, subject=str(i))
+
+    def test_counts_match_rolling_window(self):
+        self.create_messages(2)
+        now = timezone.now()
+        for offset in (
+            timezone.timedelta(0),
+            timezone.timedelta(minutes=59, seconds=59),
+            timezone.timedelta(hours=1, minutes=2),
+        ):
+            self.assertEqual(
+                self.rate_limit.get_counts(self.service, now=now + offset),
+                self.rate_limit.count_messages(self.service, now=now + offset),
+            )
+        self.assertEqual(
+            self.rate_limit.get_counts(self.service, now=now), {"total": 2}
+        )
+
+    def test_counts_match_block_period(self):
+        self.rate_limit.type = RateLimit.BLOCK_PERIOD
+        self.rate_limit.block_period = RateLimit.DAY
+        self.rate_limit.save()
+        self.create_messages(2)
+        self.assertEqual(
+            self.rate_limit.get_counts(self.service),
+            self.rate_limit.count_messages(self.service),
+        )
+        self.assertEqual(RateLimitCounter.objects.get().count, 2)
+
+    def test_expired_counters(self):
+        self.create_messages(2)
+        now = timezone.now()
+        self.assertFalse(self.rate_limit.get_expired_counters(now).exists())
+        later = now + timezone.timedelta(hours=1, minutes=2)
+        self.assertEqual(self.rate_limit.get_expired_counters(later).count(), 1)
+
+    def test_reserve_with_stale_counts(self):
+        """
+        Test that a reservation which raced with others (and so saw stale counts) still
+        cannot overshoot the quantity.
+        """
+        self.rate_limit.type = RateLimit.BLOCK_PERIOD
+        self.rate_limit.save()
+        self.create_messages(3)
+        with mock.patch.object(RateLimit, "get_counts", return_value={"total": 0}):
+            with self.assertRaises(RateLimitException):
+                self.rate_limit.reserve(self.service)
+        self.assertEqual(RateLimitCounter.objects.get().count, 3)
+
+    def test_check_service(self):
+        self.create_messages(2)
+        self.assertTrue(self.rate_limit.check_service(self.service))
+        self.create_messages(1)
+        self.assertFalse(self.rate_limit.check_service(self.service))
+        with self.assertRaises(RateLimitException):
+            self.create_messages(1)
+
+    def test_reassigned_rate_limit(self):
+        self.create_messages(2)
+        rate_limit = RateLimit.objects.create(
+            name="Other Limit", quantity=3, type=RateLimit.BLOCK_PERIOD
+        )
+        self.service.rate_limit = rate_limit
+        self.service.save()
+        self.assertEqual(rate_limit.get_counts(self.service), {"total": 2})
+        self.create_messages(1)
+        with self.assertRaises(RateLimitException):
+            self.create_messages(1)
+
+    def test_edited_rate_limit(self):
+        self.create_messages(2)
+        self.rate_limit.type = RateLimit.BLOCK_PERIOD
+        self.rate_limit.block_period = RateLimit.DAY
+        self.rate_limit.save()
+        self.assertEqual(RateLimitCounter.objects.get().count, 2)
+        self.assertEqual(self.rate_limit.get_counts(self.service), {"total": 2})
+
+    def test_changed_buckets_setting(self):
+        self.create_messages(1)
+        with override_settings(IMPRESSION_RATE_LIMIT_BUCKETS=1):
+            self.assertEqual(
+                self.rate_limit.get_counts(self.service),
+                self.rate_limit.count_messages(self.service),
+            )
+            self.assertEqual(
+                RateLimitCounter.objects.get().bucket,
+                self.rate_limit.get_bucket(Message.objects.get().created),
+            )
+            self.assertEqual(
+                RateLimit.objects.get().counter_config, "rolling_window:total:3600"
+            )
+
+
+class RateLimitPerGroupTestCase(TestCase):
+    def setUp(self):
+        self.rate_limit = RateLimit.objects.create(
+            name="Test Limit",
+            quantity=3,
+            grouping=RateLimit.PER_GROUP,
+            type=RateLimit.BLOCK_PERIOD,
+            block_period=RateLimit.DAY,
+        )
+        self.service = Service.objects.create(
+            name="test_service", rate_limit=self.rate_limit
+        )
+        self.groups = [Group.objects.create(name="group{}".format(i)) for i in range(3)]
+        self.service.allowed_groups.add(*self.groups)
+        self.user1 = User.objects.create(username="user1")
+        self.user1.groups.add(*self.groups)
+        self.user2 = User.objects.create(username="user2")
+        self.user2.groups.add(self.groups[0])
+
+    def create_message(self, user):
+        message = Message(service=self.service)
+        message.user = user
+        message.save()
+
+    def test_count_messages(self):
+        self.create_message(self.user1)
+        self.create_message(self.user2)
+        ContentType.objects.get_for_model(User)
+        with self.assertNumQueries(1):
+            counts = self.rate_limit.count_messages(self.service, groups=self.groups)
+        self.assertEqual(
+            counts,
+            {
+                "group:{}".format(self.groups[0].pk): 2,
+                "group:{}".format(self.groups[1].pk): 1,
+                "group:{}".format(self.groups[2].pk): 1,
+            },
+        )
+        self.assertEqual(
+            counts, self.rate_limit.get_counts(self.service, groups=self.groups)
+        )
+
+    def test_check_service(self):
+        self.create_message(self.user1)
+        self.create_message(self.user1)
+        self.assertTrue(self.rate_limit.check_service(self.service, groups=self.groups))
+        self.create_message(self.user2)
+        self.assertFalse(
+            self.rate_limit.check_service(self.service, groups=self.groups)
+        )
+
+    def test_reserve_all_groups_or_none(self):
+        self.create_message(self.user1)
+        self.create_message(self.user1)
+        self.create_message(self.user2)
+        with self.assertRaises(RateLimitException):
+            self.rate_limit.reserve(self.service, groups=self.groups[::-1])
+        self.assertEqual(
+            self.rate_limit.get_counts(self.service, groups=self.groups),
+            {
+                "group:{}".format(self.groups[0].pk): 3,
+                "group:{}".format(self.groups[1].pk): 2,
+                "group:{}".format(self.groups[2].pk): 2,
+            },
+        )
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_reassigned_rate_limit(self):
+        self.create_message(self.user1)
+        self.create_message(self.user2)
+        self.service.rate_limit = RateLimit.objects.create(
+            name="Other Limit", grouping=RateLimit.PER_GROUP, quantity=3
+        )
+        self.service.save()
+        self.assertEqual(
+            self.service.rate_limit.get_counts(self.service, groups=self.groups),
+            self.service.rate_limit.count_messages(self.service, groups=self.groups),
+        )
+
+
+class RateLimitTokenBucketTestCase(TestCase):
+    def setUp(self):
+        self.rate_limit = RateLimit.objects.create(
+            name="Test Limit",
+            quantity=2,
+            type=RateLimit.TOKEN_BUCKET,
+            rolling_window=timezone.timedelta(hours=1),
+            burst=3,
+        )
+        self.service = Service.objects.create(
+            name="test_service", rate_limit=self.rate_limit
+        )
+        self.now = timezone.now()
+
+    def test_rule(self):
+        self.assertEqual(
+            self.rate_limit.rule(),
+            "2 messages refilled over: 0 days, 1 hours, 0 minutes, 0 seconds, with "
+            "bursts of up to 3",
+        )
+
+    def test_burst(self):
+        for _ in range(3):
+            self.rate_limit.reserve(self.service, now=self.now)
+        with self.assertRaises(RateLimitException):
+            self.rate_limit.reserve(self.service, now=self.now)
+        self.assertFalse(self.rate_limit.check_service(self.service))
+
+    def test_refill(self):
+        for _ in range(3):
+            self.rate_limit.reserve(self.service, now=self.now)
+        later = self.now + timezone.timedelta(minutes=30)
+        self.assertEqual(
+            self.rate_limit.get_tokens(self.service, now=later), {"total": 1}
+        )
+        self.rate_limit.reserve(self.service, now=later)
+        with self.assertRaises(RateLimitException):
+            self.rate_limit.reserve(self.service, now=later)
+
+    def test_quota(self):
+        self.assertEqual(
+            self.rate_limit.get_quota(self.service, now=self.now), (3, 3, self.now)
+        )
+        for _ in range(3):
+            self.rate_limit.reserve(self.service, now=self.now)
+        # 2 tokens per hour, so the next one is in 30 minutes
+        self.assertEqual(
+            self.rate_limit.get_quota(self.service, now=self.now),
+            (3, 0, self.now + timezone.timedelta(minutes=30)),
+        )
+
+    def test_stale_reads_fail_closed(self):
+        self.rate_limit.reserve(self.service, now=self.now)
+
+        # the bucket always seems to have changed since it was read
+        with mock.patch("django.db.models.QuerySet.update", return_value=0):
+            with self.assertRaises(RateLimitException):
+                self.rate_limit.reserve(self.service, now=self.now)
+        self.assertEqual(RateLimitTokenBucket.objects.get().tokens, 2)
+
+    def test_refill_caps_at_burst(self):
+        self.rate_limit.reserve(self.service, now=self.now)
+        later = self.now + timezone.timedelta(days=1)
+        self.assertEqual(
+            self.rate_limit.get_tokens(self.service, now=later), {"total": 3}
+        )
+        bucket = RateLimitTokenBucket.objects.get()
+        self.assertEqual(bucket.tokens, 2)
+
+
+class RateLimitCounterMigrationTestCase(TransactionTestCase):
+    before = [("impression", "0001_initial")]
+    after = [("impression", "0002_ratelimitcounter")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_migration(self):
+        apps = self.migrate(self.before)
+        rate_limit = apps.get_model("impression", "RateLimit").objects.create(
+            name="Test Limit",
+            quantity=10,
+            grouping=RateLimit.PER_GROUP,
+            type=RateLimit.BLOCK_PERIOD,
+            block_period=RateLimit.DAY,
+        )
+        service = apps.get_model("impression", "Service").objects.create(
+            name="test_service", rate_limit=rate_limit
+        )
+        group = apps.get_model("auth", "Group").objects.create(name="group")
+        user = apps.get_model("auth", "User").objects.create(username="user")
+        user.groups.add(group)
+        user_type = apps.get_model("contenttypes", "ContentType").objects.get(
+            app_label="auth", model="user"
+        )
+        OldMessage = apps.get_model("impression", "Message")
+        for _ in range(2):
+            OldMessage.objects.create(
+                service=service, user_type=user_type, user_id=user.pk
+            )
+        old = OldMessage.objects.create(service=service)
+        OldMessage.objects.filter(pk=old.pk).update(
+            created=timezone.now() - timezone.timedelta(days=2)
+        )
+
+        apps = self.migrate(self.after)
+        counter = apps.get_model("impression", "RateLimitCounter").objects.get()
+        self.assertEqual(counter.key, "group:{}".format(group.pk))
+        self.assertEqual(counter.count, 2)
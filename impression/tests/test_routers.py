@@ -0,0 +1,106 @@
+"""
+This module is for testing the read replica database router.
+"""
+
+import threading
+import unittest
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from ..models import Message, Service
+from ..routers import ReplicaRouter, get_replica, replica_reads
+
+
+@unittest.skipUnless("replica" in settings.DATABASES, "No replica database")
+@override_settings(
+    DATABASE_ROUTERS=["impression.routers.ReplicaRouter"],
+    IMPRESSION_REPLICA_DATABASE="replica",
+    IMPRESSION_REPLICA_LAG=0,
+)
+class ReplicaRouterTestCase(TestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        Service.objects.create(name="primary")
+        Service.objects.using("replica").create(name="replica")
+
+    def get_names(self):
+        return set(Service.objects.values_list("name", flat=True))
+
+    def test_reads(self):
+        self.assertEqual(self.get_names(), {"primary"})
+        with replica_reads():
+            self.assertEqual(self.get_names(), {"replica"})
+        self.assertEqual(self.get_names(), {"primary"})
+
+    def test_decorator_in_threads(self):
+        entered, errors = threading.Barrier(2), []
+
+        @replica_reads()
+        def read():
+            entered.wait()
+            return get_replica()
+
+        def run():
+            try:
+                self.assertEqual(read(), "replica")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIsNone(get_replica())
+
+    def test_writes(self):
+        with replica_reads():
+            service = Service.objects.create(name="new")
+            self.assertEqual(service._state.db, "default")
+
+            # queue claims are routed as writes
+            with transaction.atomic():
+                claimed = Service.objects.select_for_update().filter(name="new")
+                self.assertEqual(claimed.db, "default")
+                self.assertTrue(claimed.exists())
+
+    @override_settings(IMPRESSION_REPLICA_LAG=60)
+    def test_lag(self):
+        with replica_reads():
+            Service.objects.create(name="new")
+            self.assertEqual(self.get_names(), {"primary", "new"})
+
+    @override_settings(IMPRESSION_REPLICA_DATABASE=None)
+    def test_no_replica(self):
+        with replica_reads():
+            self.assertEqual(self.get_names(), {"primary"})
+
+    def test_allow_migrate(self):
+        router = ReplicaRouter()
+        self.assertFalse(router.allow_migrate("replica", "impression"))
+        self.assertIsNone(router.allow_migrate("default", "impression"))
+
+    def test_status(self):
+        user = User.objects.create(username="user")
+        message = Message.objects.create_ready(
+            send_now=False, service=Service.objects.get(name="primary"), user=user
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+
+        # batch lookups only see the replica
+        response = client.get(reverse("message_status"), {"ids": message.pk})
+        self.assertEqual(response.data["results"], [])
+
+        # but a single message falls back to the primary
+        response = client.get(reverse("message_status", args=[message.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["id"], message.pk)
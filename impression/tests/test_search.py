@@ -0,0 +1,147 @@
+"""
+This module is for testing full-text search.
+"""
+
+import unittest
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .. import search
+from ..models import EmailAddress, Message, Service, Template
+
+
+@unittest.skipUnless(
+    search.SEARCH_BACKENDS.get(connection.vendor)
+    and search.SEARCH_BACKENDS[connection.vendor](connection).is_available(),
+    "Full-text search is not supported by the database",
+)
+@override_settings(
+    IMPRESSION_FULL_TEXT_SEARCH=True,
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+)
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        self.to = EmailAddress.get_or_create("alice@example.org")[0]
+
+    def create(self, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.create_ready(
+                to=[self.to], send_now=False, service=self.service, **kwargs
+            )
+
+    def search(self, term, queryset=None):
+        return set(search.search(queryset or Message.objects.all(), term))
+
+    def test_search(self):
+        invoice = self.create(subject="Your invoice", body="Amount due")
+        receipt = self.create(subject="Your receipt", body="Thank you")
+        self.assertEqual(self.search("invoice"), {invoice})
+        self.assertEqual(self.search("your"), {invoice, receipt})
+        self.assertEqual(self.search("your due"), {invoice})
+        self.assertEqual(self.search("rece"), {receipt})
+        self.assertEqual(self.search('"quoted'), set())
+
+    def test_recipients(self):
+        message = self.create(subject="Hello")
+        self.assertEqual(self.search("alice@example.org"), {message})
+
+        # recipients added later, and the final recipients of sent messages
+        bob = EmailAddress.get_or_create("bob@example.org")[0]
+        carol = EmailAddress.get_or_create("carol@example.org")[0]
+        self.service.cc_email_addresses.add(carol)
+        with self.captureOnCommitCallbacks(execute=True):
+            message.extra_bcc_email_addresses.add(bob)
+        self.assertEqual(self.search("bob"), {message})
+        with self.captureOnCommitCallbacks(execute=True):
+            message.send()
+        self.assertEqual(self.search("carol"), {message})
+
+    def test_bulk_create(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.bulk_create_ready(
+                [Message(service=self.service, subject="Bulk")], [([self.to], [], [])]
+            )[0]
+        self.assertEqual(self.search("bulk alice"), {message})
+
+    def test_rollback(self):
+        """
+        Test that objects scheduled in a transaction which was rolled back aren't
+        indexed with the next one.
+        """
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    Message.objects.create(service=self.service, subject="Gone")
+                    raise RuntimeError()
+            message = Message.objects.create(service=self.service, subject="Kept")
+        self.assertEqual(
+            [c.pks for c in callbacks if isinstance(c, search.PendingUpdates)],
+            [{Message: {message.pk}}],
+        )
+
+    def test_update_queries(self):
+        messages = [self.create(subject="Message {}".format(i)) for i in range(2)]
+        with CaptureQueriesContext(connection) as queries:
+            search.update_index(Message, [m.pk for m in messages], "default")
+        messages += [self.create(subject="Message {}".format(i)) for i in range(4)]
+        with CaptureQueriesContext(connection) as more_queries:
+            search.update_index(Message, [m.pk for m in messages], "default")
+        self.assertEqual(len(queries), len(more_queries))
+
+    def test_delete(self):
+        message = self.create(subject="Deleted")
+        with self.captureOnCommitCallbacks(execute=True):
+            message.delete()
+        sql, params = search.get_search_backend("default").get_match_sql(
+            Message, "deleted"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            self.assertEqual(cursor.fetchall(), [])
+
+    def test_templates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            template = Template.objects.create(name="receipt", body_html="<b>Total</b>")
+        self.assertEqual(self.search("total", Template.objects.all()), {template})
+
+    def test_rebuild(self):
+        with self.settings(IMPRESSION_FULL_TEXT_SEARCH=False):
+            message = self.create(subject="Unindexed")
+        self.assertEqual(self.search("unindexed"), set())
+        out = StringIO()
+        call_command("impression_rebuild_search_index", stdout=out)
+        self.assertIn("Indexed 1 messages.", out.getvalue())
+        self.assertEqual(self.search("unindexed"), {message})
+
+    def test_admin(self):
+        user = User.objects.create_superuser("admin", "admin@example.org", "pw")
+        self.client.force_login(user)
+        message = self.create(subject="Invoice")
+        self.create(subject="Receipt")
+        response = self.client.get(
+            reverse("admin:impression_message_changelist"), {"q": "alice invoice"}
+        )
+        self.assertEqual(list(response.context["cl"].result_list), [message])
+
+
+class SearchDisabledTestCase(TestCase):
+    def test_disabled(self):
+        self.assertIsNone(search.search(Message.objects.all(), "test"))
+        with self.assertRaises(CommandError):
+            call_command("impression_rebuild_search_index")
+
+    def test_admin(self):
+        user = User.objects.create_superuser("admin", "admin@example.org", "pw")
+        self.client.force_login(user)
+        Template.objects.create(name="receipt", subject="Your receipt")
+        response = self.client.get(
+            reverse("admin:impression_template_changelist"), {"q": "receipt"}
+        )
+        self.assertEqual(len(response.context["cl"].result_list), 1)
@@ -0,0 +1,124 @@
+"""
+This module is for testing the tuning of SQLite connections.
+"""
+
+import threading
+import unittest
+
+from django.contrib.auth.models import Group, User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from ..models import Message, Service
+from ..sqlite import configure_sqlite, get_pragma_statements
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "SQLite only")
+class SQLitePragmaTestCase(TestCase):
+    def get_pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA {}".format(name))
+            return cursor.fetchone()[0]
+
+    def set_pragmas(self, pragmas):
+        with override_settings(IMPRESSION_SQLITE_PRAGMAS=pragmas):
+            configure_sqlite(None, connection)
+
+    def test_pragmas(self):
+        self.addCleanup(
+            self.set_pragmas, {"busy_timeout": self.get_pragma("busy_timeout")}
+        )
+        self.set_pragmas({"busy_timeout": 1234})
+        self.assertEqual(self.get_pragma("busy_timeout"), 1234)
+
+        # the connection is left alone by default
+        self.set_pragmas(None)
+        self.assertEqual(self.get_pragma("busy_timeout"), 1234)
+
+    @unittest.skipUnless(
+        connection.settings_dict["OPTIONS"].get("init_command"),
+        "Standalone settings only",
+    )
+    def test_standalone_pragmas(self):
+        if not connection.is_in_memory_db():
+            self.assertEqual(self.get_pragma("journal_mode"), "wal")
+        self.assertEqual(self.get_pragma("synchronous"), 1)  # NORMAL
+        self.assertEqual(self.get_pragma("busy_timeout"), 5000)
+
+    def test_pragma_statements(self):
+        self.assertEqual(
+            get_pragma_statements({"journal_mode": "WAL", "busy_timeout": 100}),
+            ["PRAGMA journal_mode = WAL", "PRAGMA busy_timeout = 100"],
+        )
+
+
+@unittest.skipUnless(
+    connection.vendor == "sqlite"
+    and not connection.is_in_memory_db()
+    and connection.settings_dict["OPTIONS"].get("transaction_mode") == "IMMEDIATE",
+    "SQLite file databases with immediate transactions only",
+)
+@override_settings(
+    IMPRESSION_EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class SQLiteConcurrencyTestCase(TransactionTestCase):
+    writers = 4
+    messages_per_writer = 10
+
+    def setUp(self):
+        self.service = Service.objects.create(name="test_service")
+        group = Group.objects.create(name="Test Group")
+        self.service.allowed_groups.add(group)
+        self.user = User.objects.create(username="user")
+        self.user.groups.add(group)
+        self.errors = []
+
+    def run_in_thread(self, target):
+        def run():
+            try:
+                target()
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def write(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for _ in range(self.messages_per_writer):
+            response = client.post(
+                reverse("send_message"),
+                {"service_name": self.service.name, "to": ["to@example.org"]},
+                format="json",
+                HTTP_PREFER="respond-async",
+            )
+            if response.status_code != 202:
+                raise AssertionError(response.data)
+
+    def send(self, done):
+        while not done.is_set():
+            call_command("impression_send_emails")
+
+    def test_intake_while_sending(self):
+        done = threading.Event()
+        sender = self.run_in_thread(lambda: self.send(done))
+        writers = [self.run_in_thread(self.write) for _ in range(self.writers)]
+        for writer in writers:
+            writer.join()
+        done.set()
+        sender.join()
+        self.assertEqual(self.errors, [])
+
+        call_command("impression_send_emails")
+        self.assertEqual(
+            Message.objects.filter(sent__isnull=False).count(),
+            self.writers * self.messages_per_writer,
+        )
@@ -15,7 +15,8 @@ setup(
     version=impression.__version__,
     packages=find_packages(),
     install_requires=[
-        "Django>=2",
+        "Django>=3.1",
+        "asgiref>=3.3.2",
         "djangorestframework>=3",
         "django-impression-client",
         "beautifulsoup4>=4.4",
@@ -29,10 +30,14 @@ setup(
     classifiers=[
         "Environment :: Web Environment",
         "Framework :: Django",
-        "Framework :: Django :: 2.0",
-        "Framework :: Django :: 2.1",
-        "Framework :: Django :: 2.2",
-        "Framework :: Django :: 3.0",
+        "Framework :: Django :: 3.1",
+        "Framework :: Django :: 3.2",
+        "Framework :: Django :: 4.0",
+        "Framework :: Django :: 4.1",
+        "Framework :: Django :: 4.2",
+        "Framework :: Django :: 5.0",
+        "Framework :: Django :: 5.1",
+        "Framework :: Django :: 5.2",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3",